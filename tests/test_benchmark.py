@@ -0,0 +1,38 @@
+"""
+Benchmarks of grid network scenarios compared with the stored baselines in benchmark_baseline.json.
+
+They are opt-in because they take a long time and several GB of memory, and the wall-clock and memory baselines depend on the machine.
+They run only if the environment variable UXSIMPP_BENCH_MAX_GRID is set, e.g. `UXSIMPP_BENCH_MAX_GRID=10 pytest tests/test_benchmark.py`, and then the grid sizes up to it are run.
+Regenerate the baselines by `python -m uxsimpp.benchmark --max-grid 20 --update` before comparing on another machine.
+The scaling sweep is also available as `python -m uxsimpp.benchmark`.
+"""
+
+import pytest
+import sys, os
+import warnings
+
+sys.path.append("..")
+
+from uxsimpp.benchmark import benchmark_scenarios, scenario_name, run_benchmark_isolated, load_baseline, compare_with_baseline
+
+
+warnings.filterwarnings("ignore", message=".*cannot collect 'test' because it is not a function.*")
+
+BASELINE = load_baseline(os.path.join(os.path.dirname(__file__), "benchmark_baseline.json"))
+MAX_GRID = int(os.environ.get("UXSIMPP_BENCH_MAX_GRID", 0))
+
+pytestmark = pytest.mark.skipif("UXSIMPP_BENCH_MAX_GRID" not in os.environ, reason="benchmarks run only if UXSIMPP_BENCH_MAX_GRID is set")
+
+
+@pytest.mark.parametrize("params", benchmark_scenarios(MAX_GRID), ids=scenario_name)
+def test_benchmark(params):
+    name = scenario_name(params)
+    res = run_benchmark_isolated(params)
+    print(name, res)
+
+    assert res["trips_completed"] > 0
+    if name not in BASELINE:
+        pytest.skip(f"no baseline for {name}")
+    assert res["platoons"] == BASELINE[name]["platoons"]
+    regressions = compare_with_baseline(res, BASELINE[name])
+    assert not regressions, f"{name}: " + ", ".join(regressions)
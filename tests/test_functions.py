@@ -1,5 +1,5 @@
 import pytest
-import sys, os
+import sys, os, struct
 import random
 import warnings
 from collections import defaultdict
@@ -14,6 +14,33 @@ from uxsimpp import *
 
 warnings.filterwarnings("ignore", message=".*cannot collect 'test' because it is not a function.*")
 
+####################################################
+## MARK: Scenarios
+
+def _two_route_world(signal=False, bottleneck=None, link2a_length=1000, link2b_speed=15, demand=(0, 2000, 0.8), network=None, **kwargs):
+    """
+    Build the small scenario shared by many tests: two routes orig-mid1-dest and orig-mid2-dest.
+
+    `signal` puts a signal at mid2 for link2b, and `bottleneck` is the name of a link with capacity_out=0.4.
+    The other keyword arguments are passed to `newWorld`. The network is not built if `network` is given.
+    """
+    params = dict(tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, duo_update_weight=0.25, print_mode=0, random_seed=42)
+    params.update(kwargs)
+    W = newWorld("test", network=network, **params)
+
+    if network is None:
+        capacity_out = {bottleneck: 0.4}
+        W.addNode("orig", 0, 0)
+        W.addNode("mid1", 1, 1)
+        W.addNode("mid2", 1, -1, signal_intervals=[60, 60] if signal else [0])
+        W.addNode("dest", 2, 0)
+        W.addLink("link1a", "orig", "mid1", 1000, 20, 0.2, 1, capacity_out=capacity_out.get("link1a", -1))
+        W.addLink("link1b", "mid1", "dest", 1000, 20, 0.2, 1, capacity_out=capacity_out.get("link1b", -1))
+        W.addLink("link2a", "orig", "mid2", link2a_length, 20, 0.2, 1, capacity_out=capacity_out.get("link2a", -1))
+        W.addLink("link2b", "mid2", "dest", 1000, link2b_speed, 0.2, 1, capacity_out=capacity_out.get("link2b", -1))
+    W.adddemand("orig", "dest", *demand)
+    return W
+
 ####################################################
 ## MARK: Analyzer
 
@@ -63,11 +90,9 @@ def test_analyzer():
 
 def test_garbage_collection_and_pointer():
     """
-    Strange behavior possibly due to raw pointer in C++ code and garbage collection of Python
+    A Link keeps its World alive, so links stay valid after the Worlds go out of scope.
 
-    If `Ws.append(W)` is active, the last print sentences work as intended.
-    If it is commented out, they work strangely.
-    At least it does not cause an error?
+    The Worlds are not kept in `Ws`, yet each link still refers to its own World and reports its name.
     """
 
     def create_world(demand):
@@ -110,4 +135,870 @@ def test_garbage_collection_and_pointer():
     print([type(l.W) for l in links])
     print([l.W.name for l in links])
 
-    assert True
\ No newline at end of file
+    assert [l.W.name for l in links] == [f"basic{demand}" for demand in [0, 0.3, 0.6, 0.8]]
+
+def test_world_teardown():
+    import gc, weakref
+
+    def create_world():
+        W = newWorld("teardown", tmax=1200, deltan=5, print_mode=0, random_seed=42)
+        W.addNode("orig", 0, 0)
+        W.addNode("dest", 1, 0)
+        W.addLink("link", "orig", "dest", 1000, 20, 0.2, 1)
+        W.adddemand("orig", "dest", 0, 1000, 0.5)
+        W.exec_simulation()
+        return W
+
+    W = create_world()
+    W_ref = weakref.ref(W)
+    link = W.get_link("link")
+    veh = W.VEHICLES[0]
+    del W
+    gc.collect()
+    assert W_ref() is not None
+    assert link.W.name == "teardown" and veh.link is None
+
+    del link, veh
+    gc.collect()
+    assert W_ref() is None
+
+    for _ in range(50):
+        W = create_world()
+        assert W.get_link("link").cum_departure[-1] > 0
+    del W
+    gc.collect()
+
+####################################################
+## MARK: Idle fast-forward
+
+def test_idle_skip_equivalence():
+    def run(idle_skip_mode):
+        W = newWorld(
+            "test",
+            tmax=6000.0,
+            deltan=5.0,
+            tau=1.0,
+            duo_update_time=300.0,
+            duo_update_weight=0.25,
+            print_mode=1,
+            random_seed=42
+        )
+        W.idle_skip_mode = idle_skip_mode
+
+        W.addNode("orig", 0, 0)
+        W.addNode("mid1", 1, 1, signal_intervals=[40, 30])
+        W.addNode("mid2", 1, -1)
+        W.addNode("dest", 2, 0)
+
+        W.addLink("link1a", "orig", "mid1", 1000, 20, 0.2, 1, signal_group=0)
+        W.addLink("link1b", "mid1", "dest", 1000, 20, 0.2, 1)
+        W.addLink("link2a", "orig", "mid2", 1000, 10, 0.2, 1)
+        W.addLink("link2b", "mid2", "dest", 1000, 10, 0.2, 1)
+
+        W.adddemand("orig", "dest", 1200, 1500, 0.8)
+        W.adddemand("orig", "dest", 3000, 3100, 0.3)
+
+        W.exec_simulation(until_t=2000)
+        W.exec_simulation()
+        return W
+
+    W1 = run(True)
+    W2 = run(False)
+
+    for l1, l2 in zip(W1.LINKS, W2.LINKS):
+        assert l1.arrival_curve == l2.arrival_curve
+        assert l1.departure_curve == l2.departure_curve
+        assert l1.traveltime_real == l2.traveltime_real
+        assert l1.traveltime_instant == l2.traveltime_instant
+    for v1, v2 in zip(W1.VEHICLES, W2.VEHICLES):
+        assert v1.log_x == v2.log_x
+        assert v1.travel_time == v2.travel_time
+    assert W1.get_node("mid1").signal_phase == W2.get_node("mid1").signal_phase
+    assert W1.get_node("mid1").signal_t == W2.get_node("mid1").signal_t
+    assert W1.timestep == W2.timestep
+
+
+####################################################
+## MARK: Vehicle log policy
+
+def test_vehicle_log_policy():
+    def run(**kwargs):
+        W = newWorld(
+            "test",
+            tmax=3000.0,
+            deltan=5.0,
+            tau=1.0,
+            duo_update_time=300.0,
+            duo_update_weight=0.25,
+            print_mode=1,
+            random_seed=42,
+            **kwargs
+        )
+
+        W.addNode("orig", 0, 0)
+        W.addNode("mid", 1, 0)
+        W.addNode("dest", 2, 0)
+        W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+        W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1, capacity_out=0.4)
+        W.adddemand("orig", "dest", 0, 1000, 0.8)
+
+        W.exec_simulation()
+        return W
+
+    W_full = run()
+    W = run(vehicle_log_interval=4, vehicle_log_sample_ratio=0.25, vehicle_log_fields=["t", "state", "x"], vehicle_log_wait=False, vehicle_log_reserve_size=10)
+
+    assert W.vehicle_log_interval == 4
+    assert sum(veh.log_enabled for veh in W.VEHICLES) == len(W.VEHICLES)//4
+    for veh, veh_full in zip(W.VEHICLES, W_full.VEHICLES):
+        assert veh.travel_time == veh_full.travel_time
+        if not veh.log_enabled:
+            assert len(veh.log_t) == 0
+            continue
+        assert len(veh.log_link) == 0 and len(veh.log_v) == 0
+        assert len(veh.log_t) == len(veh.log_state) == len(veh.log_x)
+        assert 1 not in veh.log_state
+        assert veh.log_state[-1] == 3
+        for t, state, x in zip(veh.log_t[:-1], veh.log_state[:-1], veh.log_x[:-1]):
+            assert round(t/W.DELTAT) % 4 == 0
+            i = veh_full.log_t.index(t)
+            assert veh_full.log_state[i] == state and veh_full.log_x[i] == x
+
+    # the policy is validated and fixed once the simulation has started
+    with pytest.raises(RuntimeError):
+        W.set_vehicle_log_policy(1, 1.0, 31, True, 0)
+    for ratio in [-0.1, 1.5, float("nan")]:
+        with pytest.raises(ValueError):
+            newWorld("test", tmax=3000.0, print_mode=0, vehicle_log_sample_ratio=ratio)
+
+    # Analyzer functions that need fields not recorded raise a clear error
+    ana = Analyzer(W, show_mode=False, save_mode=False)
+    with pytest.raises(ValueError, match="link"):
+        ana.plot_time_space_trajectories(["link1"])
+    veh_id = next(veh.id for veh in W.VEHICLES if veh.log_enabled)
+    assert list(ana.df_vehicle_details(veh_id).columns) == ["id", "t", "orig", "dest", "state", "x"]
+    assert (ana.df_vehicles()["final_state"] == "end").all()
+
+
+def test_vehicle_log_compressed():
+    def run(vehicle_detailed_log, **kwargs):
+        W = newWorld(
+            "test",
+            tmax=3000.0,
+            deltan=5.0,
+            tau=1.0,
+            duo_update_time=300.0,
+            duo_update_weight=0.25,
+            print_mode=1,
+            random_seed=42,
+            vehicle_detailed_log=vehicle_detailed_log,
+            **kwargs
+        )
+
+        W.addNode("orig1", 0, 0)
+        W.addNode("orig2", 0, 2)
+        W.addNode("merge", 1, 1, signal_intervals=[30, 30])
+        W.addNode("dest", 2, 1)
+        W.addLink("link1", "orig1", "merge", 1000, 13.9, 0.2, 1, signal_group=0)
+        W.addLink("link2", "orig2", "merge", 1000, 20, 0.2, 1, signal_group=1)
+        W.addLink("link3", "merge", "dest", 1000, 20, 0.2, 1)
+        W.adddemand("orig1", "dest", 0, 1000, 0.45)
+        W.adddemand("orig2", "dest", 400, 1000, 0.6)
+
+        W.exec_simulation()
+        return W
+
+    for kwargs in [{}, {"vehicle_log_interval": 3}]:
+        W_full = run(1, **kwargs)
+        W_comp = run(2, **kwargs)
+
+        n_samples = 0
+        n_segments = 0
+        for veh_full, veh_comp in zip(W_full.VEHICLES, W_comp.VEHICLES):
+            assert veh_full.log_t == veh_comp.log_t
+            assert veh_full.log_state == veh_comp.log_state
+            assert veh_full.log_link == veh_comp.log_link
+            assert veh_full.log_x == veh_comp.log_x
+            assert veh_full.log_v == veh_comp.log_v
+            n_samples += len(veh_full.log_t)
+            n_segments += veh_comp.log_segment_count
+        if kwargs == {}:
+            assert n_segments < n_samples/2
+
+    ana = Analyzer(W_comp, show_mode=False)
+    assert ana.df_vehicle_details(0)["x"].tolist() == Analyzer(W_full, show_mode=False).df_vehicle_details(0)["x"].tolist()
+
+
+####################################################
+## MARK: Vehicle retirement
+
+def test_vehicle_retirement():
+    def run(vehicle_detailed_log, vehicle_retire_mode):
+        W = newWorld(
+            "test",
+            tmax=3000.0,
+            deltan=5.0,
+            tau=1.0,
+            duo_update_time=300.0,
+            duo_update_weight=0.25,
+            print_mode=1,
+            random_seed=42,
+            vehicle_detailed_log=vehicle_detailed_log,
+            vehicle_retire_mode=vehicle_retire_mode
+        )
+
+        W.addNode("orig1", 0, 0)
+        W.addNode("orig2", 0, 2)
+        W.addNode("merge", 1, 1)
+        W.addNode("dest", 2, 1)
+        W.addLink("link1", "orig1", "merge", 1000, 20, 0.2, 1)
+        W.addLink("link2", "orig2", "merge", 1000, 20, 0.2, 1)
+        W.addLink("link3", "merge", "dest", 1000, 20, 0.2, 1)
+        W.adddemand("orig1", "dest", 0, 2500, 0.45)
+        W.adddemand("orig2", "dest", 400, 2500, 0.6)
+
+        W.exec_simulation()
+        return W
+
+    for vehicle_detailed_log in [1, 2]:
+        W_ref = run(vehicle_detailed_log, False)
+        W = run(vehicle_detailed_log, True)
+
+        n_retired = 0
+        for veh_ref, veh in zip(W_ref.VEHICLES, W.VEHICLES):
+            assert veh.name == veh_ref.name
+            assert veh.travel_time == veh_ref.travel_time
+            assert veh.log_t == veh_ref.log_t
+            assert veh.log_state == veh_ref.log_state
+            assert veh.log_link == veh_ref.log_link
+            assert veh.log_x == veh_ref.log_x
+            assert veh.log_v == veh_ref.log_v
+            if veh.retired:
+                n_retired += 1
+                assert veh.state == 3
+                assert len(veh.route_preference) == 0
+            else:
+                assert veh.state != 3
+        assert 0 < n_retired < len(W.VEHICLES)
+
+        veh = W.VEHICLES[0]
+        assert veh.retired and W.get_vehicle(veh.name).id == veh.id
+        with pytest.raises(RuntimeError):
+            veh.name = "renamed"
+        assert veh.name == W_ref.VEHICLES[0].name
+        assert Analyzer(W, show_mode=False).df_vehicles()["final_state"][0] == "end"
+
+def test_rolling_mode():
+    def run(rolling_window_t, rolling_spill):
+        W = newWorld(
+            "test",
+            tmax=3000.0,
+            deltan=5.0,
+            tau=1.0,
+            duo_update_time=300.0,
+            duo_update_weight=0.25,
+            print_mode=1,
+            random_seed=42,
+            rolling_window_t=rolling_window_t,
+            rolling_spill=rolling_spill
+        )
+
+        W.addNode("orig1", 0, 0)
+        W.addNode("orig2", 0, 2)
+        W.addNode("merge", 1, 1)
+        W.addNode("dest", 2, 1)
+        W.addLink("link1", "orig1", "merge", 1000, 20, 0.2, 1)
+        W.addLink("link2", "orig2", "merge", 1000, 20, 0.2, 1)
+        W.addLink("link3", "merge", "dest", 1000, 20, 0.2, 1)
+        W.adddemand("orig1", "dest", 0, 2000, 0.45)
+        W.adddemand("orig2", "dest", 400, 2000, 0.6)
+
+        W.exec_simulation()
+        return W
+
+    W_ref = run(None, None)
+
+    spilled = []
+    W = run(400, spilled.append)
+
+    assert W.rolling_window == 80
+    assert [d["ts_start"] for d in spilled] == list(range(0, 600, 80))
+    assert spilled[-1]["ts_end"] == 600
+    for kind in ["arrival_curve", "departure_curve", "traveltime_real", "traveltime_instant"]:
+        series = np.concatenate([d[kind] for d in spilled], axis=1)
+        for i, l_ref in enumerate(W_ref.LINKS):
+            assert list(series[i]) == getattr(l_ref, kind)
+
+    # only the last window is kept
+    l = W.get_link("link3")
+    assert l.series_first_timestep == 600-80
+    assert l.arrival_curve == W_ref.get_link("link3").arrival_curve[-80:]
+    assert l.inflow(2800, 2900) == W_ref.get_link("link3").inflow(2800, 2900)
+    with pytest.raises(IndexError):
+        l.inflow(1000, 2000)
+
+    vehicles = {}
+    for d in spilled:
+        vehicles.update(d["vehicles"])
+    n_finished = 0
+    for veh_ref in W_ref.VEHICLES:
+        if veh_ref.state == 3:
+            n_finished += 1
+            assert vehicles[veh_ref.name]["x"] == veh_ref.log_x
+            assert vehicles[veh_ref.name]["t"] == veh_ref.log_t
+    assert len(vehicles) == n_finished > 0
+    assert W.VEHICLES[0].retired and W.VEHICLES[0].log_t == []
+
+def test_checkpoint_restore(tmp_path):
+    W_ref = _two_route_world(signal=True, bottleneck="link1b", link2b_speed=20, print_mode=1)
+    W_ref.exec_simulation()
+
+    W = _two_route_world(signal=True, bottleneck="link1b", link2b_speed=20, print_mode=1)
+    W.exec_simulation(until_t=1200)
+    fname = str(tmp_path/"checkpoint.bin")
+    W.save_checkpoint(fname)
+
+    W2 = load_checkpoint(fname)
+    assert W2.timestep == W.timestep and W2.name == "test"
+    W2.exec_simulation()
+
+    for l_ref, l in zip(W_ref.LINKS, W2.LINKS):
+        assert l.name == l_ref.name
+        assert l.arrival_curve == l_ref.arrival_curve
+        assert l.departure_curve == l_ref.departure_curve
+        assert l.traveltime_real == l_ref.traveltime_real
+    for veh_ref, veh in zip(W_ref.VEHICLES, W2.VEHICLES):
+        assert veh.name == veh_ref.name
+        assert veh.travel_time == veh_ref.travel_time
+        assert veh.log_x == veh_ref.log_x
+        assert veh.log_link == veh_ref.log_link
+
+    (tmp_path/"broken.bin").write_bytes(open(fname, "rb").read()[:1000])
+    with pytest.raises(RuntimeError):
+        load_checkpoint(str(tmp_path/"broken.bin"))
+
+    # checkpoints are native-endian; one from a machine with the other byte order is rejected clearly
+    data = bytearray(open(fname, "rb").read())
+    data[8:12] = data[8:12][::-1]
+    (tmp_path/"swapped.bin").write_bytes(bytes(data))
+    with pytest.raises(RuntimeError, match="byte order"):
+        load_checkpoint(str(tmp_path/"swapped.bin"))
+
+    # ids read from the file are checked before they are used as indexes
+    data = bytearray(open(fname, "rb").read())
+    i = data.index(b"link1a") + len("link1a")
+    data[i+4:i+8] = struct.pack("=i", 99)
+    (tmp_path/"mismatched.bin").write_bytes(bytes(data))
+    with pytest.raises(RuntimeError, match="does not match"):
+        load_checkpoint(str(tmp_path/"mismatched.bin"))
+
+def test_world_fork():
+    import gc
+
+    W_ref = _two_route_world(signal=True, bottleneck="link1b", link2b_speed=20, print_mode=1)
+    W_ref.exec_simulation()
+
+    W = _two_route_world(signal=True, bottleneck="link1b", link2b_speed=20, print_mode=1)
+    W.exec_simulation(until_t=1200)
+    branches = [W.fork() for _ in range(3)]
+    branches[2].get_link("link1a").vmax = 5
+
+    for W_branch in [W]+branches[:2]:
+        W_branch.exec_simulation()
+        for l_ref, l in zip(W_ref.LINKS, W_branch.LINKS):
+            assert l.arrival_curve == l_ref.arrival_curve
+            assert l.departure_curve == l_ref.departure_curve
+        for veh_ref, veh in zip(W_ref.VEHICLES, W_branch.VEHICLES):
+            assert veh.travel_time == veh_ref.travel_time
+            assert veh.log_x == veh_ref.log_x
+
+    W_branch = branches[2]
+    assert W_branch.get_link("link1b").W is not W.get_link("link1b").W
+    W_branch.exec_simulation()
+    assert W_branch.get_link("link1a").departure_curve != W_ref.get_link("link1a").departure_curve
+    assert W.get_link("link1a").vmax == 20
+
+    del W
+    gc.collect()
+    assert W_branch.get_vehicle(W_ref.VEHICLES[0].name).W is W_branch.get_link("link1b").W
+
+def test_threaded_and_async_simulation():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    def result(W):
+        return [l.departure_curve for l in W.LINKS], [veh.travel_time for veh in W.VEHICLES]
+
+    refs = []
+    for seed in range(4):
+        W = _two_route_world(random_seed=seed, print_mode=1)
+        W.exec_simulation()
+        refs.append(result(W))
+
+    worlds = [_two_route_world(random_seed=seed, print_mode=1) for seed in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda W: W.exec_simulation(), worlds))
+    for W, ref in zip(worlds, refs):
+        assert result(W) == ref
+
+    times = []
+    W = _two_route_world(random_seed=0, print_mode=1)
+    asyncio.run(W.exec_simulation_async(progress_interval_t=600, progress_callback=lambda W: times.append(W.time)))
+    assert len(times) == 5 and not W.check_simulation_ongoing()
+    assert result(W) == refs[0]
+
+def _ensemble_builder(random_seed, duo_update_weight=0.5, deltan=5):
+    return _two_route_world(random_seed=random_seed, duo_update_weight=duo_update_weight, deltan=deltan)
+
+def test_ensemble():
+    seeds = range(4)
+    res = run_ensemble(_ensemble_builder, {"duo_update_weight": [0.25, 0.75], "deltan": [5]}, seeds=seeds,
+                       outputs=["total_travel_time", "link_flows", "od_travel_times"], keep_runs=True)
+
+    assert len(res.cases) == 2 and len(res.runs) == 8
+    for case, stats in zip(res.cases, res.stats):
+        ttts = []
+        flows = []
+        for seed in seeds:
+            W = _ensemble_builder(seed, **case)
+            W.exec_simulation()
+            ttts.append(sum(veh.travel_time for veh in W.VEHICLES if veh.state == 3)*W.deltan)
+            flows.append([l.cum_departure[-1] for l in W.LINKS])
+        assert stats["total_travel_time"].count == 4
+        assert eq_tol(stats["total_travel_time"].mean, np.mean(ttts), rel_tol=1e-9)
+        assert eq_tol(stats["total_travel_time"].variance, np.var(ttts, ddof=1), rel_tol=1e-9, abs_tol=1e-6)
+        assert np.allclose(stats["link_flows"].mean, np.mean(flows, axis=0))
+        assert stats["od_travel_times"][("orig", "dest")].count == 4
+
+    df = res.summary()
+    assert list(df["duo_update_weight"]) == [0.25, 0.75]
+    assert "total_travel_time_mean" in df.columns and "link_flows_mean" not in df.columns
+
+    res_process = run_ensemble(_ensemble_builder, {"duo_update_weight": [0.25, 0.75]}, seeds=seeds, executor="process", max_workers=2)
+    assert res_process.stats[0]["total_travel_time"].mean == res.stats[0]["total_travel_time"].mean
+
+def test_shared_network():
+    W_ref = _two_route_world(signal=True)
+    W_ref.exec_simulation()
+    network = W_ref.network
+    assert network.link_names == ["link1a", "link1b", "link2a", "link2b"]
+
+    worlds = [_two_route_world(signal=True, network=network) for _ in range(3)]
+    for W in worlds:
+        assert W.network.node_names == network.node_names
+        assert W.get_node("mid2").signal_intervals == [60, 60]
+        W.exec_simulation()
+        for l_ref, l in zip(W_ref.LINKS, W.LINKS):
+            assert l.name == l_ref.name and l.start_node.name == l_ref.start_node.name
+            assert l.departure_curve == l_ref.departure_curve
+        for veh_ref, veh in zip(W_ref.VEHICLES, W.VEHICLES):
+            assert veh.travel_time == veh_ref.travel_time
+
+    with pytest.raises(RuntimeError):
+        worlds[0].addNode("extra", 3, 0)
+    del W_ref
+    assert worlds[0].get_link("link2b").end_node.name == "dest"
+
+def test_world_reset():
+    def result(W):
+        return ([l.arrival_curve for l in W.LINKS], [l.traveltime_real for l in W.LINKS],
+                [(veh.name, veh.travel_time, veh.log_x) for veh in W.VEHICLES])
+
+    for vehicle_retire_mode in [False, True]:
+        W = _two_route_world(signal=True, bottleneck="link1a", vehicle_retire_mode=vehicle_retire_mode)
+        W.exec_simulation()
+        res_first = result(W)
+
+        W.reset()
+        assert W.timestep == 0 and all(veh.state == 0 and not veh.retired for veh in W.VEHICLES)
+        W.exec_simulation()
+        assert result(W) == res_first
+
+        W.reset(keep_route_preference=True)
+        W.exec_simulation()
+        assert result(W) != res_first
+
+        W.reset(random_seed=1)
+        W.exec_simulation()
+        res_seed1 = result(W)
+        assert res_seed1 != res_first
+        W.reset()
+        W.exec_simulation()
+        assert result(W) == res_seed1
+
+def test_dynamic_user_equilibrium(tmp_path):
+    W = _two_route_world(bottleneck="link1a", link2a_length=2000, link2b_speed=20, demand=(0, 3000, 0.7), tmax=4000.0, duo_update_time=120.0)
+    gaps = W.solve_dynamic_user_equilibrium(max_iterations=6, gap_tolerance=0.0, print_mode=False)
+    assert len(gaps) == 6
+    assert all(0 <= gap < 1 for gap in gaps)
+    assert min(gaps[1:]) < gaps[0]
+    assert len(W.route_traveltime_profile) == len(W.get_traveltime_profile())
+
+    # the route table reproduces the next day in another world
+    fname = str(tmp_path/"route_table.bin")
+    W.save_route_table(fname)
+    W.reset(keep_route_preference=True)
+    W.exec_simulation()
+
+    W2 = _two_route_world(bottleneck="link1a", link2a_length=2000, link2b_speed=20, demand=(0, 3000, 0.7), tmax=4000.0, duo_update_time=120.0)
+    W2.load_route_table(fname)
+    assert W2.route_traveltime_profile == W.route_traveltime_profile
+    W2.exec_simulation()
+    assert [l.arrival_curve for l in W2.LINKS] == [l.arrival_curve for l in W.LINKS]
+    assert [veh.travel_time for veh in W2.VEHICLES] == [veh.travel_time for veh in W.VEHICLES]
+
+def test_async_route_search(tmp_path):
+    def result(W):
+        return [l.arrival_curve for l in W.LINKS], [veh.travel_time for veh in W.VEHICLES]
+
+    W = _two_route_world(signal=True, bottleneck="link1a", route_search_lag=30)
+    assert W.route_search_lag == 30
+    W.exec_simulation()
+    res = result(W)
+    W_sync = _two_route_world(signal=True, bottleneck="link1a", route_search_lag=0)
+    W_sync.exec_simulation()
+    assert result(W_sync) != res
+
+    # the lag is deterministic, also when a search is pending at checkpoints and forks
+    W = _two_route_world(signal=True, bottleneck="link1a", route_search_lag=30)
+    W.exec_simulation(until_t=910)
+    fname = str(tmp_path/"checkpoint.bin")
+    W.save_checkpoint(fname)
+    W_fork = W.fork()
+    W.exec_simulation()
+    W_fork.exec_simulation()
+    W_restored = load_checkpoint(fname)
+    W_restored.exec_simulation()
+    assert result(W) == result(W_fork) == result(W_restored) == res
+
+    W.reset()
+    W.exec_simulation()
+    assert result(W) == res
+
+    with pytest.raises(RuntimeError):
+        _two_route_world(signal=True, bottleneck="link1a", route_search_lag=300)
+
+def test_timing_mode():
+    W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42)
+    W.addNode("orig", 0, 0)
+    W.addNode("mid", 1, 1)
+    W.addNode("dest", 2, 0)
+    W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+    W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1)
+    W.adddemand("orig", "dest", 0, 2000, 0.5)
+    W.set_timing_mode(True, interval_t=300)
+    W.exec_simulation()
+
+    timing = W.get_timing()
+    assert timing["steps"] == 600
+    assert timing["transfers"]*W.deltan == pytest.approx(2000*0.5, abs=W.deltan)
+    assert timing["route_choices"] > 0 and timing["dijkstra_pops"] > 0
+    assert timing["total"] > 0
+    assert timing["total"] == pytest.approx(sum(timing[phase] for phase in ["link_update", "generate_signal", "transfer", "car_follow", "vehicle_update", "route_search", "route_choice", "idle_skip", "other"]))
+
+    series = W.get_timing_series()
+    assert series["t"] == [300*(i+1) for i in range(10)]
+    assert sum(series["transfers"]) == timing["transfers"]
+    assert sum(series["steps"]) == timing["steps"]
+
+    W.reset()
+    assert W.get_timing()["steps"] == 0 and W.get_timing_series()["t"] == []
+
+def test_memory_usage():
+    W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42)
+    W.addNode("orig", 0, 0)
+    W.addNode("mid", 1, 1)
+    W.addNode("dest", 2, 0)
+    W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+    W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1)
+    W.adddemand("orig", "dest", 0, 2000, 0.5)
+    W.initialize_adj_matrix()
+
+    categories = ["vehicle_objects", "vehicle_logs", "vehicle_preferences", "network_objects", "link_series", "link_samples", "route_matrices", "name_maps"]
+    mem = W.memory_usage()
+    assert mem["total"] == pytest.approx(sum(mem[key] for key in categories))
+    assert mem["vehicle_objects"] > 0 and mem["vehicle_preferences"] > 0 and mem["link_series"] > 0
+    assert mem["projected_vehicle_logs"] > mem["vehicle_logs"]
+    assert mem["projected_total"] > mem["total"]
+
+    W.exec_simulation(until_t=1000)
+    mem_mid = W.memory_usage()
+    assert mem_mid["vehicle_logs"] > 0
+    assert mem_mid["projected_total"] > mem_mid["total"]
+
+    W.exec_simulation()
+    mem_end = W.memory_usage()
+    assert mem_end["projected_total"] == mem_end["total"]
+    assert mem["projected_vehicle_logs"] == pytest.approx(mem_end["vehicle_logs"], rel=0.5)
+
+def test_network_stats():
+    stats = {}
+    for log in [1, 0]:
+        W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42, vehicle_detailed_log=log)
+        W.addNode("orig", 0, 0)
+        W.addNode("dest", 1, 0)
+        W.addLink("link", "orig", "dest", 10000, 20, 0.2, 1)
+        W.adddemand("orig", "dest", 0, 1000, 0.5)
+        W.set_stats_interval(600)
+        W.exec_simulation()
+
+        stats[log] = W.get_stats()
+        assert stats[log]["trips_completed"] == stats[log]["trips_total"] == 495
+        assert stats[log]["vehicle_km"] == pytest.approx(495*10)
+        assert stats[log]["total_delay"] == pytest.approx(0)
+        assert stats[log]["average_speed"] == pytest.approx(20, rel=0.05)
+
+        series = W.get_stats_series()
+        assert series["t"] == [600*(i+1) for i in range(5)]
+        for key in ["trips_completed", "total_travel_time", "vehicle_km"]:
+            assert sum(series[key]) == pytest.approx(stats[log][key])
+
+        W.reset()
+        assert W.get_stats()["trips_completed"] == 0 and W.get_stats_series()["t"] == []
+
+    assert stats[0] == stats[1]
+
+def test_link_state_matrices():
+    mats = {}
+    for log in [1, 0]:
+        W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42, vehicle_detailed_log=log)
+        W.addNode("orig", 0, 0)
+        W.addNode("mid", 1, 0)
+        W.addNode("dest", 2, 0)
+        W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+        W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1, capacity_out=0.4)
+        W.adddemand("orig", "dest", 0, 1000, 0.8)
+        W.exec_simulation()
+
+        mat = W.get_link_state_matrices(300)
+        mats[log] = mat
+        assert mat["from_trajectories"] == bool(log)
+        assert mat["flow"].shape == mat["density"].shape == mat["speed"].shape == mat["delay"].shape == (2, 10)
+        assert list(mat["t"]) == [300*i for i in range(10)]
+
+        # Edie's definitions: the totals over the time-space regions
+        area = np.array([link.length for link in W.LINKS])[:, None]*mat["interval"]
+        stats = W.get_stats()
+        rel = 1e-9 if log else 0.1
+        assert (mat["flow"]*area).sum() == pytest.approx(stats["vehicle_km"]*1000, rel=rel)
+        assert (mat["density"]*area).sum() == pytest.approx(stats["total_travel_time"], rel=rel)
+        assert mat["speed"][:, -1] == pytest.approx([20, 20])
+
+        df = Analyzer(W, save_mode=False, show_mode=False).df_mfd(600)
+        assert len(df) == 5
+        assert df["network_average_flow"][0] == pytest.approx(mat["flow"][:, :2].mean(), rel=1e-9)
+
+    assert mats[0]["speed"][:, :3] == pytest.approx(mats[1]["speed"][:, :3], rel=0.05)
+
+def test_detectors(tmp_path):
+    W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42, vehicle_detailed_log=0)
+    W.addNode("orig", 0, 0)
+    W.addNode("dest", 1, 0)
+    link = W.addLink("link", "orig", "dest", 1000, 20, 0.2, 1)
+    W.adddemand("orig", "dest", 0, 1000, 0.5)
+    W.addDetector("upstream", link, 0, 300)
+    W.addDetector("middle", "link", 500, 300)
+    with pytest.raises(RuntimeError):
+        W.addDetector("outside", "link", 1000, 300)
+    with pytest.raises(RuntimeError):
+        W.addDetector("middle", "link", 100, 300)
+
+    W.exec_simulation(until_t=600)
+    fname = str(tmp_path/"checkpoint.bin")
+    W.save_checkpoint(fname)
+    W.exec_simulation()
+
+    data = W.get_detector_data("middle")
+    assert data["t"] == [300*i for i in range(10)]
+    assert sum(data["count"]) == sum(W.get_detector_data("upstream")["count"]) == W.get_stats()["trips_completed"]
+    assert data["flow"][1] == pytest.approx(0.5)
+    assert data["speed"][1] == pytest.approx(20)
+    assert data["occupancy"][1] == pytest.approx(0.5*5/20)   # flow times jam spacing over speed
+    assert np.isnan(data["speed"][-1])
+
+    W2 = load_checkpoint(fname)
+    W2.exec_simulation()
+    assert W2.get_detector_data("middle")["count"] == data["count"]
+
+    df = Analyzer(W, save_mode=False, show_mode=False).df_detectors()
+    assert len(df) == 20 and set(df["link"]) == {"link"}
+
+    W.reset()
+    assert sum(W.get_detector_data("middle")["count"]) == 0
+
+def test_link_traveltime_stats():
+    tts = {}
+    for keep_samples in [True, False]:
+        W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42)
+        W.addNode("orig", 0, 0)
+        W.addNode("mid", 1, 0)
+        W.addNode("dest", 2, 0)
+        W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+        W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1, capacity_out=0.3)
+        W.adddemand("orig", "dest", 0, 1000, 0.6)
+        W.set_traveltime_stats(300, keep_samples=keep_samples)
+        W.exec_simulation()
+
+        link = W.get_link("link1")
+        stats = link.get_traveltime_stats()
+        assert stats["t"][:4] == [0, 300, 600, 900]
+        assert sum(stats["count"]) == link.traveltime_count == 595
+        tts[keep_samples] = [link.traveltime_quantile(q) for q in [0.5, 0.95]]
+        if keep_samples:
+            samples = np.array(link.traveltime_tt)
+            assert len(samples)*W.deltan == link.traveltime_count
+            assert np.average(samples) == pytest.approx(sum(np.nan_to_num(np.array(stats["average"])*stats["count"]))/sum(stats["count"]))
+            for q, tt in zip([0.5, 0.95], tts[keep_samples]):
+                assert tt == pytest.approx(np.quantile(samples, q, method="inverted_cdf"), rel=0.01)
+        else:
+            assert link.traveltime_tt == [] and link.traveltime_t == []
+
+        W.reset()
+        assert np.isnan(link.traveltime_quantile(0.5)) and link.get_traveltime_stats()["t"] == []
+
+    assert tts[True] == tts[False]
+
+def test_compressed_link_series(tmp_path):
+    results = {}
+    for mode in ["dense", "compressed", "compressed_f32"]:
+        W = newWorld("test", tmax=20000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42, link_series=mode)
+        W.addNode("orig", 0, 0)
+        W.addNode("mid", 1, 0)
+        W.addNode("dest", 2, 0)
+        W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+        W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1, capacity_out=0.3)
+        W.adddemand("orig", "dest", 0, 1000, 0.6)
+        W.adddemand("orig", "dest", 10000, 11000, 0.2)
+        W.exec_simulation(until_t=5000)
+        fname = str(tmp_path/f"checkpoint_{mode}.bin")
+        W.save_checkpoint(fname)
+        W.exec_simulation()
+
+        link = W.get_link("link2")
+        results[mode] = {
+            "stats": W.get_stats(),
+            "series": [link.cum_arrival, link.cum_departure, link.traveltime_real, link.traveltime_instant],
+            "outflow": link.outflow(500, 1500),
+            "memory": W.memory_usage()["link_series"],
+        }
+        W2 = load_checkpoint(fname)
+        W2.exec_simulation()
+        assert W2.get_link("link2").cum_departure == link.cum_departure
+
+    dense, compressed, compressed_f32 = results["dense"], results["compressed"], results["compressed_f32"]
+    assert compressed["stats"] == dense["stats"] == compressed_f32["stats"]
+    assert compressed["series"] == dense["series"]
+    assert compressed["outflow"] == dense["outflow"]
+    for a, b in zip(compressed_f32["series"], dense["series"]):
+        assert a == pytest.approx(b, rel=1e-6)
+    assert compressed["memory"] < dense["memory"]/10
+    assert compressed_f32["memory"] < compressed["memory"]
+
+    W = newWorld("test", tmax=3000.0, print_mode=0, link_series="compressed")
+    with pytest.raises(RuntimeError):
+        W.set_rolling_mode(600)
+    with pytest.raises(ValueError):
+        newWorld("test", link_series="sparse")
+
+def test_query_links():
+    W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42)
+    W.addNode("orig", 0, 0)
+    W.addNode("mid", 1, 0)
+    W.addNode("dest", 2, 0)
+    W.addLink("link1", "orig", "mid", 1000, 20, 0.2, 1)
+    W.addLink("link2", "mid", "dest", 1000, 20, 0.2, 1, capacity_out=0.3)
+    W.adddemand("orig", "dest", 0, 1000, 0.6)
+    W.exec_simulation()
+
+    rng = np.random.default_rng(0)
+    link_ids = rng.integers(0, 2, 1000)
+    t1 = rng.integers(0, 500, 1000)*W.DELTAT
+    t2 = t1 + rng.integers(1, 100, 1000)*W.DELTAT
+    res = W.query_links(link_ids, t1, t2)
+    for i in range(0, 1000, 50):
+        link = W.LINKS[link_ids[i]]
+        ts1, ts2 = int(t1[i]/W.DELTAT), int(t2[i]/W.DELTAT)
+        assert res["inflow"][i] == pytest.approx(link.inflow(t1[i], t2[i]))
+        assert res["outflow"][i] == pytest.approx(link.outflow(t1[i], t2[i]))
+        assert res["traveltime"][i] == pytest.approx(np.mean(link.traveltime_real[ts1:ts2]))
+        assert res["vehicles"][i] == pytest.approx(np.mean(np.array(link.cum_arrival[ts1:ts2]) - np.array(link.cum_departure[ts1:ts2])))
+
+    # names and instances, broadcasting, and invalid windows
+    res = W.query_links([["link1", W.get_link("link2")]], 0, [[600, 3000]])
+    assert res["inflow"].shape == (1, 2)
+    assert res["inflow"][0, 0] == pytest.approx(W.get_link("link1").inflow(0, 600))
+    assert np.isnan(res["inflow"][0, 1])
+    with pytest.raises(IndexError):
+        W.query_links([5], 0, 600)
+
+def test_query_routes():
+    W = newWorld("test", tmax=3000.0, deltan=5.0, tau=1.0, duo_update_time=300.0, print_mode=0, random_seed=42)
+    W.addNode("orig", 0, 0)
+    W.addNode("a", 1, 1)
+    W.addNode("b", 1, -1)
+    W.addNode("dest", 2, 0)
+    W.addNode("island", 3, 0)
+    W.addLink("link1a", "orig", "a", 1000, 20, 0.2, 1, capacity_out=0.3)
+    W.addLink("linka2", "a", "dest", 1000, 20, 0.2, 1)
+    W.addLink("link1b", "orig", "b", 1500, 20, 0.2, 1)
+    W.addLink("linkb2", "b", "dest", 1500, 20, 0.2, 1)
+    W.adddemand("orig", "dest", 0, 1000, 0.8)
+    W.exec_simulation()
+
+    # reference: the better of the two paths by chaining entry travel times
+    def path_tt(names, t):
+        t0 = t
+        for name in names:
+            t += W.get_link(name).entry_traveltime(t)
+        return t - t0
+    deps = np.arange(0, 3000, 50.0)
+    res = W.query_routes("orig", "dest", deps, return_paths=True)
+    for i, t in enumerate(deps):
+        tts = {("link1a", "linka2"): path_tt(["link1a", "linka2"], t), ("link1b", "linkb2"): path_tt(["link1b", "linkb2"], t)}
+        assert res["traveltime"][i] == pytest.approx(min(tts.values()))
+        assert res["traveltime"][i] == pytest.approx(tts[tuple(res["paths"][i])])
+    assert res["traveltime"][0] == pytest.approx(100)
+    assert res["traveltime"].max() > 150    # both paths congested at some time
+
+    # landmarks and threads do not change the results; unreachable destinations give NaN
+    origs = np.random.default_rng(0).integers(0, 4, 500)
+    res_alt = W.query_routes(origs, "dest", 600, landmarks=4, n_threads=4)
+    res_plain = W.query_routes(origs, "dest", 600, landmarks=0, n_threads=1)
+    assert np.array_equal(res_alt["traveltime"], res_plain["traveltime"])
+    assert np.isnan(W.query_routes(["orig", "island"], ["island", "dest"], 0)["traveltime"]).all()
+    with pytest.raises(IndexError):
+        W.query_routes([9], [0], 0)
+    with pytest.raises(IndexError):
+        W.freeflow_distances(10**6)
+
+def test_save_load_results(tmp_path):
+    W = _two_route_world(bottleneck="link1a", demand=(0, 1000, 0.6))
+    W.addDetector("det1", "link1b", 500, 300)
+    W.exec_simulation()
+
+    W.save_results(str(tmp_path/"res"))
+    R = load_results(str(tmp_path/"res"))
+    assert isinstance(R.LINKS[0].cum_arrival, np.memmap)
+    assert len(R.VEHICLES) == len(W.VEHICLES)
+    assert R.get_vehicle(W.VEHICLES[3].name).id == 3
+
+    # Analyzer gives the same results without the simulator
+    ana_w = Analyzer(W, show_mode=False, save_mode=False)
+    ana_r = Analyzer(R, show_mode=False, save_mode=False)
+    pd.testing.assert_frame_equal(ana_w.df_vehicles(), ana_r.df_vehicles(), check_dtype=False)
+    pd.testing.assert_frame_equal(ana_w.df_vehicle_details(3), ana_r.df_vehicle_details(3), check_dtype=False)
+    pd.testing.assert_frame_equal(ana_w.df_link_details("link1a"), ana_r.df_link_details("link1a"), check_dtype=False)
+    pd.testing.assert_frame_equal(ana_w.df_detectors(), ana_r.df_detectors(), check_dtype=False)
+    pd.testing.assert_frame_equal(ana_w.df_links(), ana_r.df_links(), check_dtype=False, rtol=0.02)
+    assert R.get_link("link1a").inflow(0, 600) == pytest.approx(W.get_link("link1a").inflow(0, 600))
+
+    # the state matrices are computed from the cumulative curves as the simulator without trajectories
+    W_nolog = _two_route_world(bottleneck="link1a", demand=(0, 1000, 0.6), vehicle_detailed_log=0)
+    W_nolog.exec_simulation()
+    W_nolog.save_results(str(tmp_path/"res_nolog"))
+    mat_w = W_nolog.get_link_state_matrices(300)
+    mat_r = load_results(str(tmp_path/"res_nolog")).get_link_state_matrices(300)
+    assert not mat_w["from_trajectories"] and not mat_r["from_trajectories"]
+    for key in ["flow", "density", "speed", "delay"]:
+        assert np.allclose(mat_w[key], mat_r[key])
+    assert load_results(str(tmp_path/"res_nolog")).VEHICLES[0].log_x.size == 0
@@ -56,9 +56,22 @@ dict_VehicleState = {
     3: "end",
 }
 
+# C++ の VehicleLogField と同じビット
+VEHICLE_LOG_FIELDS = {
+    "t": 1,
+    "state": 2,
+    "link": 4,
+    "x": 8,
+    "v": 16,
+}
+
 class Analyzer:
     """
     Class for analyzing and visualizing a simulation result.
+
+    Some functions need the vehicle log fields set by `vehicle_log_fields` of `newWorld`, and raise ValueError if they are not recorded:
+    `plot_time_space_trajectories` needs "t", "link" and "x", `network_fancy` needs all fields, and `df_vehicle_details` needs "t" and omits the columns of the other missing fields.
+    `network`, `network_anim`, `df_vehicles`, `df_links`, `df_link_details`, `df_detectors` and `df_mfd` do not use the vehicle logs.
     """
 
     def __init__(s, W, save_mode=True, show_mode=True, ax_return_mode=False):
@@ -68,7 +81,7 @@ class Analyzer:
         Parameters
         ----------
         W : object
-            The world to which this belongs.
+            The world to which this belongs, or `Results` loaded by `load_results`.
         """
         s.W = W
 
@@ -89,13 +102,25 @@ class Analyzer:
         #フラグ
         s.flag_compute_accurate_trajectories = False
 
+    def _recorded_log_fields(s):
+        fields = getattr(s.W, "vehicle_log_fields", sum(VEHICLE_LOG_FIELDS.values()))
+        return [name for name, bit in VEHICLE_LOG_FIELDS.items() if fields & bit]
+
+    def _check_log_fields(s, func_name, fields):
+        #ログに記録されていないフィールドを使う解析は分かりやすいエラーにする
+        missing = [f for f in fields if f not in s._recorded_log_fields()]
+        if missing:
+            raise ValueError(f"`{func_name}` needs the vehicle log fields {missing}, which are not recorded. Add them to `vehicle_log_fields` of `newWorld`.")
+
     def _compute_accurate_trajectories(s):         
+        s._check_log_fields("plot_time_space_trajectories", ["t", "link", "x"])
         if not s.flag_compute_accurate_trajectories:  
             for veh in s.W.VEHICLES:
                 l_old = None
-                for i in lange(veh.log_t):
-                    if veh.log_link[i] != -1:
-                        l = s.W.LINKS[veh.log_link[i]]
+                log_t, log_link, log_x = veh.log_t, veh.log_link, veh.log_x
+                for i in lange(log_t):
+                    if log_link[i] != -1:
+                        l = s.W.LINKS[log_link[i]]
                         if l_old != l:
                             s.tss[l].append([])
                             s.xss[l].append([])
@@ -104,8 +129,8 @@ class Analyzer:
                             s.names[l].append(veh.name)
 
                         l_old = l
-                        s.tss[l][-1].append(veh.log_t[i])
-                        s.xss[l][-1].append(veh.log_x[i])
+                        s.tss[l][-1].append(log_t[i])
+                        s.xss[l][-1].append(log_x[i])
 
             for l in s.W.LINKS:
                 #端部を外挿
@@ -436,6 +461,7 @@ class Analyzer:
 
         Temporary images used to create the animation are removed after the animation is generated.
         """
+        s._check_log_fields("network_fancy", list(VEHICLE_LOG_FIELDS.keys()))
         print(" generating animation...")
 
         # ベジエ補間
@@ -457,20 +483,21 @@ class Analyzer:
             vs = []
             dx = (random.random()-0.5)*dcoef
             dy = (random.random()-0.5)*dcoef
-            for i in range(0, len(veh.log_t), interval):
-                if veh.log_state[i] in ["run", 2]:
-                    link = s.W.LINKS[veh.log_link[i]]
+            log_t, log_state, log_link, log_x, log_v = veh.log_t, veh.log_state, veh.log_link, veh.log_x, veh.log_v
+            for i in range(0, len(log_t), interval):
+                if log_state[i] in ["run", 2]:
+                    link = s.W.LINKS[log_link[i]]
                     x0 = link.start_node.x+dx
                     y0 = link.start_node.y+dy
                     x1 = link.end_node.x+dx
                     y1 = link.end_node.y+dy
-                    alpha = veh.log_x[i]/link.length
-                    ts.append(veh.log_t[i])
+                    alpha = log_x[i]/link.length
+                    ts.append(log_t[i])
                     xs.append(x0*(1-alpha)+x1*alpha)
                     ys.append(y0*(1-alpha)+y1*alpha)
-            for i in range(0, len(veh.log_t)):
-                if veh.log_state[i] in ["run", 2]:
-                    vs.append(veh.log_v[i]/s.W.LINKS[veh.log_link[i]].u)
+            for i in range(0, len(log_t)):
+                if log_state[i] in ["run", 2]:
+                    vs.append(log_v[i]/s.W.LINKS[log_link[i]].u)
             if len(ts) <= interval:
                 continue
 
@@ -583,17 +610,25 @@ class Analyzer:
         return pics[int(len(pics)/2)]
 
     def df_vehicle_details(s, idx):
+        s._check_log_fields("df_vehicle_details", ["t"])
+        recorded = s._recorded_log_fields()
         veh = s.W.VEHICLES[idx]
-        df = pd.DataFrame({
-            "id": [veh.id for _ in veh.log_t],
-            "t": veh.log_t,
-            "orig": [veh.orig.name for _ in veh.log_t],
-            "dest": [veh.dest.name for _ in veh.log_t],
-            "state": [dict_VehicleState[elem] for elem in veh.log_state],
-            "link": [s.W.LINKS[elem].name if elem != -1 else "-1" for elem in veh.log_link],
-            "x": veh.log_x,
-            "v": veh.log_v,
-        })
+        log_t = veh.log_t
+        columns = {
+            "id": [veh.id for _ in log_t],
+            "t": log_t,
+            "orig": [veh.orig.name for _ in log_t],
+            "dest": [veh.dest.name for _ in log_t],
+        }
+        if "state" in recorded:
+            columns["state"] = [dict_VehicleState[elem] for elem in veh.log_state]
+        if "link" in recorded:
+            columns["link"] = [s.W.LINKS[elem].name if elem != -1 else "-1" for elem in veh.log_link]
+        if "x" in recorded:
+            columns["x"] = veh.log_x
+        if "v" in recorded:
+            columns["v"] = veh.log_v
+        df = pd.DataFrame(columns)
 
         return df
 
@@ -602,7 +637,7 @@ class Analyzer:
             "id": [veh.id for veh in s.W.VEHICLES],
             "orig": [veh.orig.name for veh in s.W.VEHICLES],
             "dest": [veh.dest.name for veh in s.W.VEHICLES],
-            "final_state": [dict_VehicleState[veh.log_state[-1]] for veh in s.W.VEHICLES],
+            "final_state": [dict_VehicleState[veh.state] for veh in s.W.VEHICLES],
             "departure_time": [veh.departure_time for veh in s.W.VEHICLES],
             "arrival_time": [veh.arrival_time for veh in s.W.VEHICLES],
             "travel_time": [veh.arrival_time-veh.departure_time if veh.arrival_time>0 else -1 for veh in s.W.VEHICLES],
@@ -618,12 +653,15 @@ class Analyzer:
         else:
             link = s.W.LINKS[int(link)]
 
+        arrival_curve = link.arrival_curve
+        departure_curve = link.departure_curve
+        ts_first = link.series_first_timestep
         df = pd.DataFrame({
-            "name": [link.name for _ in range(len(link.arrival_curve))],
-            "t": [t*s.W.DELTAT for t in range(len(link.arrival_curve))],
-            "cumulative_arrivals": link.arrival_curve,
-            "cumulative_departures": link.departure_curve,
-            "number_of_vehicles": np.array(link.arrival_curve)-np.array(link.departure_curve),
+            "name": [link.name for _ in range(len(arrival_curve))],
+            "t": [(ts_first+t)*s.W.DELTAT for t in range(len(arrival_curve))],
+            "cumulative_arrivals": arrival_curve,
+            "cumulative_departures": departure_curve,
+            "number_of_vehicles": np.array(arrival_curve)-np.array(departure_curve),
             "average_speed": link.length/np.array(link.traveltime_instant),
             "travel_time": link.traveltime_real,
         })
@@ -641,6 +679,55 @@ class Analyzer:
             "free_travel_time": [link.length/link.u for link in s.W.LINKS],
             "average_travel_time": [np.average(link.traveltime_real) for link in s.W.LINKS],
             "stddiv_travel_time": [np.std(link.traveltime_real) for link in s.W.LINKS],
+            "p50_travel_time": [link.traveltime_quantile(0.5) for link in s.W.LINKS],
+            "p95_travel_time": [link.traveltime_quantile(0.95) for link in s.W.LINKS],
+        })
+
+        return df
+
+    def df_detectors(s):
+        """
+        Get the values recorded by the detectors in the same format as field sensors.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per detector and interval with "detector", "link", "x", "t" (the start time of the interval), "count" (veh), "flow" (veh/s), "speed" (the time-mean speed) and "occupancy".
+        """
+        dfs = []
+        for det in s.W.DETECTORS:
+            data = s.W.get_detector_data(det.name)
+            df = pd.DataFrame({"detector": det.name, "link": s.W.LINKS[det.link].name, "x": det.x, **data})
+            dfs.append(df[["detector", "link", "x", "t", "count", "flow", "speed", "occupancy"]])
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=["detector", "link", "x", "t", "count", "flow", "speed", "occupancy"])
+        return pd.concat(dfs, ignore_index=True)
+
+    def df_mfd(s, interval=300):
+        """
+        Compute the network-wide average density, flow and speed in each time bin, i.e., the macroscopic fundamental diagram, from the link state matrices of `World.get_link_state_matrices`.
+
+        Parameters
+        ----------
+        interval : float, optional
+            The length of a time bin in seconds, default is 300.
+
+        Returns
+        -------
+        pd.DataFrame
+            "t" (the start time of each bin), "network_average_density" (veh/m), "network_average_flow" (veh/s) and "network_average_speed" (m/s, NaN if no vehicle is present).
+        """
+        mat = s.W.get_link_state_matrices(interval)
+        lengths = np.array([link.length for link in s.W.LINKS])
+        density = lengths @ mat["density"] / lengths.sum()
+        flow = lengths @ mat["flow"] / lengths.sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speed = np.where(density > 0, flow/density, np.nan)
+        df = pd.DataFrame({
+            "t": mat["t"],
+            "network_average_density": density,
+            "network_average_flow": flow,
+            "network_average_speed": speed,
         })
 
         return df
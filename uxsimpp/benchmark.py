@@ -0,0 +1,299 @@
+"""
+Benchmark suite of grid network scenarios.
+
+Each scenario is run in a fresh process, and its build time, simulation time, analysis time and peak memory are measured and compared with stored baselines.
+Run `python -m uxsimpp.benchmark --help` for the command line usage.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+
+#: Default parameters of the benchmark scenarios.
+DEFAULT_PARAMS = {
+    "grid": 10,         # number of nodes per side of the grid
+    "demand": 0.5,      # flow from each boundary node in veh/s
+    "deltan": 5,
+    "signal": False,
+    "logging": True,
+    "tmax": 4000,
+}
+
+#: Grid sizes of the scaling benchmark.
+GRID_SIZES = [5, 10, 20, 50, 100]
+
+
+def scenario_name(params):
+    """
+    Get the name of a scenario used as the key of baselines.
+
+    Parameters
+    ----------
+    params : dict
+        The scenario parameters. Missing ones are taken from `DEFAULT_PARAMS`.
+
+    Returns
+    -------
+    str
+    """
+    p = {**DEFAULT_PARAMS, **params}
+    return f"grid{p['grid']}_demand{p['demand']}_deltan{p['deltan']}_signal{int(p['signal'])}_log{int(p['logging'])}_tmax{p['tmax']}"
+
+
+def benchmark_scenarios(max_grid=100):
+    """
+    Get the parameters of the benchmark scenarios.
+
+    They consist of the grid sizes up to `max_grid` with the default parameters, and variations of demand level, `deltan`, signals and logging on the default grid.
+
+    Parameters
+    ----------
+    max_grid : int, optional
+        The maximum grid size, default is 100.
+
+    Returns
+    -------
+    list of dict
+    """
+    scenarios = [{"grid": n} for n in GRID_SIZES if n <= max_grid]
+    if DEFAULT_PARAMS["grid"] <= max_grid:
+        scenarios += [{"demand": d} for d in [0.25, 1.0]]
+        scenarios += [{"deltan": d} for d in [1, 10]]
+        scenarios += [{"signal": True}, {"logging": False}]
+    return scenarios
+
+
+def build_grid_scenario(grid=10, demand=0.5, deltan=5, signal=False, logging=True, tmax=4000, random_seed=0):
+    """
+    Build a grid network scenario in which vehicles travel from each boundary node to the nodes on the opposite side.
+
+    Parameters
+    ----------
+    grid : int, optional
+        The number of nodes per side, default is 10.
+    demand : float, optional
+        The flow from each boundary node in veh/s, default is 0.5. It is split equally to the destinations and generated in the first half of the simulation.
+    deltan : int, optional
+        The platoon size, default is 5.
+    signal : bool, optional
+        Whether nodes have signals, default is False. Horizontal and vertical links get green alternately for 30 s.
+    logging : bool, optional
+        Whether save vehicle data, default is True.
+    tmax : float, optional
+        The simulation duration, default is 4000 s.
+    random_seed : int, optional
+        The random seed, default is 0.
+
+    Returns
+    -------
+    World
+        The world before simulation.
+    """
+    from .uxsimpp import newWorld
+
+    W = newWorld(f"bench_grid{grid}", tmax=tmax, deltan=deltan, tau=1, duo_update_time=300, duo_update_weight=0.5,
+                 print_mode=0, random_seed=random_seed, vehicle_detailed_log=int(logging))
+
+    signal_intervals = [30, 30] if signal else [0]
+    for i in range(grid):
+        for j in range(grid):
+            W.addNode(f"n{i}-{j}", i, j, signal_intervals=signal_intervals)
+    for i in range(grid):
+        for j in range(grid):
+            for di, dj, group in [(1, 0, 0), (-1, 0, 0), (0, 1, 1), (0, -1, 1)]:
+                if 0 <= i+di < grid and 0 <= j+dj < grid:
+                    W.addLink(f"l{i}-{j}-{i+di}-{j+dj}", f"n{i}-{j}", f"n{i+di}-{j+dj}", 1000, 20, 0.2, 1,
+                              signal_group=[group] if signal else [0])
+
+    flow = demand/grid
+    for i in range(grid):
+        for j in range(grid):
+            W.adddemand(f"n0-{i}", f"n{grid-1}-{j}", 0, tmax/2, flow)
+            W.adddemand(f"n{grid-1}-{i}", f"n0-{j}", 0, tmax/2, flow)
+            W.adddemand(f"n{i}-0", f"n{j}-{grid-1}", 0, tmax/2, flow)
+            W.adddemand(f"n{i}-{grid-1}", f"n{j}-0", 0, tmax/2, flow)
+    return W
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024     # bytes on macOS, KiB on Linux
+
+
+def run_benchmark(params):
+    """
+    Run a benchmark scenario in the current process.
+
+    Parameters
+    ----------
+    params : dict
+        The scenario parameters for `build_grid_scenario`. Missing ones are taken from `DEFAULT_PARAMS`.
+
+    Returns
+    -------
+    dict
+        "build_time", "simulation_time" and "analysis_time" in seconds, "peak_rss" (the peak resident set size of the process in bytes, None if unavailable), "platoons", and "trips_completed" in veh.
+    """
+    from .uxsimpp import Analyzer
+
+    p = {**DEFAULT_PARAMS, **params}
+    t0 = time.perf_counter()
+    W = build_grid_scenario(**p)
+    t1 = time.perf_counter()
+    W.exec_simulation()
+    t2 = time.perf_counter()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Analyzer creates an output directory in the working directory
+        os.chdir(tmpdir)
+        try:
+            ana = Analyzer(W, save_mode=False, show_mode=False)
+            ana.df_links()
+            if p["logging"]:
+                ana.df_vehicles()
+        finally:
+            os.chdir(cwd)
+    t3 = time.perf_counter()
+
+    return {
+        "build_time": t1-t0,
+        "simulation_time": t2-t1,
+        "analysis_time": t3-t2,
+        "peak_rss": _peak_rss(),
+        "platoons": len(W.VEHICLES),
+        "trips_completed": sum(veh.state == 3 for veh in W.VEHICLES)*W.deltan,
+    }
+
+
+def run_benchmark_isolated(params):
+    """
+    Run a benchmark scenario in a fresh process so that its peak memory is not affected by other scenarios.
+
+    Parameters
+    ----------
+    params : dict
+        The scenario parameters.
+
+    Returns
+    -------
+    dict
+        The same as `run_benchmark`.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_benchmark, params).result()
+
+
+def load_baseline(fname):
+    """
+    Load baselines from a JSON file.
+
+    Parameters
+    ----------
+    fname : str
+        The file name.
+
+    Returns
+    -------
+    dict
+        A dict from scenario names to results. Empty if the file does not exist.
+    """
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_baseline(fname, results):
+    """
+    Save results as baselines to a JSON file. Existing baselines of other scenarios are kept.
+
+    Parameters
+    ----------
+    fname : str
+        The file name.
+    results : dict
+        A dict from scenario names to results.
+    """
+    baseline = load_baseline(fname)
+    baseline.update(results)
+    with open(fname, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare_with_baseline(result, baseline, time_tolerance=2.0, time_slack=0.05, memory_tolerance=1.5, memory_slack=32*2**20):
+    """
+    Compare a result with its baseline.
+
+    Parameters
+    ----------
+    result : dict
+        The result of `run_benchmark`.
+    baseline : dict
+        The baseline result of the same scenario.
+    time_tolerance : float, optional
+        The allowed ratio of each time to the baseline, default is 2.0.
+    time_slack : float, optional
+        The allowed absolute increase of each time in seconds on top of the ratio, default is 0.05. It absorbs the noise of short scenarios.
+    memory_tolerance : float, optional
+        The allowed ratio of the peak memory to the baseline, default is 1.5.
+    memory_slack : int, optional
+        The allowed absolute increase of the peak memory in bytes on top of the ratio, default is 32 MiB.
+
+    Returns
+    -------
+    list of str
+        The descriptions of the regressions. Empty if there is none.
+    """
+    regressions = []
+    for key in ["build_time", "simulation_time", "analysis_time"]:
+        if key in baseline and result[key] > baseline[key]*time_tolerance + time_slack:
+            regressions.append(f"{key}: {result[key]:.3f} s > baseline {baseline[key]:.3f} s")
+    if result.get("peak_rss") is not None and baseline.get("peak_rss") is not None:
+        if result["peak_rss"] > baseline["peak_rss"]*memory_tolerance + memory_slack:
+            regressions.append(f"peak_rss: {result['peak_rss']/2**20:.1f} MiB > baseline {baseline['peak_rss']/2**20:.1f} MiB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the UXsim++ benchmark suite.")
+    parser.add_argument("--max-grid", type=int, default=20, help="the maximum grid size (default: 20). Grids larger than 50x50 need several GB of memory.")
+    parser.add_argument("--baseline", default=os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "tests", "benchmark_baseline.json")), help="the baseline JSON file")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baselines")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    failed = False
+    for params in benchmark_scenarios(args.max_grid):
+        name = scenario_name(params)
+        res = run_benchmark_isolated(params)
+        results[name] = res
+        rss = f"{res['peak_rss']/2**20:.1f} MiB" if res["peak_rss"] is not None else "-"
+        print(f"{name}: build {res['build_time']:.3f} s, simulation {res['simulation_time']:.3f} s, analysis {res['analysis_time']:.3f} s, peak RSS {rss}")
+        if name in baseline:
+            for msg in compare_with_baseline(res, baseline[name]):
+                print(f"    REGRESSION {msg}")
+                failed = True
+
+    if args.update:
+        save_baseline(args.baseline, results)
+        print(f"baselines saved to {args.baseline}")
+    return 1 if failed and not args.update else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""
+Ensemble runner for random seeds and parameter sweeps.
+"""
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+class RunningStats:
+    """
+    Streaming mean and variance of scalars or arrays by Welford's algorithm.
+
+    Attributes
+    ----------
+    count : int
+        The number of added samples.
+    """
+    def __init__(s):
+        s.count = 0
+        s._mean = None
+        s._m2 = None
+
+    def add(s, x):
+        """
+        Add a sample.
+
+        Parameters
+        ----------
+        x : float or array-like
+            The sample. All samples must have the same shape.
+        """
+        x = np.asarray(x, dtype=float)
+        s.count += 1
+        if s.count == 1:
+            s._mean = x.copy()
+            s._m2 = np.zeros_like(x)
+        else:
+            delta = x - s._mean
+            s._mean = s._mean + delta/s.count
+            s._m2 = s._m2 + delta*(x - s._mean)
+
+    @staticmethod
+    def _ret(x):
+        return float(x) if np.ndim(x) == 0 else x
+
+    @property
+    def mean(s):
+        """The mean of the samples."""
+        if s.count == 0:
+            return np.nan
+        return s._ret(s._mean)
+
+    @property
+    def variance(s):
+        """The unbiased variance of the samples. NaN if less than 2 samples."""
+        if s.count < 2:
+            return np.nan if s.count == 0 else s._ret(np.full_like(s._m2, np.nan))
+        return s._ret(s._m2/(s.count-1))
+
+    @property
+    def std(s):
+        """The unbiased standard deviation of the samples."""
+        return s._ret(np.sqrt(s.variance))
+
+    def __repr__(s):
+        return f"RunningStats(count={s.count}, mean={s.mean}, std={s.std})"
+
+
+def _completed_vehicles(W):
+    return [veh for veh in W.VEHICLES if veh.state == 3]
+
+def _total_travel_time(W):
+    return sum(veh.travel_time for veh in _completed_vehicles(W))*W.deltan
+
+def _average_travel_time(W):
+    tts = [veh.travel_time for veh in _completed_vehicles(W)]
+    return np.average(tts) if len(tts) else np.nan
+
+def _trips_completed(W):
+    return len(_completed_vehicles(W))*W.deltan
+
+def _link_flows(W):
+    return np.array([l.cum_departure[-1] for l in W.LINKS])
+
+def _od_travel_times(W):
+    tts = {}
+    for veh in _completed_vehicles(W):
+        tts.setdefault((veh.orig.name, veh.dest.name), []).append(veh.travel_time)
+    return {od: np.average(tt) for od, tt in tts.items()}
+
+#: Summary outputs available by name in `run_ensemble`. Each function takes a simulated World.
+ENSEMBLE_OUTPUTS = {
+    "total_travel_time": _total_travel_time,    # total travel time of completed trips in veh*s
+    "average_travel_time": _average_travel_time,
+    "trips_completed": _trips_completed,        # in veh
+    "link_flows": _link_flows,                  # traffic volume of each link in veh, in the order of W.LINKS
+    "od_travel_times": _od_travel_times,        # dict from (orig name, dest name) to average travel time
+}
+
+
+def _run_case(builder, params, seed, outputs):
+    W = builder(random_seed=seed, **params)
+    W.exec_simulation()
+    ret = {}
+    for name in outputs:
+        func = outputs[name] if callable(outputs[name]) else ENSEMBLE_OUTPUTS[outputs[name]]
+        ret[name] = func(W)
+    return ret
+
+
+class EnsembleResult:
+    """
+    Aggregated results of an ensemble run.
+
+    Attributes
+    ----------
+    cases : list of dict
+        The parameters of each case, i.e., each point of the parameter grid.
+    stats : list of dict
+        The statistics of each case. `stats[i][name]` is a RunningStats of the output `name` over seeds, or a dict of RunningStats if the output is a dict.
+    runs : list of tuple
+        The (params, seed, outputs) of every run. Empty unless `keep_runs` is True.
+    """
+    def __init__(s, cases, outputs):
+        s.cases = cases
+        s.outputs = list(outputs)
+        s.stats = [{name: None for name in s.outputs} for _ in cases]
+        s.runs = []
+
+    def _add(s, case_index, values):
+        stats = s.stats[case_index]
+        for name, value in values.items():
+            if isinstance(value, dict):
+                if stats[name] is None:
+                    stats[name] = {}
+                for key, v in value.items():
+                    stats[name].setdefault(key, RunningStats()).add(v)
+            else:
+                if stats[name] is None:
+                    stats[name] = RunningStats()
+                stats[name].add(value)
+
+    def summary(s):
+        """
+        Summarize scalar outputs as a DataFrame.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per case with the parameters, the number of runs, and the mean and standard deviation of each scalar output.
+        """
+        rows = []
+        for params, stats in zip(s.cases, s.stats):
+            row = dict(params)
+            for name in s.outputs:
+                st = stats[name]
+                if isinstance(st, RunningStats) and np.ndim(st.mean) == 0:
+                    row["n"] = st.count
+                    row[name+"_mean"] = st.mean
+                    row[name+"_std"] = st.std
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def run_ensemble(builder, param_grid=None, seeds=(0,), outputs=("total_travel_time",), executor="thread", max_workers=None, keep_runs=False):
+    """
+    Run a scenario for every combination of parameters and random seeds concurrently and aggregate summary outputs.
+
+    Only the requested outputs of each run are kept, and each World is released after its outputs are computed.
+
+    Parameters
+    ----------
+    builder : callable
+        The function that builds a World (before simulation) as `builder(random_seed=seed, **params)`. It must be picklable if `executor` is "process".
+    param_grid : dict or None, optional
+        A dict from parameter names to lists of values, default is None. Every combination of the values is run.
+    seeds : list of int, optional
+        The random seeds, default is (0,). Every case is run with every seed.
+    outputs : list of str or dict, optional
+        The outputs to be computed, default is ("total_travel_time",). Names in `ENSEMBLE_OUTPUTS`, or a dict from output names to names in `ENSEMBLE_OUTPUTS` or functions taking a simulated World. An output can be a scalar, an array, or a dict of scalars.
+    executor : str, optional
+        "thread" (default) or "process". Threads run in parallel because the simulation releases the GIL.
+    max_workers : int or None, optional
+        The maximum number of workers, default is None (determined by the executor).
+    keep_runs : bool, optional
+        Whether keep the outputs of every run in `EnsembleResult.runs`, default is False.
+
+    Returns
+    -------
+    EnsembleResult
+        The statistics over seeds for each case. The aggregation order is deterministic regardless of the completion order.
+
+    Examples
+    --------
+    >>> def builder(random_seed, duo_update_weight=0.5):
+    ...     W = newWorld("ensemble", tmax=3600, duo_update_weight=duo_update_weight, print_mode=0, random_seed=random_seed)
+    ...     ... # define network and demand
+    ...     return W
+    >>> res = run_ensemble(builder, {"duo_update_weight": [0.25, 0.5]}, seeds=range(10), outputs=["total_travel_time", "link_flows"])
+    >>> res.summary()
+    """
+    if param_grid is None:
+        param_grid = {}
+    names = list(param_grid.keys())
+    cases = [dict(zip(names, values)) for values in itertools.product(*[param_grid[name] for name in names])]
+    if not isinstance(outputs, dict):
+        outputs = {name: name for name in outputs}
+    for name, func in outputs.items():
+        if not callable(func) and func not in ENSEMBLE_OUTPUTS:
+            raise ValueError(f"Unknown output `{func}`. Available outputs are {list(ENSEMBLE_OUTPUTS.keys())}")
+
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    elif executor == "process":
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        raise ValueError(f"Unknown executor `{executor}`")
+
+    seeds = list(seeds)
+    tasks = [(i, seed) for i in range(len(cases)) for seed in seeds]
+    result = EnsembleResult(cases, outputs.keys())
+    with pool:
+        for (i, seed), values in zip(tasks, pool.map(_run_case, itertools.repeat(builder), [cases[i] for i, _ in tasks], [seed for _, seed in tasks], itertools.repeat(outputs))):
+            result._add(i, values)
+            if keep_runs:
+                result.runs.append((cases[i], seed, values))
+    return result
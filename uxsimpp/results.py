@@ -0,0 +1,417 @@
+"""
+Memory-mappable storage of simulation results.
+
+`save_results` writes the link time series, the columnar vehicle logs and the metadata of a simulated World to a directory of .npy files.
+`load_results` maps them back as a `Results` object, which has the attributes of World used by `Analyzer`, so that results can be analysed without the simulator.
+The arrays are memory-mapped, so loading is instant and only the accessed parts are read from the disk.
+"""
+
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+from .analyzer import VEHICLE_LOG_FIELDS
+
+
+#: Version of the results format. Incremented when the layout changes.
+RESULTS_VERSION = 1
+
+#: Link time series saved as (number of links, number of timesteps) arrays.
+RESULTS_LINK_SERIES = ["arrival_curve", "departure_curve", "traveltime_real", "traveltime_instant"]
+
+#: Vehicle log fields saved as concatenated columns with their dtypes.
+RESULTS_LOG_FIELDS = {"t": np.float64, "state": np.int32, "link": np.int32, "x": np.float64, "v": np.float64}
+
+#: Quantiles of link travel times kept from the quantile sketches.
+RESULTS_QUANTILES = np.linspace(0, 1, 101)
+
+
+def save_results(W, path):
+    """
+    Save the results of a simulated World to a directory of .npy files.
+
+    Parameters
+    ----------
+    W : World
+        The world after simulation.
+    path : str
+        The directory. It is created if it does not exist, and existing result files in it are overwritten.
+
+    Notes
+    -----
+    The directory contains "meta.json" (the scenario parameters, the network and the detector data), "link_<series>.npy" for each of `RESULTS_LINK_SERIES`, "link_traveltime_quantiles.npy", "veh_<attribute>.npy", and "log_offsets.npy" and "log_<field>.npy" for the recorded vehicle log fields.
+    The logs of the vehicle with id `i` are `log_<field>[log_offsets[i]:log_offsets[i+1]]`.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    ts_first = W.LINKS[0].series_first_timestep if len(W.LINKS) else 0
+    n_ts = len(W.LINKS[0].arrival_curve) if len(W.LINKS) else 0
+    for kind in RESULTS_LINK_SERIES:
+        np.save(os.path.join(path, f"link_{kind}.npy"), W.get_link_series_array(kind, ts_first, ts_first+n_ts))
+    np.save(os.path.join(path, "link_traveltime_quantiles.npy"),
+            np.array([[l.traveltime_quantile(q) for q in RESULTS_QUANTILES] for l in W.LINKS]).reshape(len(W.LINKS), len(RESULTS_QUANTILES)))
+
+    vehicles = W.VEHICLES
+    np.save(os.path.join(path, "veh_name.npy"), np.array([veh.name for veh in vehicles], dtype=str))
+    np.save(os.path.join(path, "veh_orig.npy"), np.array([veh.orig.id for veh in vehicles], dtype=np.int32))
+    np.save(os.path.join(path, "veh_dest.npy"), np.array([veh.dest.id for veh in vehicles], dtype=np.int32))
+    np.save(os.path.join(path, "veh_state.npy"), np.array([veh.state for veh in vehicles], dtype=np.int32))
+    np.save(os.path.join(path, "veh_departure_time.npy"), np.array([veh.departure_time for veh in vehicles], dtype=float))
+    np.save(os.path.join(path, "veh_arrival_time.npy"), np.array([veh.arrival_time for veh in vehicles], dtype=float))
+    np.save(os.path.join(path, "veh_travel_time.npy"), np.array([veh.travel_time for veh in vehicles], dtype=float))
+
+    logs = W.get_vehicle_logs()
+    log_fields = [field for field in RESULTS_LOG_FIELDS if field in logs]
+    np.save(os.path.join(path, "log_offsets.npy"), logs["offsets"])
+    for field in RESULTS_LOG_FIELDS:
+        fname = os.path.join(path, f"log_{field}.npy")
+        if field in logs:
+            np.save(fname, logs[field].astype(RESULTS_LOG_FIELDS[field], copy=False))
+        elif os.path.exists(fname):
+            os.remove(fname)
+
+    meta = {
+        "version": RESULTS_VERSION,
+        "name": W.name,
+        "tmax": W.TMAX,
+        "delta_t": W.DELTAT,
+        "delta_n": W.deltan,
+        "timestep": W.timestep,
+        "total_timesteps": W.total_timesteps,
+        "series_first_timestep": ts_first,
+        "log_fields": log_fields,
+        "nodes": [{"name": n.name, "x": n.x, "y": n.y, "signal_intervals": list(n.signal_intervals), "signal_offset": n.signal_offset}
+                  for n in W.NODES],
+        "links": [{"name": l.name, "start_node": l.start_node.id, "end_node": l.end_node.id, "length": l.length, "vmax": l.vmax,
+                   "kappa": l.kappa, "delta": l.delta, "tau": l.tau, "capacity": l.capacity, "w": l.w, "merge_priority": l.merge_priority,
+                   "capacity_out": l.capacity_out, "signal_group": list(l.signal_group), "traveltime_count": l.traveltime_count}
+                  for l in W.LINKS],
+        "detectors": [{"name": det.name, "link": det.link, "x": det.x, "data": W.get_detector_data(det.name)}
+                      for det in W.DETECTORS],
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, allow_nan=True)
+
+
+def load_results(path, mmap_mode="r"):
+    """
+    Load results saved by `save_results`.
+
+    Parameters
+    ----------
+    path : str
+        The directory.
+    mmap_mode : str or None, optional
+        The memory-map mode of `numpy.load`, default is "r". None reads the arrays into memory.
+
+    Returns
+    -------
+    Results
+
+    Examples
+    --------
+    >>> W.save_results("out_results")
+    >>> R = load_results("out_results")
+    >>> Analyzer(R).df_links()
+    """
+    return Results(path, mmap_mode)
+
+
+class ResultNode:
+    """
+    A node of loaded results. It has the same attributes as Node except for the simulation state.
+    """
+    def __init__(s, W, id, name, x, y, signal_intervals, signal_offset):
+        s.W = W
+        s.id = id
+        s.name = name
+        s.x = x
+        s.y = y
+        s.signal_intervals = signal_intervals
+        s.signal_offset = signal_offset
+
+    def __repr__(s):
+        return f"<Node `{s.name}`>"
+
+
+class ResultLink:
+    """
+    A link of loaded results. The time series are read-only NumPy arrays mapped from the files.
+    """
+    def __init__(s, W, id, name, start_node, end_node, length, vmax, kappa, delta, tau, capacity, w, merge_priority, capacity_out, signal_group, traveltime_count):
+        s.W = W
+        s.id = id
+        s.name = name
+        s.start_node = W.NODES[start_node]
+        s.end_node = W.NODES[end_node]
+        s.length = length
+        s.vmax = s.u = vmax
+        s.kappa = kappa
+        s.delta = delta
+        s.tau = tau
+        s.capacity = capacity
+        s.w = w
+        s.merge_priority = merge_priority
+        s.capacity_out = capacity_out
+        s.signal_group = signal_group
+        s.traveltime_count = traveltime_count
+        s.series_first_timestep = W.series_first_timestep
+
+    @property
+    def arrival_curve(s):
+        return s.W._link_series["arrival_curve"][s.id]
+
+    @property
+    def departure_curve(s):
+        return s.W._link_series["departure_curve"][s.id]
+
+    cum_arrival = arrival_curve
+    cum_departure = departure_curve
+
+    @property
+    def traveltime_real(s):
+        return s.W._link_series["traveltime_real"][s.id]
+
+    @property
+    def traveltime_instant(s):
+        return s.W._link_series["traveltime_instant"][s.id]
+
+    def _at(s, series, t):
+        ts = int(t/s.W.DELTAT) - s.series_first_timestep
+        if not 0 <= ts < len(series):
+            raise IndexError(f"time {t} is out of the kept link series")
+        return series[ts]
+
+    def inflow(s, t1, t2):
+        """Get the average inflow of the link between t1 and t2."""
+        return (s._at(s.arrival_curve, t2) - s._at(s.arrival_curve, t1))/(t2-t1)
+
+    def outflow(s, t1, t2):
+        """Get the average outflow of the link between t1 and t2."""
+        return (s._at(s.departure_curve, t2) - s._at(s.departure_curve, t1))/(t2-t1)
+
+    def traveltime_quantile(s, q):
+        """Get the q-quantile of the travel times, interpolated from the saved quantiles. NaN if no vehicle has traversed the link."""
+        return float(np.interp(q, RESULTS_QUANTILES, s.W._traveltime_quantiles[s.id]))
+
+    def __repr__(s):
+        return f"<Link `{s.name}`>"
+
+
+class ResultVehicle:
+    """
+    A vehicle of loaded results. The logs are read-only NumPy arrays mapped from the files, and empty for fields that were not recorded.
+    """
+    def __init__(s, W, id):
+        s.W = W
+        s.id = id
+
+    @property
+    def name(s):
+        return str(s.W._veh["name"][s.id])
+
+    @property
+    def orig(s):
+        return s.W.NODES[s.W._veh["orig"][s.id]]
+
+    @property
+    def dest(s):
+        return s.W.NODES[s.W._veh["dest"][s.id]]
+
+    @property
+    def state(s):
+        return int(s.W._veh["state"][s.id])
+
+    @property
+    def departure_time(s):
+        return float(s.W._veh["departure_time"][s.id])
+
+    @property
+    def arrival_time(s):
+        return float(s.W._veh["arrival_time"][s.id])
+
+    @property
+    def travel_time(s):
+        return float(s.W._veh["travel_time"][s.id])
+
+    def _log(s, field):
+        if field not in s.W._logs:
+            return np.empty(0, dtype=RESULTS_LOG_FIELDS[field])
+        offsets = s.W._log_offsets
+        return s.W._logs[field][offsets[s.id]:offsets[s.id+1]]
+
+    @property
+    def log_t(s):
+        return s._log("t")
+
+    @property
+    def log_state(s):
+        return s._log("state")
+
+    @property
+    def log_link(s):
+        return s._log("link")
+
+    @property
+    def log_x(s):
+        return s._log("x")
+
+    @property
+    def log_v(s):
+        return s._log("v")
+
+    def __repr__(s):
+        return f"<Vehicle `{s.name}`>"
+
+
+class ResultDetector:
+    """
+    A detector of loaded results.
+    """
+    def __init__(s, name, link, x):
+        s.name = name
+        s.link = link
+        s.x = x
+
+
+class _ResultVehicles(Sequence):
+    # ResultVehicle is created on access so that loading does not depend on the number of vehicles
+    def __init__(s, W):
+        s.W = W
+
+    def __len__(s):
+        return len(s.W._veh["state"])
+
+    def __getitem__(s, i):
+        if isinstance(i, slice):
+            return [s[j] for j in range(*i.indices(len(s)))]
+        if i < 0:
+            i += len(s)
+        if not 0 <= i < len(s):
+            raise IndexError("vehicle index out of range")
+        return ResultVehicle(s.W, i)
+
+
+class Results:
+    """
+    Simulation results loaded by `load_results`. It can be passed to `Analyzer` in place of World.
+
+    Attributes
+    ----------
+    name : str
+        The name of the world.
+    TMAX, DELTAT : float
+        The simulation duration and the timestep in s.
+    deltan : float
+        The platoon size.
+    timestep : int
+        The timestep at which the simulation was saved.
+    vehicle_log_fields : int
+        The bits of the recorded vehicle log fields in `VEHICLE_LOG_FIELDS`.
+    NODES, LINKS, VEHICLES, DETECTORS : list-like
+        The same as World. VEHICLES creates each vehicle on access.
+    """
+    def __init__(s, path, mmap_mode="r"):
+        s.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != RESULTS_VERSION:
+            raise ValueError(f"Unsupported results version {meta['version']} in {path}")
+        s.name = meta["name"]
+        s.TMAX = s.t_max = meta["tmax"]
+        s.DELTAT = s.delta_t = meta["delta_t"]
+        s.deltan = meta["delta_n"]
+        s.timestep = meta["timestep"]
+        s.total_timesteps = meta["total_timesteps"]
+        s.series_first_timestep = meta["series_first_timestep"]
+        s.vehicle_log_fields = sum(VEHICLE_LOG_FIELDS[field] for field in meta["log_fields"])
+
+        def load(fname):
+            return np.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+        s._link_series = {kind: load(f"link_{kind}.npy") for kind in RESULTS_LINK_SERIES}
+        s._traveltime_quantiles = load("link_traveltime_quantiles.npy")
+        s._veh = {key: load(f"veh_{key}.npy") for key in ["name", "orig", "dest", "state", "departure_time", "arrival_time", "travel_time"]}
+        s._log_offsets = load("log_offsets.npy")
+        s._logs = {field: load(f"log_{field}.npy") for field in meta["log_fields"]}
+
+        s.NODES = [ResultNode(s, i, **n) for i, n in enumerate(meta["nodes"])]
+        s.LINKS = [ResultLink(s, i, **l) for i, l in enumerate(meta["links"])]
+        s.VEHICLES = _ResultVehicles(s)
+        s.DETECTORS = [ResultDetector(d["name"], d["link"], d["x"]) for d in meta["detectors"]]
+        s._detector_data = {d["name"]: d["data"] for d in meta["detectors"]}
+        s._nodes_dict = {n.name: n for n in s.NODES}
+        s._links_dict = {l.name: l for l in s.LINKS}
+
+    def get_node(s, node_name):
+        """Get a node by name."""
+        if isinstance(node_name, ResultNode):
+            return node_name
+        return s._nodes_dict[node_name]
+
+    def get_link(s, link_name):
+        """Get a link by name."""
+        if isinstance(link_name, ResultLink):
+            return link_name
+        return s._links_dict[link_name]
+
+    def get_vehicle(s, vehicle_name):
+        """Get a vehicle by name. It searches all vehicles."""
+        idx = np.flatnonzero(s._veh["name"] == vehicle_name)
+        if len(idx) == 0:
+            raise KeyError(f"Vehicle `{vehicle_name}` not found")
+        return s.VEHICLES[int(idx[0])]
+
+    def get_detector_data(s, detector_name):
+        """Get the values recorded by a detector, the same as `World.get_detector_data`."""
+        return s._detector_data[detector_name]
+
+    def get_link_state_matrices(s, interval_t):
+        """
+        Compute link-by-time matrices of traffic states by Edie's generalized definitions, as `World.get_link_state_matrices`.
+
+        They are always computed from the cumulative curves and the instantaneous travel times, so "from_trajectories" is False.
+        """
+        bin_steps = int(max(1.0, round(interval_t/s.DELTAT)))
+        n_bins = (s.total_timesteps + bin_steps - 1)//bin_steps
+        n_links = len(s.LINKS)
+        interval = bin_steps*s.DELTAT
+        ts_end = min(s.timestep+1, s.total_timesteps)
+
+        ttd = np.zeros((n_links, n_bins))
+        tts = np.zeros((n_links, n_bins))
+        lengths = np.array([l.length for l in s.LINKS])
+        vmax = np.array([l.vmax for l in s.LINKS])
+        # timesteps before the kept series are unknown
+        ts0 = s.series_first_timestep
+        tts[:, :ts0//bin_steps+(1 if ts0 % bin_steps else 0)] = np.nan
+        ttd[np.isnan(tts)] = np.nan
+        # accumulate in chunks of bins so that only a part of the series is read at a time
+        chunk = max(1, 2**20//max(1, n_links*bin_steps))*bin_steps
+        for start in range(ts0, ts_end, chunk):
+            end = min(ts_end, start+chunk)
+            i0, i1 = start-ts0, end-ts0
+            n = np.asarray(s._link_series["arrival_curve"][:, i0:i1]) - np.asarray(s._link_series["departure_curve"][:, i0:i1])
+            tt = np.asarray(s._link_series["traveltime_instant"][:, i0:i1])
+            bins = np.arange(start, end)//bin_steps
+            for b in np.unique(bins):
+                m = bins == b
+                tts[:, b] += n[:, m].sum(axis=1)*s.DELTAT
+                ttd[:, b] += (n[:, m]*s.DELTAT*lengths[:, None]/tt[:, m]).sum(axis=1)
+
+        area = lengths[:, None]*interval
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speed = np.where(tts > 0, ttd/tts, np.where(np.isnan(tts), tts, vmax[:, None]))
+        return {
+            "t": np.arange(n_bins)*interval,
+            "interval": interval,
+            "from_trajectories": False,
+            "flow": ttd/area,
+            "density": tts/area,
+            "speed": speed,
+            "delay": tts - ttd/vmax[:, None],
+        }
+
+    def __repr__(s):
+        return f"<Results `{s.name}` from {s.path}>"
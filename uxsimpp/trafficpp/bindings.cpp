@@ -2,6 +2,7 @@
 
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 #include <pybind11/functional.h> // if you need to bind functionals or std::function
 
 #include <memory>
@@ -17,53 +18,73 @@ namespace py = pybind11;
 
 // ----------------------------------------------------------------------
 // カスタム streambuf: Python の sys.stdout に出力する
+// GIL を持たないスレッド（解放中の main_loop）からの出力はバッファに溜め、
+// flush（std::endl など）の時だけ GIL を取得して書き出す
 // ----------------------------------------------------------------------
-#ifdef __GNUC__
-#pragma GCC diagnostic push
-#pragma GCC diagnostic ignored "-Wattributes" //ignore warning: greater visibility than the type of its field 
-#endif
 class py_stdout_redirect_buf : public std::streambuf {
 public:
-    py_stdout_redirect_buf() {
-        // Python の sys.stdout を取得（※これがグローバル領域で呼ばれると問題になるので、後述の get_pyout() 内で初期化する）
-        py::object sys = py::module_::import("sys");
-        py_stdout = sys.attr("stdout");
+    ~py_stdout_redirect_buf() override {
+        if (!buffer.empty() && Py_IsInitialized()) {
+            flush_buffer();
+        }
     }
 protected:
-    // 単一文字出力時：char を 1文字の std::string に変換して出力
+    // 単一文字出力時
     virtual int overflow(int c) override {
         if (c != EOF) {
-            std::string s(1, static_cast<char>(c));
-            py_stdout.attr("write")(s);
+            buffer.push_back(static_cast<char>(c));
+            flush_if_gil_held();
         }
         return c;
     }
     // 複数文字出力時
     virtual std::streamsize xsputn(const char* s, std::streamsize n) override {
-        std::string str(s, n);
-        py_stdout.attr("write")(str);
+        buffer.append(s, n);
+        flush_if_gil_held();
         return n;
     }
+    virtual int sync() override {
+        if (!buffer.empty()) {
+            flush_buffer();
+        }
+        return 0;
+    }
+private:
+    std::string buffer;
+
+    void flush_if_gil_held() {
+        if (PyGILState_Check()) {
+            flush_buffer();
+        }
+    }
+    void flush_buffer() {
+        py::gil_scoped_acquire acquire;
+        std::string str;
+        str.swap(buffer);
+        // sys.stdout は差し替えられることがあるので毎回取得する
+        py::module_::import("sys").attr("stdout").attr("write")(str);
+    }
+};
+
+// World ごとに持つ出力ストリーム
+class py_ostream : public std::ostream {
+public:
+    py_ostream() : std::ostream(&buf) {}
 private:
-    py::object py_stdout;
+    py_stdout_redirect_buf buf;
 };
-#ifdef __GNUC__
-#pragma GCC diagnostic pop
-#endif
 
 // ----------------------------------------------------------------------
-// Python インタープリタが初期化された後に呼ばれるようにするため、
-// 出力用 std::ostream を返すヘルパー関数を作成する
+// World::writer を Python の sys.stdout 経由の ostream に切り替える
+// 複数の World を別スレッドで実行できるよう、ストリームは World ごとに作る
 // ----------------------------------------------------------------------
-std::ostream* get_pyout() {
-    // 関数内の static 変数は、初回呼び出し時（すなわちPython側でインポート後）に初期化されるので安全
-    static py_stdout_redirect_buf custom_buf;
-    static std::ostream pyout(&custom_buf);
-    return &pyout;
+void attach_pyout(World &world) {
+    world.writer_holder = std::make_shared<py_ostream>();
+    world.writer = world.writer_holder.get();
 }
 
 // ----------------------------------------------------------------------
-// create_world() の実装（World::writer を Python の sys.stdout 経由の ostream に切り替える）
+// create_world() の実装
 // ----------------------------------------------------------------------
 std::unique_ptr<World> create_world(
         const std::string &world_name,
@@ -75,7 +96,7 @@ std::unique_ptr<World> create_world(
         double route_choice_uncertainty,
         int print_mode,
         long long random_seed,
-        bool vehicle_log_mode){
+        int vehicle_log_mode){
     auto world = std::make_unique<World>(
         world_name,
         t_max,
@@ -87,8 +108,16 @@ std::unique_ptr<World> create_world(
         print_mode,
         random_seed,
         vehicle_log_mode);
-    // World 内の出力先を Python の sys.stdout 経由に変更
-    world->writer = get_pyout();
+    attach_pyout(*world);
+    return world;
+}
+
+// ----------------------------------------------------------------------
+// チェックポイントから World を復元する
+// ----------------------------------------------------------------------
+std::unique_ptr<World> load_checkpoint(const std::string &fname){
+    auto world = create_world("", 0.0, 1.0, 1.0, 1.0, 0.0, 0.0, 0, 0, vlmFULL);
+    world->load_checkpoint(fname);
     return world;
 }
 
@@ -97,7 +126,7 @@ std::unique_ptr<World> create_world(
 // ----------------------------------------------------------------------
 void add_node(World &world, const std::string &node_name, double x, double y, 
         vector<double> signal_intervals = {0}, double signal_offset = 0) {
-    new Node(&world, node_name, x, y, signal_intervals, signal_offset);
+    world.add_node(node_name, x, y, signal_intervals, signal_offset);
 }
 
 void add_link(
@@ -111,8 +140,8 @@ void add_link(
         double merge_priority,
         double capacity_out,
         vector<int> signal_group={0}){
-    new Link(&world, link_name, start_node_name, end_node_name,
-                        vmax, kappa, length, merge_priority, capacity_out, signal_group);
+    world.add_link(link_name, start_node_name, end_node_name,
+                   vmax, kappa, length, merge_priority, capacity_out, signal_group);
 }
 
 void add_demand(
@@ -124,6 +153,146 @@ void add_demand(
     double flow,
     vector<string> links_preferred_str);
 
+// ----------------------------------------------------------------------
+// vector をコピーせずに NumPy 配列 (1 次元または rows x cols) に変換する
+// 所有権は capsule に移し、配列の破棄時に解放する
+// ----------------------------------------------------------------------
+py::array_t<double> to_numpy(vector<double> &&data, size_t rows, size_t cols){
+    auto *holder = new vector<double>(std::move(data));
+    py::capsule owner(holder, [](void *p){ delete static_cast<vector<double> *>(p); });
+    return py::array_t<double>({rows, cols}, {cols * sizeof(double), sizeof(double)}, holder->data(), owner);
+}
+
+template <typename T>
+py::array_t<T> to_numpy(vector<T> &&data){
+    auto *holder = new vector<T>(std::move(data));
+    py::capsule owner(holder, [](void *p){ delete static_cast<vector<T> *>(p); });
+    return py::array_t<T>({holder->size()}, {sizeof(T)}, holder->data(), owner);
+}
+
+// ----------------------------------------------------------------------
+// Edie の定義によるリンク x 時間帯の状態行列を dict of NumPy 配列で返す
+// ----------------------------------------------------------------------
+py::dict get_link_state_matrices(World &world, double interval_t){
+    LinkStateMatrices mat;
+    {
+        py::gil_scoped_release release;
+        mat = world.compute_link_state_matrices(interval_t);
+    }
+    vector<double> t(mat.n_bins);
+    for (size_t b = 0; b < mat.n_bins; b++){
+        t[b] = (double)b * mat.interval;
+    }
+    py::dict ret;
+    ret["t"] = py::array_t<double>(t.size(), t.data());
+    ret["interval"] = mat.interval;
+    ret["from_trajectories"] = mat.from_trajectories;
+    ret["flow"] = to_numpy(std::move(mat.flow), mat.n_links, mat.n_bins);
+    ret["density"] = to_numpy(std::move(mat.density), mat.n_links, mat.n_bins);
+    ret["speed"] = to_numpy(std::move(mat.speed), mat.n_links, mat.n_bins);
+    ret["delay"] = to_numpy(std::move(mat.delay), mat.n_links, mat.n_bins);
+    return ret;
+}
+
+// ----------------------------------------------------------------------
+// リンクと時間窓のバッチクエリ。入力は 1 次元配列、出力は dict of NumPy 配列
+// ----------------------------------------------------------------------
+py::dict query_links(World &world,
+                     py::array_t<int, py::array::c_style | py::array::forcecast> link_ids,
+                     py::array_t<double, py::array::c_style | py::array::forcecast> t1,
+                     py::array_t<double, py::array::c_style | py::array::forcecast> t2){
+    vector<int> ids(link_ids.data(), link_ids.data() + link_ids.size());
+    vector<double> t1v(t1.data(), t1.data() + t1.size());
+    vector<double> t2v(t2.data(), t2.data() + t2.size());
+    LinkQueryResult res;
+    {
+        py::gil_scoped_release release;
+        res = world.query_links(ids, t1v, t2v);
+    }
+    py::dict ret;
+    ret["inflow"] = to_numpy(std::move(res.inflow));
+    ret["outflow"] = to_numpy(std::move(res.outflow));
+    ret["traveltime"] = to_numpy(std::move(res.traveltime));
+    ret["vehicles"] = to_numpy(std::move(res.vehicles));
+    return ret;
+}
+
+// ----------------------------------------------------------------------
+// 全リンクの時系列をリンク x タイムステップの NumPy 配列で返す
+// ----------------------------------------------------------------------
+py::array_t<double> get_link_series_array(World &world, const string &kind, size_t ts_start, size_t ts_end){
+    size_t n = ts_end > ts_start ? ts_end - ts_start : 0;
+    vector<double> data;
+    {
+        py::gil_scoped_release release;
+        data.reserve(world.links.size() * n);
+        for (const auto &row : world.get_link_series(kind, ts_start, ts_end)){
+            data.insert(data.end(), row.begin(), row.end());
+        }
+    }
+    return to_numpy(std::move(data), world.links.size(), n);
+}
+
+// ----------------------------------------------------------------------
+// 全車両のログを列指向で返す。車両 i のログは offsets[i]:offsets[i+1]
+// ----------------------------------------------------------------------
+py::dict get_vehicle_logs(World &world){
+    int fields = world.vehicle_log_mode == vlmNONE ? 0 : world.vehicle_log_fields;
+    vector<int64_t> offsets = {0};
+    vector<double> t, x, v;
+    vector<int> state, link;
+    {
+        py::gil_scoped_release release;
+        offsets.reserve(world.vehicles.size() + 1);
+        for (Vehicle *veh : world.vehicles){
+            size_t n = 0;
+            auto append = [&n](auto &col, auto &&values){
+                n = std::max(n, values.size());
+                col.insert(col.end(), values.begin(), values.end());
+            };
+            if (fields & vlfT) append(t, veh->get_log_t());
+            if (fields & vlfSTATE) append(state, veh->get_log_state());
+            if (fields & vlfLINK) append(link, veh->get_log_link());
+            if (fields & vlfX) append(x, veh->get_log_x());
+            if (fields & vlfV) append(v, veh->get_log_v());
+            offsets.push_back(offsets.back() + (int64_t)n);
+        }
+    }
+    py::dict ret;
+    ret["offsets"] = to_numpy(std::move(offsets));
+    if (fields & vlfT) ret["t"] = to_numpy(std::move(t));
+    if (fields & vlfSTATE) ret["state"] = to_numpy(std::move(state));
+    if (fields & vlfLINK) ret["link"] = to_numpy(std::move(link));
+    if (fields & vlfX) ret["x"] = to_numpy(std::move(x));
+    if (fields & vlfV) ret["v"] = to_numpy(std::move(v));
+    return ret;
+}
+
+// ----------------------------------------------------------------------
+// 時間依存最短経路のバッチクエリ。経路はリンク ID のリスト
+// ----------------------------------------------------------------------
+py::dict query_routes(World &world,
+                      py::array_t<int, py::array::c_style | py::array::forcecast> orig_ids,
+                      py::array_t<int, py::array::c_style | py::array::forcecast> dest_ids,
+                      py::array_t<double, py::array::c_style | py::array::forcecast> departure_times,
+                      bool return_paths, int n_landmarks, int n_threads){
+    vector<int> origs(orig_ids.data(), orig_ids.data() + orig_ids.size());
+    vector<int> dests(dest_ids.data(), dest_ids.data() + dest_ids.size());
+    vector<double> deps(departure_times.data(), departure_times.data() + departure_times.size());
+    RouteQueryResult res;
+    {
+        py::gil_scoped_release release;
+        res = world.query_routes(origs, dests, deps, return_paths, n_landmarks, n_threads);
+    }
+    py::dict ret;
+    ret["traveltime"] = to_numpy(std::move(res.traveltime));
+    if (return_paths){
+        ret["paths"] = py::cast(res.paths);
+    }
+    ret["settled"] = res.settled;
+    return ret;
+}
+
 // ----------------------------------------------------------------------
 // コンパイル日時を返す関数
 // ----------------------------------------------------------------------
@@ -174,8 +343,8 @@ PYBIND11_MODULE(trafficppy, m) {
               Whether print the simulation progress or not.
           random_seed : int
               The random seed.
-          vehicle_log_mode : bool
-              Whether save vehicle data or not.
+          vehicle_log_mode : int
+              Whether save vehicle data or not. 0: no log, 1: log every sample, 2: compressed log of breakpoints.
 
           Returns
           -------
@@ -209,6 +378,22 @@ PYBIND11_MODULE(trafficppy, m) {
               The offset of the signal.
           )docstring");
 
+    m.def("load_checkpoint", &load_checkpoint,
+          py::arg("fname"),
+          R"docstring(
+          Restore a World from a checkpoint file written by `World.save_checkpoint`.
+
+          Parameters
+          ----------
+          fname : str
+              The file name.
+
+          Returns
+          -------
+          World
+              The restored world. The simulation can be continued by `main_loop`.
+          )docstring");
+
     m.def("add_link", &add_link,
           py::arg("world"),
           py::arg("link_name"),
@@ -280,20 +465,43 @@ PYBIND11_MODULE(trafficppy, m) {
     // 2) MARK: World
     //
     py::class_<World>(m, "World")
-        .def("initialize_adj_matrix", &World::initialize_adj_matrix)
+        .def("initialize_adj_matrix", &World::initialize_adj_matrix,
+             py::call_guard<py::gil_scoped_release>())
         .def("print_scenario_stats", &World::print_scenario_stats)
-        .def("main_loop", &World::main_loop)
+        .def("main_loop", &World::main_loop,
+             py::arg("duration_t") = -1,
+             py::arg("until_t") = -1,
+             py::call_guard<py::gil_scoped_release>(),
+             "Run the simulation. The GIL is released during the run, so that other Python threads and other Worlds can run in parallel.")
         .def("check_simulation_ongoing", &World::check_simulation_ongoing)
+        .def("reset", &World::reset,
+             py::arg("keep_route_preference") = false,
+             py::arg("reseed") = true,
+             py::arg("random_seed") = -1,
+             R"docstring(
+             Return the world to t=0 while keeping the network, the demand and the allocations.
+
+             Vehicle states, logs, link curves and queues are cleared in place. Parameters of nodes, links and vehicles changed after construction are kept.
+
+             Parameters
+             ----------
+             keep_route_preference : bool, optional
+                 If True, the route preferences learned by DUO are kept. Otherwise, they are cleared as in a new world. Default is False.
+             reseed : bool, optional
+                 If True, the random number generator is reseeded, so that the same run as a new world is obtained. Otherwise, it continues from the current state. Default is True.
+             random_seed : int, optional
+                 The new random seed. If negative, the current seed is used. Default is -1.
+             )docstring")
         .def("print_simple_results", &World::print_simple_results)
         .def("update_adj_time_matrix", &World::update_adj_time_matrix)
         .def("get_node", &World::get_node,
-             py::return_value_policy::reference,
+             py::return_value_policy::reference_internal,
              "Get a Node by name (reference)")
         .def("get_link", &World::get_link,
-             py::return_value_policy::reference,
+             py::return_value_policy::reference_internal,
              "Get a Link by name (reference)")
         .def("get_vehicle", &World::get_vehicle,
-             py::return_value_policy::reference,
+             py::return_value_policy::reference_internal,
              "Get a Vehicle by name (reference)")
         .def_readonly("VEHICLES", &World::vehicles,
                       "Vector of pointers to all Vehicles in the world.")
@@ -301,7 +509,10 @@ PYBIND11_MODULE(trafficppy, m) {
                       "Vector of pointers to all Links in the world.")
         .def_readonly("NODES", &World::nodes,
                       "Vector of pointers to all Nodes in the world.")
+        .def_readonly("DETECTORS", &World::detectors,
+                      "List of all Detectors in the world in the order of their indices.")
         .def_readonly("timestep", &World::timestep)
+        .def_readonly("total_timesteps", &World::total_timesteps)
         .def_readonly("time", &World::time)
         .def_readonly("delta_t", &World::delta_t)
         .def_readonly("DELTAT", &World::delta_t)
@@ -309,13 +520,458 @@ PYBIND11_MODULE(trafficppy, m) {
         .def_readonly("TMAX", &World::t_max)
         .def_readonly("name", &World::name)
         .def_readonly("deltan", &World::delta_n)
+        .def("set_vehicle_log_policy", &World::set_vehicle_log_policy,
+             py::arg("interval"),
+             py::arg("sample_ratio"),
+             py::arg("fields"),
+             py::arg("log_wait"),
+             py::arg("reserve_size"),
+             R"docstring(
+             Set the policy of vehicle logging. It must be set before the simulation starts.
+             `sample_ratio` and `reserve_size` apply to vehicles added after this call. The other settings are read at every step and apply to all vehicles.
+
+             Parameters
+             ----------
+             interval : int
+                 Log every `interval` timesteps. The end of trip is always logged.
+             sample_ratio : float
+                 The ratio of vehicles to be logged in [0, 1]. Raises ValueError otherwise. Vehicles are sampled deterministically by their id.
+             fields : int
+                 The fields to be recorded as bit flags: t=1, state=2, link=4, x=8, v=16.
+             log_wait : bool
+                 Whether log vehicles waiting at the origin or not.
+             reserve_size : int
+                 The initial capacity of each log vector.
+             )docstring")
+        .def_readonly("vehicle_log_interval", &World::vehicle_log_interval)
+        .def_readonly("vehicle_log_sample_ratio", &World::vehicle_log_sample_ratio)
+        .def_readonly("vehicle_log_fields", &World::vehicle_log_fields)
+        .def_readonly("vehicle_log_wait", &World::vehicle_log_wait)
+        .def_readonly("vehicle_log_reserve_size", &World::vehicle_log_reserve_size)
+        .def_readwrite("vehicle_retire_mode", &World::vehicle_retire_mode,
+                       "Whether move the logs of finished vehicles to a compact world-level archive and release their per-vehicle state. Default is False.")
+        .def_readwrite("idle_skip_mode", &World::idle_skip_mode,
+                       "Whether jump the clock over periods in which no vehicle is running or waiting. Default is True.")
+        .def("set_rolling_mode", &World::set_rolling_mode,
+             py::arg("window_t"),
+             py::arg("spill") = nullptr,
+             R"docstring(
+             Enable rolling mode, in which only a trailing window of link time series is kept and older data is spilled.
+
+             It does not make the memory usage constant: the simulation still ends at `t_max`, a Vehicle object and its archived name and id are kept for every vehicle, the statistics and timing series grow with the number of their intervals, and the detector series are allocated for the whole duration.
+
+             Parameters
+             ----------
+             window_t : float
+                 The length of the window in seconds.
+             spill : callable, optional
+                 The function called as `spill(ts_start, ts_end)` at the end of each window and of the simulation, before the data of the timesteps is released. If None, the data is dropped.
+             )docstring")
+        .def_readonly("rolling_window", &World::rolling_window)
+        .def("set_series_mode", &World::set_series_mode,
+             py::arg("mode"),
+             R"docstring(
+             Set the storage of link time series. It must be set before the simulation starts.
+
+             Parameters
+             ----------
+             mode : int
+                 0 (dense, a value per timestep), 1 (compressed, only the breakpoints where the values change), or 2 (compressed with float32 values).
+                 Compressed series are accessed by binary search and cannot be used with rolling mode. The values used by the simulation are kept exact in all modes.
+             )docstring")
+        .def_readonly("series_mode", &World::series_mode)
+        .def_readonly("rolling_spilled_until", &World::rolling_spilled_until)
+        .def("freeze_network", [](World &w){
+                 return std::const_pointer_cast<Network>(w.freeze_network());
+             },
+             R"docstring(
+             Freeze the network topology so that it can be shared by other Worlds. Nodes and links cannot be added afterwards.
+
+             It is also called automatically when the simulation is initialized.
+
+             Returns
+             -------
+             Network
+                 The frozen network. Pass it to `newWorld(network=...)` to build Worlds sharing it.
+             )docstring")
+        .def("attach_network", [](World &w, std::shared_ptr<Network> net){
+                 w.attach_network(net);
+             },
+             py::arg("network"),
+             R"docstring(
+             Instantiate nodes and links from a frozen network shared with other Worlds. The world must be empty.
+
+             Parameters
+             ----------
+             network : Network
+                 The frozen network.
+             )docstring")
+        .def_property_readonly("network", [](const World &w){
+                 return std::const_pointer_cast<Network>(w.network);
+             },
+             "The frozen network of the world, or None if it is not frozen yet.")
+        .def("fork", [](const World &w){
+                 auto f = w.fork();
+                 attach_pyout(*f);
+                 return f;
+             },
+             R"docstring(
+             Create a deep copy of the world including the complete simulation state.
+
+             The copy can be simulated and modified independently, e.g., to evaluate alternative interventions from the same state.
+
+             Returns
+             -------
+             World
+                 The new world. The spill function of rolling mode is not copied.
+             )docstring")
+        .def("save_checkpoint", &World::save_checkpoint,
+             py::arg("fname"),
+             R"docstring(
+             Save the complete simulation state to a binary file. It can be restored by `load_checkpoint`.
+
+             Parameters
+             ----------
+             fname : str
+                 The file name.
+
+             Notes
+             -----
+             The spill function of rolling mode is not saved. Set it again by `set_rolling_mode` with the same window after restoring.
+             Values are written in the native byte order and struct layout, so a checkpoint can only be restored on a machine with the same architecture and build.
+             )docstring")
+        .def("get_link_series", &World::get_link_series,
+             py::arg("kind"),
+             py::arg("ts_start"),
+             py::arg("ts_end"),
+             "Get a time series of all links as a list of lists. `kind` is one of 'arrival_curve', 'departure_curve', 'traveltime_real', and 'traveltime_instant'.")
+        .def("get_link_series_array", &get_link_series_array,
+             py::arg("kind"),
+             py::arg("ts_start"),
+             py::arg("ts_end"),
+             "Get a time series of all links as a NumPy array of shape (number of links, ts_end - ts_start). `kind` is the same as `get_link_series`.")
+        .def("get_vehicle_logs", &get_vehicle_logs,
+             R"docstring(
+             Get the logs of all vehicles in a columnar layout.
+
+             Returns
+             -------
+             dict
+                 "offsets": NumPy array of int64 with length (number of vehicles + 1). The logs of the vehicle with id `i` are `[offsets[i]:offsets[i+1]]` of each column.
+                 "t", "state", "link", "x", "v": NumPy arrays of the concatenated logs, only for the recorded fields. Compressed logs are expanded.
+             )docstring")
+        .def("get_archived_vehicle_ids", &World::get_archived_vehicle_ids,
+             py::arg("unspilled_only") = false,
+             "Get the ids of retired vehicles. If `unspilled_only` is True, only vehicles whose logs have not been spilled are returned.")
+        .def_property("route_traveltime_profile",
+                      [](const World &w){ return w.route_traveltime_profile; },
+                      &World::set_route_traveltime_profile,
+                      "Link travel times used by the route search instead of the current ones. `route_traveltime_profile[k][link id]` is used at the k-th route update. Non-positive values and updates beyond the profile fall back to the current travel times. Empty by default.")
+        .def_property("route_search_lag",
+                      [](const World &w){ return w.route_search_lag; },
+                      &World::set_route_search_lag,
+                      "The number of steps from the start of a route search to the application of its result. If positive, the route search runs on a worker thread while the simulation advances, and the result is applied after exactly this number of steps, so that results do not depend on the thread timing. It must be smaller than the interval of route updates. Default is 0 (synchronous).")
+        .def_readonly("average_speed", &World::ave_v,
+                      "The average speed of running vehicles over the steps so far.")
+        .def_readonly("average_speed_ratio", &World::ave_vratio,
+                      "The average ratio of the speed to the free flow speed of running vehicles over the steps so far.")
+        .def_readonly("total_travel_time", &World::total_travel_time,
+                      "The total travel time of running vehicles so far in veh*s.")
+        .def_readonly("total_delay", &World::total_delay,
+                      "The total delay compared with the free flow speed so far in veh*s.")
+        .def_property_readonly("vehicle_km", [](const World &w){ return w.vehicle_distance / 1000.0; },
+                               "The total distance traveled by vehicles so far in veh*km.")
+        .def_readonly("trips_completed", &World::trips_completed,
+                      "The number of completed trips so far in veh.")
+        .def("get_stats", &World::get_stats,
+             R"docstring(
+             Get the network statistics accumulated during the simulation. They are available regardless of the vehicle log settings.
+
+             Returns
+             -------
+             dict
+                 "average_speed" and "average_speed_ratio" over the steps of running vehicles, "total_travel_time" and "total_delay" in veh*s, "vehicle_km", "trips_completed" and "trips_total" in veh.
+             )docstring")
+        .def("set_stats_interval", &World::set_stats_interval,
+             py::arg("interval_t"),
+             R"docstring(
+             Record the network statistics of each interval during the simulation. The recorded series is cleared.
+
+             Parameters
+             ----------
+             interval_t : float
+                 The interval in seconds. If 0, the series is not recorded.
+             )docstring")
+        .def("get_stats_series", &World::get_stats_series,
+             R"docstring(
+             Get the network statistics of each interval recorded by `set_stats_interval`.
+
+             Returns
+             -------
+             dict
+                 Lists of "t" (the end time of each interval), "average_speed", "average_speed_ratio" (NaN if no vehicle is running), "total_travel_time", "total_delay", "vehicle_km", and "trips_completed" in each interval.
+             )docstring")
+        .def("set_traveltime_stats", &World::set_traveltime_stats,
+             py::arg("interval_t"),
+             py::arg("keep_samples") = false,
+             R"docstring(
+             Set how link travel times are recorded. By default, the average travel time in each interval of route updates and a quantile sketch are recorded for each link, and the raw samples are not kept.
+
+             Parameters
+             ----------
+             interval_t : float
+                 The interval of `Link.get_traveltime_stats` in seconds. The recorded stats are cleared if it changes.
+             keep_samples : bool, optional
+                 Whether keep the raw samples of all traversals in `Link.traveltime_t` and `Link.traveltime_tt`. Default is False.
+             )docstring")
+        .def_readonly("traveltime_keep_samples", &World::traveltime_keep_samples)
+        .def("query_links", &query_links,
+             py::arg("link_ids"),
+             py::arg("t1"),
+             py::arg("t2"),
+             R"docstring(
+             Answer a batch of queries of links and time windows in one pass.
+
+             Parameters
+             ----------
+             link_ids : array-like of int
+                 The link id of each query.
+             t1 : array-like of float
+                 The start time of each window. It must have the same length as `link_ids`.
+             t2 : array-like of float
+                 The end time of each window.
+
+             Returns
+             -------
+             dict
+                 NumPy arrays of "inflow" and "outflow" (veh/s, as `Link.inflow` and `Link.outflow`), "traveltime" (the mean of `Link.traveltime_real`), and "vehicles" (the mean number of vehicles on the link) over the timesteps in each window.
+                 Queries whose window is empty or out of the kept link series give NaN.
+             )docstring")
+        .def("query_routes", &query_routes,
+             py::arg("orig_ids"),
+             py::arg("dest_ids"),
+             py::arg("departure_times"),
+             py::arg("return_paths") = false,
+             py::arg("n_landmarks") = 8,
+             py::arg("n_threads") = 0,
+             R"docstring(
+             Answer a batch of time-dependent shortest path queries in parallel.
+
+             Link costs are the experienced travel times by entry time derived from the cumulative curves, and the free flow travel times outside the simulated period.
+
+             Parameters
+             ----------
+             orig_ids : array-like of int
+                 The origin node id of each query.
+             dest_ids : array-like of int
+                 The destination node id of each query. It must have the same length as `orig_ids`.
+             departure_times : array-like of float
+                 The departure time of each query.
+             return_paths : bool, optional
+                 Whether return the paths, default is False.
+             n_landmarks : int, optional
+                 The number of ALT landmarks for goal-directed search, default is 8. 0 means plain Dijkstra.
+             n_threads : int, optional
+                 The number of threads, default is 0 (the number of hardware threads).
+
+             Returns
+             -------
+             dict
+                 "traveltime": NumPy array of the shortest travel times, NaN if unreachable.
+                 "paths": list of lists of link ids, only if `return_paths` is True.
+                 "settled": the total number of nodes settled by the searches.
+             )docstring")
+        .def("freeflow_distances", &World::freeflow_distances,
+             py::arg("source"),
+             py::arg("reverse") = false,
+             R"docstring(
+             Compute the free flow travel times from a node to all nodes.
+
+             Parameters
+             ----------
+             source : int
+                 The node id.
+             reverse : bool, optional
+                 If True, the travel times from all nodes to `source` are computed. Default is False.
+
+             Returns
+             -------
+             list of float
+                 By node id. Infinity if unreachable.
+             )docstring")
+        .def("add_detector", &World::add_detector,
+             py::arg("detector_name"),
+             py::arg("link_name"),
+             py::arg("x"),
+             py::arg("interval_t"),
+             R"docstring(
+             Add a virtual loop detector, which records the vehicles crossing a position of a link during the simulation. It works regardless of the vehicle log settings.
+
+             Parameters
+             ----------
+             detector_name : str
+                 The name of the detector.
+             link_name : str
+                 The name of the link.
+             x : float
+                 The position from the start of the link. It must be in [0, length).
+             interval_t : float
+                 The aggregation interval in seconds. It is rounded to a multiple of the timestep.
+
+             Returns
+             -------
+             int
+                 The index of the detector.
+             )docstring")
+        .def("get_detector_data", &World::get_detector_data,
+             py::arg("detector_name"),
+             R"docstring(
+             Get the values recorded by a detector in each interval.
+
+             Parameters
+             ----------
+             detector_name : str
+                 The name of the detector.
+
+             Returns
+             -------
+             dict
+                 Lists of "t" (the start time of each interval), "count" (veh), "flow" (veh/s), "speed" (the time-mean speed of crossed vehicles, NaN if none), and "occupancy" (the fraction of time the detector is occupied, assuming each vehicle occupies the jam spacing).
+             )docstring")
+        .def("get_link_state_matrices", &get_link_state_matrices,
+             py::arg("interval_t"),
+             R"docstring(
+             Compute link-by-time matrices of traffic states by Edie's generalized definitions.
+
+             In the time-space region of each link and time bin, the flow is the total distance traveled and the density is the total time spent divided by the area of the region.
+             They are computed from the vehicle trajectories if the vehicle logs record the time, link and position of every vehicle at every timestep, and otherwise from the cumulative curves and the instantaneous travel times.
+
+             Parameters
+             ----------
+             interval_t : float
+                 The length of a time bin in seconds. It is rounded to a multiple of the timestep.
+
+             Returns
+             -------
+             dict
+                 "flow" (veh/s), "density" (veh/m), "speed" (m/s, the free flow speed if no vehicle is present) and "delay" (veh*s compared with the free flow speed) as NumPy arrays of shape (number of links, number of bins) in the order of link ids,
+                 "t" (the start time of each bin), "interval" (the actual bin length), and "from_trajectories" (whether the trajectories were used).
+                 Timesteps spilled in rolling mode are NaN unless the trajectories are used.
+             )docstring")
+        .def("memory_usage", &World::memory_usage,
+             R"docstring(
+             Estimate the memory usage of the world by category.
+
+             The sizes are estimated from the sizes and capacities of the containers, so that they are approximate.
+
+             Returns
+             -------
+             dict
+                 The bytes of "vehicle_objects", "vehicle_logs", "vehicle_preferences" (per-vehicle preference maps), "network_objects", "link_series" (cumulative curves, travel time series and detector values), "link_samples" (per-link travel time samples and their stats), "route_matrices" (adjacency and route matrices, route preferences and profiles), "name_maps", and their "total".
+                 The projected bytes at the end of the simulation "projected_vehicle_logs", "projected_link_samples", and "projected_total" are also included.
+                 They are extrapolated linearly from the elapsed steps, or estimated from the free flow shortest paths of the vehicles before the simulation.
+             )docstring")
+        .def("set_timing_mode", &World::set_timing_mode,
+             py::arg("enabled") = true,
+             py::arg("interval_t") = 0.0,
+             R"docstring(
+             Enable or disable timing mode, in which the time spent in each phase of the simulation steps is measured.
+
+             Parameters
+             ----------
+             enabled : bool, optional
+                 Whether measure the phase times. Default is True.
+             interval_t : float, optional
+                 The interval of the timing series in seconds. If 0, the series is not recorded. Default is 0.
+
+             Notes
+             -----
+             The phases are "link_update", "generate_signal", "transfer", "car_follow", "vehicle_update", "route_search" (including waiting for the asynchronous search), "route_choice", "idle_skip" (fast-forward over idle periods), and "other". The measurements are not saved in checkpoints.
+             )docstring")
+        .def_readonly("timing_mode", &World::timing_mode)
+        .def("reset_timing", &World::reset_timing,
+             "Clear the measured phase times, the counters and the timing series. They are also cleared by `reset`.")
+        .def("get_timing", &World::get_timing,
+             R"docstring(
+             Get the total time spent in each phase and the counters.
+
+             Returns
+             -------
+             dict
+                 The time of each phase in seconds (0 unless timing mode is enabled), "total" time, and the counters "steps" (simulated timesteps), "transfers" (vehicles transferred between links at nodes), "route_choices" (next link choices of vehicles), and "dijkstra_pops" (priority queue pops in route searches).
+             )docstring")
+        .def("get_timing_series", &World::get_timing_series,
+             "Get the timing series recorded in timing mode as a dict of lists: \"t\" (the end time of each interval) and the values of `get_timing` in each interval.")
+        .def_readwrite("day_to_day_weight", &World::day_to_day_weight,
+                       "If positive, the route preferences at each route update are updated from the ones at the same route update of the previous run with this weight, instead of the current ones with `duo_update_weight`. Default is 0 (disabled).")
+        .def("get_traveltime_profile", &World::get_traveltime_profile,
+             "Get the link travel times experienced by vehicles entering each link at each route update as a list of lists, `profile[k][link id]`, from the cumulative curves. The free flow travel time is used for links no vehicle has entered.")
+        .def("equilibrium_gap", &World::equilibrium_gap,
+             py::arg("profile"),
+             R"docstring(
+             Compute the relative gap of completed trips against the shortest paths under a travel time profile.
+
+             Parameters
+             ----------
+             profile : list of list of float
+                 `profile[k][link id]` is the travel time at the k-th route update, e.g., from `get_traveltime_profile`. Each trip is compared with the shortest path at the route update just before its departure.
+
+             Returns
+             -------
+             float
+                 (sum of experienced travel times - sum of shortest path travel times) / sum of experienced travel times. It is 0 at dynamic user equilibrium.
+             )docstring")
+        .def("save_route_table", &World::save_route_table,
+             py::arg("fname"),
+             "Save the route preferences, the preferences recorded at each route update in day-to-day mode, and `route_traveltime_profile` to a binary file. Nodes and links are identified by name.")
+        .def("load_route_table", &World::load_route_table,
+             py::arg("fname"),
+             "Load the route table saved by `save_route_table`. The nodes and links in the file must exist in the world.")
+        ;
+
+    //
+    // MARK: Network
+    //
+    py::class_<Network, std::shared_ptr<Network>>(m, "Network",
+                                                  "Frozen network topology shared by Worlds. It is created by `World.freeze_network`.")
+        .def_property_readonly("node_names", [](const Network &net){
+            vector<string> names;
+            for (const auto &spec : net.nodes){
+                names.push_back(spec.name);
+            }
+            return names;
+        })
+        .def_property_readonly("link_names", [](const Network &net){
+            vector<string> names;
+            for (const auto &spec : net.links){
+                names.push_back(spec.name);
+            }
+            return names;
+        })
+        ;
+
+    //
+    // MARK: Detector
+    //
+    py::class_<Detector>(m, "Detector",
+                         "Virtual loop detector added by `World.add_detector`.")
+        .def_readonly("name", &Detector::name)
+        .def_readonly("link", &Detector::link,
+                      "The id of the link.")
+        .def_readonly("x", &Detector::x,
+                      "The position from the start of the link.")
+        .def("__repr__", [](const Detector &d){ return "<Detector `" + d.name + "`>"; })
         ;
 
     //
     // MARK: Node
     //
-    py::class_<Node>(m, "Node")
-        .def(py::init<World *, const std::string &, double, double>(),
+    // Nodes, links and vehicles are owned by the World, so Python never deletes them
+    py::class_<Node, std::unique_ptr<Node, py::nodelete>>(m, "Node")
+        .def(py::init([](World *w, const std::string &node_name, double x, double y){
+                 return w->add_node(node_name, x, y);
+             }),
+             py::keep_alive<1, 2>(),
              py::arg("world"),
              py::arg("node_name"),
              py::arg("x"),
@@ -340,9 +996,12 @@ PYBIND11_MODULE(trafficppy, m) {
     //
     // MARK: Link
     //
-    py::class_<Link>(m, "Link")
-        .def(py::init<World *, const std::string &, const std::string &, const std::string &,
-                      double, double, double, double, double>(),
+    py::class_<Link, std::unique_ptr<Link, py::nodelete>>(m, "Link")
+        .def(py::init([](World *w, const std::string &link_name, const std::string &start_node_name, const std::string &end_node_name,
+                         double vmax, double kappa, double length, double merge_priority, double capacity_out){
+                 return w->add_link(link_name, start_node_name, end_node_name, vmax, kappa, length, merge_priority, capacity_out);
+             }),
+             py::keep_alive<1, 2>(),
              py::arg("world"),
              py::arg("link_name"),
              py::arg("start_node_name"),
@@ -369,12 +1028,51 @@ PYBIND11_MODULE(trafficppy, m) {
         .def_readonly("start_node", &Link::start_node)
         .def_readonly("end_node", &Link::end_node)
         .def_readonly("vehicles", &Link::vehicles)
-        .def_readonly("arrival_curve", &Link::arrival_curve)
-        .def_readonly("cum_arrival", &Link::arrival_curve)
-        .def_readonly("departure_curve", &Link::departure_curve)
-        .def_readonly("cum_departure", &Link::departure_curve)
-        .def_readonly("traveltime_real", &Link::traveltime_real)
-        .def_readonly("traveltime_instant", &Link::traveltime_instant)
+        .def_property_readonly("arrival_curve", [](const Link &ln){ return ln.arrival_curve.to_vector(); })
+        .def_property_readonly("cum_arrival", [](const Link &ln){ return ln.arrival_curve.to_vector(); })
+        .def_property_readonly("departure_curve", [](const Link &ln){ return ln.departure_curve.to_vector(); })
+        .def_property_readonly("cum_departure", [](const Link &ln){ return ln.departure_curve.to_vector(); })
+        .def_property_readonly("traveltime_real", [](const Link &ln){ return ln.traveltime_real.to_vector(); })
+        .def_property_readonly("traveltime_instant", [](const Link &ln){ return ln.traveltime_instant.to_vector(); })
+        .def_property_readonly("series_breakpoints", [](const Link &ln){
+                 return ln.arrival_curve.breakpoint_count() + ln.departure_curve.breakpoint_count()
+                      + ln.traveltime_real.breakpoint_count() + ln.traveltime_instant.breakpoint_count();
+             },
+             "The total number of breakpoints stored in the link time series in compressed mode. 0 in dense mode.")
+        .def_property_readonly("series_first_timestep", [](const Link &ln){ return ln.arrival_curve.first_timestep(); },
+                               "The oldest timestep kept in the link time series. It is 0 unless rolling mode is enabled.")
+        .def("inflow", &Link::inflow,
+             py::arg("t1"),
+             py::arg("t2"),
+             "Get the average inflow of the link between t1 and t2. Raises IndexError if the times are out of the kept series.")
+        .def("outflow", &Link::outflow,
+             py::arg("t1"),
+             py::arg("t2"),
+             "Get the average outflow of the link between t1 and t2. Raises IndexError if the times are out of the kept series.")
+        .def("entry_traveltime", &Link::entry_traveltime,
+             py::arg("t"),
+             "Get the experienced travel time of a vehicle entering the link at time `t` from the cumulative curves. It is at least the free flow travel time, which is also used outside the simulated period.")
+        .def("traveltime_quantile", &Link::traveltime_quantile,
+             py::arg("q"),
+             "Estimate the q-quantile of the travel times of vehicles that have traversed the link, within 1% relative error. NaN if no vehicle has traversed it.")
+        .def_property_readonly("traveltime_count", [](const Link &ln){ return ln.traveltime_sketch.count(); },
+                               "The number of vehicles that have traversed the link in veh.")
+        .def("get_traveltime_stats", [](const Link &ln){
+                 map<string, vector<double>> ret = {{"t", {}}, {"count", {}}, {"average", {}}};
+                 double interval_t = (double)ln.w->traveltime_stats_interval * ln.w->delta_t;
+                 for (size_t k = 0; k < ln.traveltime_interval_count.size(); k++){
+                     double n = ln.traveltime_interval_count[k];
+                     ret["t"].push_back((double)k * interval_t);
+                     ret["count"].push_back(n);
+                     ret["average"].push_back(n > 0.0 ? ln.traveltime_interval_sum[k] / n : std::nan(""));
+                 }
+                 return ret;
+             },
+             "Get the travel times of vehicles that left the link in each interval of `World.set_traveltime_stats` as a dict of lists: \"t\" (the start time of each interval), \"count\" (veh), and \"average\" (NaN if no vehicle left).")
+        .def_readonly("traveltime_t", &Link::traveltime_t,
+                      "The times vehicles left the link. Recorded only if `keep_samples` of `World.set_traveltime_stats` is True.")
+        .def_readonly("traveltime_tt", &Link::traveltime_tt,
+                      "The travel times of vehicles that left the link. Recorded only if `keep_samples` of `World.set_traveltime_stats` is True.")
         .def("update", &Link::update)
         .def("set_travel_time", &Link::set_travel_time)
         ;
@@ -382,8 +1080,11 @@ PYBIND11_MODULE(trafficppy, m) {
     //
     // MARK: Vehicle
     //
-    py::class_<Vehicle>(m, "Vehicle")
-        .def(py::init<World *, const std::string &, double, const std::string &, const std::string &>(),
+    py::class_<Vehicle, std::unique_ptr<Vehicle, py::nodelete>>(m, "Vehicle")
+        .def(py::init([](World *w, const std::string &name, double departure_time, const std::string &orig_name, const std::string &dest_name){
+                 return w->add_vehicle(name, departure_time, orig_name, dest_name);
+             }),
+             py::keep_alive<1, 2>(),
              py::arg("world"),
              py::arg("name"),
              py::arg("departure_time"),
@@ -391,7 +1092,9 @@ PYBIND11_MODULE(trafficppy, m) {
              py::arg("dest_name"))
         .def_readonly("W", &Vehicle::w)
         .def_readonly("id", &Vehicle::id)
-        .def_readwrite("name", &Vehicle::name)
+        .def_property("name",
+                      [](const Vehicle &veh){ return std::string(veh.name_view()); },
+                      &Vehicle::set_name)
         .def_readonly("departure_time", &Vehicle::departure_time)
         .def_readwrite("orig", &Vehicle::orig)
         .def_readwrite("dest", &Vehicle::dest)
@@ -408,11 +1111,16 @@ PYBIND11_MODULE(trafficppy, m) {
         .def_readwrite("route_adaptive", &Vehicle::route_adaptive)
         .def_readwrite("route_preference", &Vehicle::route_preference)
         .def_readwrite("links_preferred", &Vehicle::links_preferred)
-        .def_readonly("log_t", &Vehicle::log_t)
-        .def_readonly("log_state", &Vehicle::log_state)
-        .def_readonly("log_link", &Vehicle::log_link)
-        .def_readonly("log_x", &Vehicle::log_x)
-        .def_readonly("log_v", &Vehicle::log_v)
+        .def_property_readonly("retired", [](const Vehicle &veh){ return veh.archive_index >= 0; },
+                               "Whether the vehicle has been retired to the world-level archive.")
+        .def_readonly("log_enabled", &Vehicle::log_enabled)
+        .def_property_readonly("log_t", &Vehicle::get_log_t)
+        .def_property_readonly("log_state", &Vehicle::get_log_state)
+        .def_property_readonly("log_link", &Vehicle::get_log_link)
+        .def_property_readonly("log_x", &Vehicle::get_log_x)
+        .def_property_readonly("log_v", &Vehicle::get_log_v)
+        .def_property_readonly("log_segment_count", [](const Vehicle &veh){ return veh.log_segments.size(); },
+                               "The number of breakpoint segments in compressed log mode.")
         .def_readonly("arrival_time", &Vehicle::arrival_time)
         .def_readonly("travel_time", &Vehicle::travel_time)
         // .def("update", &Vehicle::update)
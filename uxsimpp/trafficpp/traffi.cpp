@@ -12,6 +12,7 @@
 #include <algorithm>
 #include <chrono>
 #include <queue>
+#include <sstream>
 
 #include "traffi.h"
 
@@ -43,7 +44,9 @@ Node::Node(World *w, const string &node_name, double x, double y, vector<double>
       signal_offset(signal_offset){
     w->nodes.push_back(this);
     w->node_id++;
-    w->nodes_map[node_name] = this;
+    if (!w->network){
+        w->nodes_map[node_name] = this;
+    }
 
     signal_t = signal_offset;
     signal_phase = 0;
@@ -83,7 +86,7 @@ void Node::generate(){
                 outlink->vehicles.push_back(veh);
 
                 // arrival curve
-                outlink->arrival_curve[w->timestep] += w->delta_n;
+                outlink->arrival_curve.add(w->timestep, w->delta_n);
             }
         }
     }
@@ -105,6 +108,17 @@ void Node::signal_update(){
     }
 }
 
+/**
+ * @brief Return the node to the initial state.
+ */
+void Node::reset(){
+    incoming_vehicles.clear();
+    incoming_vehicles_requests.clear();
+    generation_queue.clear();
+    signal_t = signal_offset;
+    signal_phase = 0;
+}
+
 /**
  * @brief Transfer vehicles between links at the node.
  */
@@ -146,9 +160,9 @@ void Node::transfer(){
             chosen_veh->link->capacity_out_remain -= w->delta_n;
 
             // departure curve of the old link
-            chosen_veh->link->departure_curve[w->timestep] += w->delta_n;
+            chosen_veh->link->departure_curve.add(w->timestep, w->delta_n);
             // arrival curve of the new link
-            outlink->arrival_curve[w->timestep] += w->delta_n;
+            outlink->arrival_curve.add(w->timestep, w->delta_n);
 
             // record travel time
             chosen_veh->record_travel_time(chosen_veh->link, (double)w->timestep * w->delta_t);
@@ -175,6 +189,7 @@ void Node::transfer(){
 
             // remove chosen_veh from incoming_vehicles
             remove_from_vector(incoming_vehicles, chosen_veh);
+            w->count_transfers++;
         }
     }
 
@@ -226,6 +241,7 @@ Link::Link(
     }
     delta = 1.0/kappa;
     tau = w->tau;
+    traveltime_last = -1.0;
 
     backward_wave_speed = 1/tau/kappa;
     capacity = vmax*backward_wave_speed*kappa/(vmax+backward_wave_speed);
@@ -235,14 +251,10 @@ Link::Link(
     }
     capacity_out_remain = capacity_out*w->delta_t;
 
-    start_node = w->nodes_map[start_node_name];
-    end_node = w->nodes_map[end_node_name];
-
-    arrival_curve.resize(w->total_timesteps, 0.0);
-    departure_curve.resize(w->total_timesteps, 0.0);
+    start_node = w->find_node(start_node_name);
+    end_node = w->find_node(end_node_name);
 
-    traveltime_real.resize(w->total_timesteps, 0.0);
-    traveltime_instant.resize(w->total_timesteps, 0.0);
+    init_series(w->rolling_window);
 
     // Insert self into global vectors
     start_node->out_links.push_back(this);
@@ -250,7 +262,9 @@ Link::Link(
 
     w->links.push_back(this);
     w->link_id++;
-    w->links_map[link_name] = this;
+    if (!w->network){
+        w->links_map[link_name] = this;
+    }
 }
 
 /**
@@ -260,8 +274,8 @@ void Link::update(){
     set_travel_time();
 
     if (w->timestep != 0){
-        arrival_curve[w->timestep] = arrival_curve[w->timestep-1];
-        departure_curve[w->timestep] = departure_curve[w->timestep-1];
+        arrival_curve.set(w->timestep, arrival_curve.get(w->timestep-1));
+        departure_curve.set(w->timestep, departure_curve.get(w->timestep-1));
     }
 
     if (capacity_out < 10e9 ){
@@ -278,10 +292,10 @@ void Link::update(){
  */
 void Link::set_travel_time(){
     // last vehicle's real travel time
-    if (!traveltime_tt.empty() && !vehicles.empty()){
-        traveltime_real[w->timestep] = (double)traveltime_tt.back();
+    if (traveltime_last >= 0.0 && !vehicles.empty()){
+        traveltime_real.set(w->timestep, traveltime_last);
     }else{
-        traveltime_real[w->timestep] = (double)length / (double)vmax;
+        traveltime_real.set(w->timestep, (double)length / (double)vmax);
     }
 
     // instantaneous travel time = length / average speed
@@ -292,13 +306,389 @@ void Link::set_travel_time(){
         }
         double avg_v = vsum / (double)vehicles.size();
         if (avg_v > vmax / 10.0){
-            traveltime_instant[w->timestep] = (double)length / avg_v;
+            traveltime_instant.set(w->timestep, (double)length / avg_v);
         }else{
-            traveltime_instant[w->timestep] = (double)length / (vmax / 10.0);
+            traveltime_instant.set(w->timestep, (double)length / (vmax / 10.0));
         }
     }else{
-        traveltime_instant[w->timestep] = (double)length / (double)vmax;
+        traveltime_instant.set(w->timestep, (double)length / (double)vmax);
+    }
+}
+
+/**
+ * @brief Fill the link state for timesteps in which no vehicle exists in the whole network.
+ * 
+ * @param ts_from The first timestep to fill.
+ * @param ts_to The timestep after the last one to fill.
+ */
+void Link::fill_idle(size_t ts_from, size_t ts_to){
+    if (ts_from >= ts_to){
+        return;
+    }
+    double tt_free = (double)length / (double)vmax;
+    double arrival = ts_from == 0 ? arrival_curve.get(0) : arrival_curve.get(ts_from-1);
+    double departure = ts_from == 0 ? departure_curve.get(0) : departure_curve.get(ts_from-1);
+    for (size_t ts = ts_from; ts < ts_to; ts++){
+        traveltime_real.set(ts, tt_free);
+        traveltime_instant.set(ts, tt_free);
+        arrival_curve.set(ts, arrival);
+        departure_curve.set(ts, departure);
+    }
+
+    if (capacity_out < 10e9 ){
+        for (size_t ts = ts_from; ts < ts_to && capacity_out_remain < w->delta_n; ts++){
+            capacity_out_remain += capacity_out*w->delta_t;
+        }
+    } else {
+        capacity_out_remain = 10e9;
+    }
+}
+
+/**
+ * @brief Allocate the time series of the link.
+ * 
+ * @param window The number of timesteps kept in rolling mode. 0 means dense mode.
+ */
+void Link::init_series(size_t window){
+    arrival_curve.init(w->total_timesteps, window, w->series_mode);
+    departure_curve.init(w->total_timesteps, window, w->series_mode);
+    traveltime_real.init(w->total_timesteps, window, w->series_mode);
+    traveltime_instant.init(w->total_timesteps, window, w->series_mode);
+}
+
+/**
+ * @brief Return the link to the initial state while keeping its parameters and allocations.
+ */
+void Link::reset(){
+    vehicles.clear();
+    traveltime_tt.clear();
+    traveltime_t.clear();
+    traveltime_last = -1.0;
+    traveltime_interval_count.clear();
+    traveltime_interval_sum.clear();
+    traveltime_sketch.clear();
+    init_series(w->rolling_window);
+    capacity_out_remain = (capacity_out < 0.0 ? 10e10 : capacity_out)*w->delta_t;
+}
+
+/**
+ * @brief Record the travel time of a traversal in the interval stats and the quantile sketch.
+ * 
+ * @param t The time the vehicle left the link.
+ * @param tt The travel time.
+ */
+void Link::add_traveltime_sample(double t, double tt){
+    traveltime_last = tt;
+    size_t k = w->timestep / w->traveltime_stats_interval;
+    if (k >= traveltime_interval_count.size()){
+        traveltime_interval_count.resize(k + 1, 0.0);
+        traveltime_interval_sum.resize(k + 1, 0.0);
+    }
+    traveltime_interval_count[k] += w->delta_n;
+    traveltime_interval_sum[k] += tt * w->delta_n;
+    traveltime_sketch.add(tt, w->delta_n);
+    if (w->traveltime_keep_samples){
+        traveltime_t.push_back(t);
+        traveltime_tt.push_back(tt);
+    }
+}
+
+/**
+ * @brief Estimate a quantile of the travel times of the traversals so far.
+ * 
+ * @param q The quantile in [0, 1].
+ * @return double NaN if no vehicle has traversed the link.
+ */
+double Link::traveltime_quantile(double q) const {
+    return traveltime_sketch.quantile(q);
+}
+
+/**
+ * @brief Get the experienced travel time of a vehicle entering the link at a time, from the cumulative curves.
+ * 
+ * The travel time is the time until the departure curve reaches the arrival curve at the entry. It is the free flow travel time if no vehicle has entered by then or the time is out of the recorded series, and at least the free flow travel time otherwise. Entry time plus travel time is nondecreasing in the entry time (FIFO).
+ * 
+ * @param t The entry time.
+ * @return double
+ */
+double Link::entry_traveltime(double t) const {
+    double tt_free = length / vmax;
+    if (!(t >= 0.0)){
+        return tt_free;
+    }
+    size_t ts = (size_t)(t / w->delta_t);
+    size_t ts_end = std::min(w->timestep, w->total_timesteps);
+    if (ts >= ts_end || !arrival_curve.contains(ts) || !departure_curve.contains(ts)){
+        return tt_free;
+    }
+    double arrivals = arrival_curve.at(ts);
+    if (arrivals == 0.0){
+        return tt_free;
+    }
+    // the first timestep at which the departure curve reaches `arrivals`, ts_end if none
+    size_t lo = ts, hi = ts_end;
+    while (lo < hi){
+        size_t mid = lo + (hi - lo) / 2;
+        if (departure_curve.at(mid) < arrivals){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return std::max(tt_free, (double)(lo - ts) * w->delta_t);
+}
+
+/**
+ * @brief Get the average inflow of the link between two times.
+ * 
+ * @param t1 The start time.
+ * @param t2 The end time.
+ * @return double
+ */
+double Link::inflow(double t1, double t2){
+    return (arrival_curve.at((size_t)(t2/w->delta_t)) - arrival_curve.at((size_t)(t1/w->delta_t)))/(t2-t1);
+}
+
+/**
+ * @brief Get the average outflow of the link between two times.
+ * 
+ * @param t1 The start time.
+ * @param t2 The end time.
+ * @return double
+ */
+double Link::outflow(double t1, double t2){
+    return (departure_curve.at((size_t)(t2/w->delta_t)) - departure_curve.at((size_t)(t1/w->delta_t)))/(t2-t1);
+}
+
+// -----------------------------------------------------------------------
+// MARK: LinkSeries 
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Allocate the series.
+ * 
+ * @param length The number of timesteps of the whole simulation.
+ * @param window The number of timesteps kept in rolling mode. 0 means dense mode. It is ignored in compressed modes.
+ * @param mode The storage mode in `SeriesMode`.
+ */
+void LinkSeries::init(size_t length, size_t window, int mode){
+    this->length = length;
+    this->mode = mode;
+    ts_latest = 0;
+    value_latest = 0.0;
+    bp_ts.clear();
+    bp_value.clear();
+    bp_value32.clear();
+    if (mode != smDENSE){
+        this->window = 0;
+        data.clear();
+        data.shrink_to_fit();
+        return;
+    }
+    this->window = window < length ? window : 0;
+    data.assign(this->window ? this->window : length, 0.0);
+}
+
+/**
+ * @brief Get the value at the timestep in compressed modes by binary search over the breakpoints.
+ * 
+ * @param ts The timestep.
+ * @return double
+ */
+double LinkSeries::get_compressed(size_t ts) const {
+    if (bp_ts.empty() || ts > ts_latest){
+        return 0.0;
+    }
+    if (ts >= bp_ts.back()){
+        return value_latest;
+    }
+    auto it = std::upper_bound(bp_ts.begin(), bp_ts.end(), (uint32_t)ts);
+    if (it == bp_ts.begin()){
+        return 0.0;
+    }
+    return breakpoint_value(it - bp_ts.begin() - 1);
+}
+
+/**
+ * @brief Set the value at the timestep in compressed modes. A breakpoint is added only if the stored value changes.
+ * 
+ * @param ts The timestep. It must not be before the latest written timestep.
+ * @param value The value.
+ */
+void LinkSeries::set_compressed(size_t ts, double value){
+    if (ts < ts_latest){
+        throw std::logic_error("A compressed link series must be written in the order of time");
+    }
+    double stored = (mode == smCOMPRESSED_F32) ? (double)(float)value : value;
+    size_t n = bp_ts.size();
+    if (n > 0 && bp_ts.back() == ts){
+        // overwrite the breakpoint of this timestep, or drop it if the value returns to the previous one
+        double prev = n >= 2 ? breakpoint_value(n-2) : 0.0;
+        if (stored == prev){
+            bp_ts.pop_back();
+            if (mode == smCOMPRESSED_F32) bp_value32.pop_back(); else bp_value.pop_back();
+        } else if (mode == smCOMPRESSED_F32){
+            bp_value32.back() = (float)value;
+        } else {
+            bp_value.back() = value;
+        }
+    } else if (stored != (n > 0 ? breakpoint_value(n-1) : 0.0)){
+        bp_ts.push_back((uint32_t)ts);
+        if (mode == smCOMPRESSED_F32) bp_value32.push_back((float)value); else bp_value.push_back(value);
+    }
+    value_latest = value;
+    ts_latest = ts;
+}
+
+/**
+ * @brief Get the oldest timestep kept in the series.
+ * 
+ * @return size_t
+ */
+size_t LinkSeries::first_timestep() const {
+    if (window && ts_latest + 1 > window){
+        return ts_latest + 1 - window;
+    }
+    return 0;
+}
+
+/**
+ * @brief Check whether the value at the timestep is kept in the series.
+ * 
+ * @param ts The timestep.
+ * @return bool
+ */
+bool LinkSeries::contains(size_t ts) const {
+    return ts < length && ts >= first_timestep();
+}
+
+/**
+ * @brief Get the value at the timestep with range check.
+ * 
+ * @param ts The timestep.
+ * @return double
+ */
+double LinkSeries::at(size_t ts) const {
+    if (!contains(ts)){
+        throw std::out_of_range("timestep " + std::to_string(ts) + " is out of the range of link series");
+    }
+    if (window && ts > ts_latest){
+        return 0.0;
+    }
+    return get(ts);
+}
+
+/**
+ * @brief Get the values in the range of timesteps.
+ * 
+ * @param ts_start The first timestep.
+ * @param ts_end The timestep after the last one.
+ * @return vector<double>
+ */
+vector<double> LinkSeries::range(size_t ts_start, size_t ts_end) const {
+    vector<double> ret;
+    if (ts_end <= ts_start){
+        return ret;
+    }
+    ret.reserve(ts_end - ts_start);
+    if (mode != smDENSE){
+        if (!contains(ts_start) || !contains(ts_end - 1)){
+            throw std::out_of_range("timesteps [" + std::to_string(ts_start) + ", " + std::to_string(ts_end) + ") are out of the range of link series");
+        }
+        // walk the breakpoints instead of searching for each timestep
+        size_t i = std::upper_bound(bp_ts.begin(), bp_ts.end(), (uint32_t)ts_start) - bp_ts.begin();
+        double value = i == 0 ? 0.0 : breakpoint_value(i-1);
+        for (size_t ts = ts_start; ts < ts_end; ts++){
+            while (i < bp_ts.size() && bp_ts[i] <= ts){
+                value = breakpoint_value(i++);
+            }
+            if (ts > ts_latest || bp_ts.empty()){
+                ret.push_back(0.0);
+            } else {
+                ret.push_back(i == bp_ts.size() ? value_latest : value);
+            }
+        }
+        return ret;
+    }
+    for (size_t ts = ts_start; ts < ts_end; ts++){
+        ret.push_back(at(ts));
+    }
+    return ret;
+}
+
+/**
+ * @brief Get all values kept in the series in the order of time.
+ * 
+ * @return vector<double>
+ */
+vector<double> LinkSeries::to_vector() const {
+    if (mode != smDENSE){
+        return range(0, length);
+    }
+    if (!window){
+        return data;
+    }
+    return range(first_timestep(), ts_latest + 1);
+}
+
+/**
+ * @brief Get the sum of the values in the range of timesteps. Compressed series are integrated over the breakpoints.
+ * 
+ * @param ts_start The first timestep.
+ * @param ts_end The timestep after the last one.
+ * @return double
+ */
+double LinkSeries::sum(size_t ts_start, size_t ts_end) const {
+    if (ts_end <= ts_start){
+        return 0.0;
+    }
+    if (!contains(ts_start) || !contains(ts_end - 1)){
+        throw std::out_of_range("timesteps [" + std::to_string(ts_start) + ", " + std::to_string(ts_end) + ") are out of the range of link series");
+    }
+    double ret = 0.0;
+    if (mode == smDENSE){
+        size_t ts_stop = std::min(ts_end, window ? ts_latest + 1 : ts_end);
+        for (size_t ts = ts_start; ts < ts_stop; ts++){
+            ret += get(ts);
+        }
+        return ret;
+    }
+    if (bp_ts.empty()){
+        return 0.0;
+    }
+    // timesteps after `ts_latest` are 0, and the ones after the last breakpoint have `value_latest`
+    ts_end = std::min(ts_end, ts_latest + 1);
+    size_t i = std::upper_bound(bp_ts.begin(), bp_ts.end(), (uint32_t)ts_start) - bp_ts.begin();
+    size_t ts = ts_start;
+    double value = i == 0 ? 0.0 : breakpoint_value(i-1);
+    while (ts < ts_end){
+        size_t ts_next = i < bp_ts.size() ? std::min((size_t)bp_ts[i], ts_end) : ts_end;
+        ret += (i == bp_ts.size() ? value_latest : value) * (double)(ts_next - ts);
+        ts = ts_next;
+        if (i < bp_ts.size() && ts == bp_ts[i]){
+            value = breakpoint_value(i++);
+        }
     }
+    return ret;
+}
+
+/**
+ * @brief Release the unused capacity of the breakpoints.
+ */
+void LinkSeries::shrink_to_fit(){
+    bp_ts.shrink_to_fit();
+    bp_value.shrink_to_fit();
+    bp_value32.shrink_to_fit();
+}
+
+/**
+ * @brief Get the bytes allocated by the series.
+ * 
+ * @return size_t
+ */
+size_t LinkSeries::bytes() const {
+    return data.capacity() * sizeof(double) + bp_ts.capacity() * sizeof(uint32_t)
+         + bp_value.capacity() * sizeof(double) + bp_value32.capacity() * sizeof(float);
 }
 
 // -----------------------------------------------------------------------
@@ -341,9 +731,11 @@ Vehicle::Vehicle(
       route_choice_flag_on_link(0),
       route_choice_principle(rcpDUO),
       route_adaptive(0.0),
-      route_choice_uncertainty(0.0){
-    orig = w->nodes_map[orig_name];
-    dest = w->nodes_map[dest_name];
+      route_choice_uncertainty(0.0),
+      log_x_last(0.0),
+      archive_index(-1){
+    orig = w->find_node(orig_name);
+    dest = w->find_node(dest_name);
 
     // Initialize link preference
     for (auto ln : w->links){
@@ -351,11 +743,17 @@ Vehicle::Vehicle(
     }
     route_choice_uncertainty = w->route_choice_uncertainty;
 
-    log_t.reserve(w->vehicle_log_reserve_size);
-    log_state.reserve(w->vehicle_log_reserve_size);
-    log_link.reserve(w->vehicle_log_reserve_size);
-    log_x.reserve(w->vehicle_log_reserve_size);
-    log_v.reserve(w->vehicle_log_reserve_size);
+    // deterministic and evenly spaced sampling of logged vehicles
+    log_enabled = floor((double)(id+1) * w->vehicle_log_sample_ratio) > floor((double)id * w->vehicle_log_sample_ratio);
+
+    if (w->vehicle_log_mode == vlmFULL && log_enabled){
+        size_t n = w->vehicle_log_reserve_size;
+        if (w->vehicle_log_fields & vlfT) log_t.reserve(n);
+        if (w->vehicle_log_fields & vlfSTATE) log_state.reserve(n);
+        if (w->vehicle_log_fields & vlfLINK) log_link.reserve(n);
+        if (w->vehicle_log_fields & vlfX) log_x.reserve(n);
+        if (w->vehicle_log_fields & vlfV) log_v.reserve(n);
+    }
 
     w->vehicles.push_back(this);
     w->vehicles_living[id] = this;
@@ -379,6 +777,10 @@ void Vehicle::update(){
         log_data();
     }else if (state == vsRUN){
         log_data();
+        w->record_run_step(this);
+        if (!w->detectors.empty()){
+            w->record_detectors(this);
+        }
         // route choice check
         if (x == 0.0){
             route_choice_flag_on_link = 0;
@@ -394,6 +796,9 @@ void Vehicle::update(){
             if (link->end_node == dest){
                 end_trip();
                 log_data();
+                if (w->vehicle_retire_mode){
+                    retire();
+                }
             }else{
                 route_next_link_choice(link->end_node->out_links);
                 link->end_node->incoming_vehicles.push_back(this);
@@ -410,7 +815,8 @@ void Vehicle::update(){
  */
 void Vehicle::end_trip(){
     state = vsEND;
-    link->departure_curve[w->timestep] += w->delta_n;
+    w->trips_completed += w->delta_n;
+    link->departure_curve.add(w->timestep, w->delta_n);
     record_travel_time(link, (double)w->timestep * w->delta_t);
 
     arrival_time = (double)w->timestep * w->delta_t;
@@ -460,6 +866,7 @@ void Vehicle::car_follow_newell(){
  * @param linkset Available links to choose from.
  */
 void Vehicle::route_next_link_choice(vector<Link*> linkset){
+    w->count_route_choices++;
     if (linkset.empty()){
         // no outgoing link
         route_next_link = nullptr;
@@ -503,8 +910,7 @@ void Vehicle::route_next_link_choice(vector<Link*> linkset){
  */
 void Vehicle::record_travel_time(Link *link, double t){
     if (link != nullptr){
-        link->traveltime_t.push_back(t);
-        link->traveltime_tt.push_back(t - arrival_time_link);
+        link->add_traveltime_sample(t, t - arrival_time_link);
     }
     arrival_time_link = t + 1.0;
 }
@@ -514,342 +920,3227 @@ void Vehicle::record_travel_time(Link *link, double t){
  */
 void Vehicle::log_data(){
     // 各タイムステップのログを push_back で追加する
-    if (w->vehicle_log_mode == 1){
-        log_t.push_back((double)w->timestep * w->delta_t);
-        log_state.push_back(state);
-        if (link) {
-            log_link.push_back(link->id);
-        } else {
-            log_link.push_back(-1);
+    if (w->vehicle_log_mode != vlmNONE && log_enabled){
+        if (state == vsWAIT && !w->vehicle_log_wait){
+            return;
         }
-        log_x.push_back(x);
-        if (link != nullptr && std::fabs(x - (link->length - 1.0)) > 1e-9){
-            log_v.push_back(v);
-        } else {
-            log_v.push_back(0.0);
+        // the end of trip is always recorded
+        if (state != vsEND && w->timestep % w->vehicle_log_interval != 0){
+            return;
         }
-}
-}
 
+        if (w->vehicle_log_mode == vlmCOMPRESSED){
+            if (link != nullptr && std::fabs(x - (link->length - 1.0)) > 1e-9){
+                log_data_compressed(v);
+            } else {
+                log_data_compressed(0.0);
+            }
+            return;
+        }
+
+        int fields = w->vehicle_log_fields;
+        if (fields & vlfT){
+            log_t.push_back((double)w->timestep * w->delta_t);
+        }
+        if (fields & vlfSTATE){
+            log_state.push_back(state);
+        }
+        if (fields & vlfLINK){
+            if (link) {
+                log_link.push_back(link->id);
+            } else {
+                log_link.push_back(-1);
+            }
+        }
+        if (fields & vlfX){
+            log_x.push_back(x);
+        }
+        if (fields & vlfV){
+            if (link != nullptr && std::fabs(x - (link->length - 1.0)) > 1e-9){
+                log_v.push_back(v);
+            } else {
+                log_v.push_back(0.0);
+            }
+        }
+    }
+}
 
-// -----------------------------------------------------------------------
-// MARK: World 
-// -----------------------------------------------------------------------
 
 /**
- * @brief Create a World (simulation environment).
+ * @brief Log vehicle data as breakpoints. A new segment is started only when the current sample cannot be reproduced from the last segment.
  * 
- * @param world_name The name of the world.
- * @param t_max The simulation duration.
- * @param delta_n The platoon size.
- * @param tau The reaction time.
- * @param duo_update_time The time interval for route choice update.
- * @param duo_update_weight The update weight for route choice.
- * @param route_choice_uncertainty The noise in route choice.
- * @param print_mode Whether print the simulation progress or not.
- * @param random_seed The random seed.
- * @param vehicle_log_mode Whether save vehicle data or not.
+ * @param v_log The speed to be logged.
  */
-World::World(
-    const string &world_name,
-    double t_max,
-    double delta_n,
-    double tau,
-    double duo_update_time,
-    double duo_update_weight,
-    double route_choice_uncertainty,
-    int print_mode,
-    long long random_seed,
-    bool vehicle_log_mode)
-    : timestamp(std::chrono::high_resolution_clock::now().time_since_epoch().count()),
-      name(world_name),
-      t_max(t_max),
-      delta_n(delta_n),
-      tau(tau),
-      duo_update_time(duo_update_time),
-      duo_update_weight(duo_update_weight),
-      print_mode(print_mode),
-      delta_t(tau * delta_n),
-      total_timesteps((int)(t_max / (tau * delta_n))),
-      timestep_for_route_update((int)(duo_update_time / (tau * delta_n))),
-      time(0),
-      node_id(0),
-      link_id(0),
-      vehicle_id(0),
-      timestep(0),
-      route_choice_uncertainty(route_choice_uncertainty),
-      random_seed(random_seed),
-      vehicle_log_reserve_size(0),
-      vehicle_log_mode(vehicle_log_mode),
-      ave_v(0.0),
-      ave_vratio(0.0),
-      trips_total(0.0),
-      trips_completed(0.0),
-      rng((std::mt19937::result_type)random_seed),
-      flag_initialized(false),
-      writer(&std::cout){
-}
+void Vehicle::log_data_compressed(double v_log){
+    int ts = (int)w->timestep;
+    int link_id = link ? link->id : -1;
+    int interval = (int)w->vehicle_log_interval;
 
-void World::initialize_adj_matrix(){
-    if (flag_initialized==false){
-        adj_mat.resize(node_id, vector<int>(node_id, 0));
-        adj_mat_time.resize(node_id, vector<double>(node_id, 0.0));
-        for (auto ln : links){
-            int i = ln->start_node->id;
-            int j = ln->end_node->id;
-            adj_mat[i][j] = 1;
-            adj_mat_time[i][j] = ln->length / ln->vmax;
-        }
-
-        route_preference.resize(nodes.size());
-        for (auto nd : nodes){
-            for (auto ln : links){
-                route_preference[nd->id][ln] = 0.0;
+    if (!log_segments.empty()){
+        LogSegment &seg = log_segments.back();
+        if (seg.state == state && seg.link == link_id && seg.v == v_log && ts == seg.ts + seg.count*interval){
+            // candidate increments are the ones used in car_follow_newell, so that the replay is bitwise exact
+            double dx_candidates[2] = {seg.dx, 0.0};
+            int n_candidates = 1;
+            if (seg.count == 1 && link){
+                dx_candidates[1] = link->vmax * w->delta_t;
+                n_candidates = 2;
+            }
+            for (int c = 0; c < n_candidates; c++){
+                double dx = dx_candidates[c];
+                double x_pred = log_x_last;
+                for (int k = 0; k < interval; k++){
+                    x_pred += dx;
+                }
+                if (x_pred == x){
+                    seg.dx = dx;
+                    seg.count++;
+                    log_x_last = x;
+                    return;
+                }
             }
         }
-        flag_initialized = true;
     }
+
+    log_segments.push_back({x, v_log, 0.0, ts, 1, link_id, state});
+    log_x_last = x;
 }
 
-void World::update_adj_time_matrix(){
-    for (auto ln : links){
-        int i = ln->start_node->id;
-        int j = ln->end_node->id;
-        if (ln->traveltime_real[timestep] != 0.0){
-            adj_mat_time[i][j] = ln->traveltime_real[timestep];
-        }else{
-            adj_mat_time[i][j] = ln->length / ln->vmax;
-        }
+/**
+ * @brief Move the logs and name of a finished vehicle to the world-level archive and release its per-vehicle transient state.
+ */
+void Vehicle::retire(){
+    if (archive_index >= 0){
+        return;
     }
+    w->vehicles_map.erase(name);
+    archive_index = w->vehicle_archive.append(this);
+
+    string().swap(name);
+    map<Link *, double>().swap(route_preference);
+    vector<double>().swap(log_t);
+    vector<int>().swap(log_state);
+    vector<int>().swap(log_link);
+    vector<double>().swap(log_x);
+    vector<double>().swap(log_v);
+    vector<LogSegment>().swap(log_segments);
 }
 
-pair<vector<vector<double>>, vector<vector<int>>> 
-  World::route_search_all(const vector<vector<double>> &adj, double infty) {
-    int nsize = (int)adj.size();
+/**
+ * @brief Return the vehicle to the state before departure while keeping its trip definition and log allocations.
+ */
+void Vehicle::reset(){
+    if (archive_index >= 0){
+        name = string(name_view());
+        archive_index = -1;
+    }
+    link = nullptr;
+    x = 0.0;
+    x_next = 0.0;
+    v = 0.0;
+    leader = nullptr;
+    follower = nullptr;
+    state = vsHOME;
+    arrival_time = 0.0;
+    travel_time = 0.0;
+    arrival_time_link = 0.0;
+    route_next_link = nullptr;
+    route_choice_flag_on_link = 0;
+    route_adaptive = 0.0;
+    for (auto ln : w->links){
+        route_preference[ln] = 0.0;
+    }
+    log_t.clear();
+    log_state.clear();
+    log_link.clear();
+    log_x.clear();
+    log_v.clear();
+    log_segments.clear();
+    log_x_last = 0.0;
+}
+
+/**
+ * @brief Get the name of the vehicle, including retired ones.
+ * 
+ * @return std::string_view
+ */
+std::string_view Vehicle::name_view() const {
+    if (archive_index >= 0 && name.empty()){
+        return w->vehicle_archive.get_name(archive_index);
+    }
+    return name;
+}
+
+/**
+ * @brief Set the name of the vehicle. The name of a retired vehicle is stored in the archive and cannot be changed.
+ * 
+ * @param new_name The new name.
+ */
+void Vehicle::set_name(const string &new_name){
+    if (archive_index >= 0){
+        throw std::runtime_error("The name of retired vehicle `" + string(name_view()) + "` cannot be changed");
+    }
+    name = new_name;
+}
+
+/**
+ * @brief Get the range of log segments in compressed log mode, including retired vehicles.
+ * 
+ * @return pair<const LogSegment *, const LogSegment *> The first and past-the-end segments.
+ */
+pair<const LogSegment *, const LogSegment *> Vehicle::get_log_segments() const {
+    if (archive_index >= 0){
+        const VehicleArchive &ar = w->vehicle_archive;
+        if ((size_t)archive_index < ar.spilled_count){
+            return {nullptr, nullptr};
+        }
+        return {ar.log_segments.data() + (ar.offsets[archive_index] - ar.column_base),
+                ar.log_segments.data() + (ar.offsets[archive_index+1] - ar.column_base)};
+    }
+    return {log_segments.data(), log_segments.data() + log_segments.size()};
+}
+
+/**
+ * @brief Get the time of each log sample. Compressed logs are expanded.
+ * 
+ * @return vector<double>
+ */
+vector<double> Vehicle::get_log_t(){
+    if (w->vehicle_log_mode != vlmCOMPRESSED){
+        if (archive_index >= 0){
+            return w->vehicle_archive.slice(w->vehicle_archive.log_t, archive_index);
+        }
+        return log_t;
+    }
+    vector<double> ret;
+    if (!(w->vehicle_log_fields & vlfT)){
+        return ret;
+    }
+    auto [seg_begin, seg_end] = get_log_segments();
+    for (auto seg = seg_begin; seg != seg_end; seg++){
+        for (int i = 0; i < seg->count; i++){
+            size_t ts = (size_t)seg->ts + (size_t)i*w->vehicle_log_interval;
+            ret.push_back((double)ts * w->delta_t);
+        }
+    }
+    return ret;
+}
+
+/**
+ * @brief Get the state of each log sample. Compressed logs are expanded.
+ * 
+ * @return vector<int>
+ */
+vector<int> Vehicle::get_log_state(){
+    if (w->vehicle_log_mode != vlmCOMPRESSED){
+        if (archive_index >= 0){
+            return w->vehicle_archive.slice(w->vehicle_archive.log_state, archive_index);
+        }
+        return log_state;
+    }
+    vector<int> ret;
+    if (!(w->vehicle_log_fields & vlfSTATE)){
+        return ret;
+    }
+    auto [seg_begin, seg_end] = get_log_segments();
+    for (auto seg = seg_begin; seg != seg_end; seg++){
+        ret.insert(ret.end(), seg->count, seg->state);
+    }
+    return ret;
+}
+
+/**
+ * @brief Get the link id of each log sample. Compressed logs are expanded.
+ * 
+ * @return vector<int>
+ */
+vector<int> Vehicle::get_log_link(){
+    if (w->vehicle_log_mode != vlmCOMPRESSED){
+        if (archive_index >= 0){
+            return w->vehicle_archive.slice(w->vehicle_archive.log_link, archive_index);
+        }
+        return log_link;
+    }
+    vector<int> ret;
+    if (!(w->vehicle_log_fields & vlfLINK)){
+        return ret;
+    }
+    auto [seg_begin, seg_end] = get_log_segments();
+    for (auto seg = seg_begin; seg != seg_end; seg++){
+        ret.insert(ret.end(), seg->count, seg->link);
+    }
+    return ret;
+}
+
+/**
+ * @brief Get the position of each log sample. Compressed logs are expanded.
+ * 
+ * @return vector<double>
+ */
+vector<double> Vehicle::get_log_x(){
+    if (w->vehicle_log_mode != vlmCOMPRESSED){
+        if (archive_index >= 0){
+            return w->vehicle_archive.slice(w->vehicle_archive.log_x, archive_index);
+        }
+        return log_x;
+    }
+    vector<double> ret;
+    if (!(w->vehicle_log_fields & vlfX)){
+        return ret;
+    }
+    auto [seg_begin, seg_end] = get_log_segments();
+    for (auto seg = seg_begin; seg != seg_end; seg++){
+        double x_cur = seg->x;
+        ret.push_back(x_cur);
+        for (int i = 1; i < seg->count; i++){
+            for (size_t k = 0; k < w->vehicle_log_interval; k++){
+                x_cur += seg->dx;
+            }
+            ret.push_back(x_cur);
+        }
+    }
+    return ret;
+}
+
+/**
+ * @brief Get the speed of each log sample. Compressed logs are expanded.
+ * 
+ * @return vector<double>
+ */
+vector<double> Vehicle::get_log_v(){
+    if (w->vehicle_log_mode != vlmCOMPRESSED){
+        if (archive_index >= 0){
+            return w->vehicle_archive.slice(w->vehicle_archive.log_v, archive_index);
+        }
+        return log_v;
+    }
+    vector<double> ret;
+    if (!(w->vehicle_log_fields & vlfV)){
+        return ret;
+    }
+    auto [seg_begin, seg_end] = get_log_segments();
+    for (auto seg = seg_begin; seg != seg_end; seg++){
+        ret.insert(ret.end(), seg->count, seg->v);
+    }
+    return ret;
+}
+
+// -----------------------------------------------------------------------
+// MARK: VehicleArchive
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Append the logs and name of a vehicle to the archive.
+ * 
+ * @param veh The vehicle.
+ * @return int The index of the record.
+ */
+int VehicleArchive::append(const Vehicle *veh){
+    if (offsets.empty()){
+        offsets.push_back(column_base);
+        name_offsets.push_back(0);
+    }
+    log_t.insert(log_t.end(), veh->log_t.begin(), veh->log_t.end());
+    log_state.insert(log_state.end(), veh->log_state.begin(), veh->log_state.end());
+    log_link.insert(log_link.end(), veh->log_link.begin(), veh->log_link.end());
+    log_x.insert(log_x.end(), veh->log_x.begin(), veh->log_x.end());
+    log_v.insert(log_v.end(), veh->log_v.begin(), veh->log_v.end());
+    log_segments.insert(log_segments.end(), veh->log_segments.begin(), veh->log_segments.end());
+
+    // every recorded field has the same length
+    size_t n = std::max({veh->log_t.size(), veh->log_state.size(), veh->log_link.size(), veh->log_x.size(), veh->log_v.size(), veh->log_segments.size()});
+    offsets.push_back(offsets.back() + n);
+
+    names += veh->name;
+    name_offsets.push_back(names.size());
+    vehicle_ids.push_back(veh->id);
+
+    return (int)offsets.size() - 2;
+}
+
+/**
+ * @brief Drop the logs of all records while keeping their names.
+ */
+void VehicleArchive::spill(){
+    spilled_count = size();
+    column_base = offsets.empty() ? 0 : offsets.back();
+    vector<double>().swap(log_t);
+    vector<int>().swap(log_state);
+    vector<int>().swap(log_link);
+    vector<double>().swap(log_x);
+    vector<double>().swap(log_v);
+    vector<LogSegment>().swap(log_segments);
+}
+
+/**
+ * @brief Remove all records while keeping the allocations.
+ */
+void VehicleArchive::clear(){
+    offsets.clear();
+    log_t.clear();
+    log_state.clear();
+    log_link.clear();
+    log_x.clear();
+    log_v.clear();
+    log_segments.clear();
+    names.clear();
+    name_offsets.clear();
+    vehicle_ids.clear();
+    spilled_count = 0;
+    column_base = 0;
+}
+
+/**
+ * @brief Get the name of an archived vehicle.
+ * 
+ * @param index The index of the record.
+ * @return std::string_view
+ */
+std::string_view VehicleArchive::get_name(int index) const {
+    return std::string_view(names).substr(name_offsets[index], name_offsets[index+1] - name_offsets[index]);
+}
+
+/**
+ * @brief Release the spare capacity of the archive.
+ */
+void VehicleArchive::shrink_to_fit(){
+    offsets.shrink_to_fit();
+    log_t.shrink_to_fit();
+    log_state.shrink_to_fit();
+    log_link.shrink_to_fit();
+    log_x.shrink_to_fit();
+    log_v.shrink_to_fit();
+    log_segments.shrink_to_fit();
+    names.shrink_to_fit();
+    name_offsets.shrink_to_fit();
+    vehicle_ids.shrink_to_fit();
+}
+
+/**
+ * @brief Get the number of archived vehicles.
+ * 
+ * @return size_t
+ */
+size_t VehicleArchive::size() const {
+    return offsets.empty() ? 0 : offsets.size() - 1;
+}
+
+// -----------------------------------------------------------------------
+// MARK: World 
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Create a World (simulation environment).
+ * 
+ * @param world_name The name of the world.
+ * @param t_max The simulation duration.
+ * @param delta_n The platoon size.
+ * @param tau The reaction time.
+ * @param duo_update_time The time interval for route choice update.
+ * @param duo_update_weight The update weight for route choice.
+ * @param route_choice_uncertainty The noise in route choice.
+ * @param print_mode Whether print the simulation progress or not.
+ * @param random_seed The random seed.
+ * @param vehicle_log_mode Whether save vehicle data or not. 0: no log, 1: log every sample, 2: compressed log of breakpoints.
+ */
+World::World(
+    const string &world_name,
+    double t_max,
+    double delta_n,
+    double tau,
+    double duo_update_time,
+    double duo_update_weight,
+    double route_choice_uncertainty,
+    int print_mode,
+    long long random_seed,
+    int vehicle_log_mode)
+    : timestamp(std::chrono::high_resolution_clock::now().time_since_epoch().count()),
+      name(world_name),
+      t_max(t_max),
+      delta_n(delta_n),
+      tau(tau),
+      duo_update_time(duo_update_time),
+      duo_update_weight(duo_update_weight),
+      print_mode(print_mode),
+      delta_t(tau * delta_n),
+      total_timesteps((int)(t_max / (tau * delta_n))),
+      timestep_for_route_update((int)(duo_update_time / (tau * delta_n))),
+      time(0),
+      node_id(0),
+      link_id(0),
+      vehicle_id(0),
+      timestep(0),
+      route_choice_uncertainty(route_choice_uncertainty),
+      random_seed(random_seed),
+      vehicle_log_reserve_size(0),
+      vehicle_log_mode(vehicle_log_mode),
+      vehicle_log_interval(1),
+      vehicle_log_sample_ratio(1.0),
+      vehicle_log_fields(vlfALL),
+      vehicle_log_wait(true),
+      vehicle_retire_mode(false),
+      rolling_window(0),
+      rolling_spilled_until(0),
+      ave_v(0.0),
+      ave_vratio(0.0),
+      trips_total(0.0),
+      trips_completed(0.0),
+      rng((std::mt19937::result_type)random_seed),
+      flag_initialized(false),
+      writer(&std::cout),
+      idle_skip_mode(true){
+    traveltime_stats_interval = std::max((size_t)1, timestep_for_route_update);
+}
+
+/**
+ * @brief Destroy the World and all nodes, links and vehicles owned by it.
+ */
+World::~World(){
+    route_search_wait();
+    vehicle_pool.clear();
+    link_pool.clear();
+    node_pool.clear();
+}
+
+/**
+ * @brief Create a node owned by the world.
+ * 
+ * @param node_name The name of the node.
+ * @param x The x-coordinate of the node.
+ * @param y The y-coordinate of the node.
+ * @param signal_intervals A list representing the signal at the node.
+ * @param signal_offset The offset of the signal.
+ * @return Node* The created node.
+ */
+Node *World::add_node(
+        const string &node_name,
+        double x,
+        double y,
+        vector<double> signal_intervals,
+        double signal_offset){
+    if (network){
+        throw std::runtime_error("Cannot add node `" + node_name + "` to a World whose network is frozen");
+    }
+    return node_pool.create(this, node_name, x, y, signal_intervals, signal_offset);
+}
+
+/**
+ * @brief Create a link owned by the world.
+ * 
+ * @param link_name The name of the link.
+ * @param start_node_name The name of the start node.
+ * @param end_node_name The name of the end node.
+ * @param vmax The free flow speed on the link.
+ * @param kappa The jam density on the link.
+ * @param length The length of the link.
+ * @param merge_priority The priority of the link when merging.
+ * @param capacity_out The capacity out of the link.
+ * @param signal_group The signal group(s) to which the link belongs.
+ * @return Link* The created link.
+ */
+Link *World::add_link(
+        const string &link_name,
+        const string &start_node_name,
+        const string &end_node_name,
+        double vmax,
+        double kappa,
+        double length,
+        double merge_priority,
+        double capacity_out,
+        vector<int> signal_group){
+    if (network){
+        throw std::runtime_error("Cannot add link `" + link_name + "` to a World whose network is frozen");
+    }
+    return link_pool.create(this, link_name, start_node_name, end_node_name,
+        vmax, kappa, length, merge_priority, capacity_out, signal_group);
+}
+
+/**
+ * @brief Create a vehicle owned by the world.
+ * 
+ * @param vehicle_name The name of the vehicle.
+ * @param departure_time The departure time of the vehicle.
+ * @param orig_name The origin node.
+ * @param dest_name The destination node.
+ * @return Vehicle* The created vehicle.
+ */
+Vehicle *World::add_vehicle(
+        const string &vehicle_name,
+        double departure_time,
+        const string &orig_name,
+        const string &dest_name){
+    return vehicle_pool.create(this, vehicle_name, departure_time, orig_name, dest_name);
+}
+
+/**
+ * @brief Set the policy of vehicle logging. It must be set before the simulation starts.
+ * 
+ * `sample_ratio` and `reserve_size` apply to vehicles added after this call. The other settings are read at every step and apply to all vehicles.
+ * 
+ * @param interval Log every `interval` timesteps. The end of trip is always logged.
+ * @param sample_ratio The ratio of vehicles to be logged in [0, 1]. Vehicles are sampled deterministically by their id.
+ * @param fields The fields to be recorded, a combination of `VehicleLogField` flags.
+ * @param log_wait Whether log vehicles waiting at the origin or not.
+ * @param reserve_size The initial capacity of each log vector.
+ */
+void World::set_vehicle_log_policy(
+        size_t interval,
+        double sample_ratio,
+        int fields,
+        bool log_wait,
+        size_t reserve_size){
+    if (timestep != 0){
+        throw std::runtime_error("The vehicle log policy must be set before the simulation starts");
+    }
+    if (interval == 0){
+        throw std::runtime_error("`interval` of vehicle log policy must be positive");
+    }
+    if (!(sample_ratio >= 0.0 && sample_ratio <= 1.0)){
+        throw std::invalid_argument("`sample_ratio` of vehicle log policy must be in [0, 1]");
+    }
+    vehicle_log_interval = interval;
+    vehicle_log_sample_ratio = sample_ratio;
+    vehicle_log_fields = fields & vlfALL;
+    vehicle_log_wait = log_wait;
+    vehicle_log_reserve_size = reserve_size;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Network
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Get the id of a node by name.
+ * 
+ * @param node_name The name of the node.
+ * @return int The id, or -1 if not found.
+ */
+int Network::find_node(const string &node_name) const {
+    auto it = node_ids.find(node_name);
+    return it == node_ids.end() ? -1 : it->second;
+}
+
+/**
+ * @brief Get the id of a link by name.
+ * 
+ * @param link_name The name of the link.
+ * @return int The id, or -1 if not found.
+ */
+int Network::find_link(const string &link_name) const {
+    auto it = link_ids.find(link_name);
+    return it == link_ids.end() ? -1 : it->second;
+}
+
+/**
+ * @brief Freeze the network topology of the world so that it can be shared by other Worlds.
+ * 
+ * Nodes and links cannot be added afterwards. It is called by `initialize_adj_matrix` automatically.
+ * 
+ * @return std::shared_ptr<const Network> The frozen network.
+ */
+std::shared_ptr<const Network> World::freeze_network(){
+    if (network){
+        return network;
+    }
+    auto net = std::make_shared<Network>();
+    net->nodes.reserve(nodes.size());
+    for (auto nd : nodes){
+        net->nodes.push_back({nd->name, nd->x, nd->y, nd->signal_intervals, nd->signal_offset});
+        net->node_ids[nd->name] = nd->id;
+    }
+    net->links.reserve(links.size());
+    net->successors.resize(nodes.size());
+    for (auto ln : links){
+        net->links.push_back({ln->name, ln->start_node->id, ln->end_node->id, ln->vmax, ln->kappa, ln->length, ln->merge_priority, ln->capacity_out, ln->signal_group});
+        net->link_ids[ln->name] = ln->id;
+        net->successors[ln->start_node->id].push_back(ln->end_node->id);
+    }
+    for (auto &succ : net->successors){
+        std::sort(succ.begin(), succ.end());
+        succ.erase(std::unique(succ.begin(), succ.end()), succ.end());
+    }
+    network = net;
+
+    // name lookups go through the network from now on
+    unordered_map<string, Node *>().swap(nodes_map);
+    unordered_map<string, Link *>().swap(links_map);
+    return network;
+}
+
+/**
+ * @brief Instantiate nodes and links of the world from a frozen network shared with other Worlds.
+ * 
+ * The world must not have any nodes or links. Only per-run state is allocated; definitions, name maps and adjacency lists are shared.
+ * 
+ * @param net The frozen network.
+ */
+void World::attach_network(std::shared_ptr<const Network> net){
+    if (!nodes.empty() || !links.empty() || !vehicles.empty()){
+        throw std::runtime_error("A network can only be attached to an empty World");
+    }
+    network = net;
+    for (const auto &spec : net->nodes){
+        node_pool.create(this, spec.name, spec.x, spec.y, spec.signal_intervals, spec.signal_offset);
+    }
+    for (const auto &spec : net->links){
+        link_pool.create(this, spec.name, net->nodes[spec.start_node].name, net->nodes[spec.end_node].name,
+            spec.vmax, spec.kappa, spec.length, spec.merge_priority, spec.capacity_out, spec.signal_group);
+    }
+}
+
+/**
+ * @brief Find a node by name.
+ * 
+ * @param node_name The name of the node.
+ * @return Node* The node, or nullptr if not found.
+ */
+Node *World::find_node(const string &node_name){
+    if (network){
+        int id = network->find_node(node_name);
+        return id >= 0 ? nodes[id] : nullptr;
+    }
+    auto it = nodes_map.find(node_name);
+    return it == nodes_map.end() ? nullptr : it->second;
+}
+
+/**
+ * @brief Find a link by name.
+ * 
+ * @param link_name The name of the link.
+ * @return Link* The link, or nullptr if not found.
+ */
+Link *World::find_link(const string &link_name){
+    if (network){
+        int id = network->find_link(link_name);
+        return id >= 0 ? links[id] : nullptr;
+    }
+    auto it = links_map.find(link_name);
+    return it == links_map.end() ? nullptr : it->second;
+}
+
+void World::initialize_adj_matrix(){
+    if (flag_initialized==false){
+        freeze_network();
+        adj_mat_time.resize(node_id, vector<double>(node_id, 0.0));
+        for (auto ln : links){
+            int i = ln->start_node->id;
+            int j = ln->end_node->id;
+            adj_mat_time[i][j] = ln->length / ln->vmax;
+        }
+
+        route_preference.resize(nodes.size());
+        for (auto nd : nodes){
+            for (auto ln : links){
+                route_preference[nd->id][ln] = 0.0;
+            }
+        }
+        flag_initialized = true;
+    }
+}
+
+void World::update_adj_time_matrix(){
+    size_t k = timestep_for_route_update > 0 ? timestep / timestep_for_route_update : 0;
+    const vector<double> *profile = k < route_traveltime_profile.size() ? &route_traveltime_profile[k] : nullptr;
+    for (auto ln : links){
+        int i = ln->start_node->id;
+        int j = ln->end_node->id;
+        if (profile && (*profile)[ln->id] > 0.0){
+            adj_mat_time[i][j] = (*profile)[ln->id];
+        }else if (ln->traveltime_real.get(timestep) != 0.0){
+            adj_mat_time[i][j] = ln->traveltime_real.get(timestep);
+        }else{
+            adj_mat_time[i][j] = ln->length / ln->vmax;
+        }
+    }
+}
+
+pair<vector<vector<double>>, vector<vector<int>>> 
+  World::route_search_all(const vector<vector<double>> &adj, double infty) {
+    int nsize = (int)adj.size();
     if (std::fabs(infty) < 1e-9) {
         infty = 1e15;
     }
 
-    // 隣接リストの構築: pair<隣接ノード, 重み>
-    vector<vector<pair<int, double>>> adj_list(nsize);
-    for (int i = 0; i < nsize; i++) {
-        for (int j = 0; j < nsize; j++) {
-            if (adj[i][j] > 0.0) {
-                adj_list[i].push_back({j, adj[i][j]});
-            }
-        }
+    // 隣接リストの構築: pair<隣接ノード, 重み>
+    // ネットワークが凍結済みなら、共有されている後続ノードのリストだけを走査する
+    vector<vector<pair<int, double>>> adj_list(nsize);
+    bool use_successors = network && (int)network->successors.size() == nsize;
+    for (int i = 0; i < nsize; i++) {
+        if (use_successors) {
+            for (int j : network->successors[i]) {
+                if (adj[i][j] > 0.0) {
+                    adj_list[i].push_back({j, adj[i][j]});
+                }
+            }
+        } else {
+            for (int j = 0; j < nsize; j++) {
+                if (adj[i][j] > 0.0) {
+                    adj_list[i].push_back({j, adj[i][j]});
+                }
+            }
+        }
+    }
+
+    vector<vector<double>> dist(nsize, vector<double>(nsize, infty));
+    vector<vector<int>> next_hop(nsize, vector<int>(nsize, -1));
+    
+    // 優先度付きキューを使用: pair<距離, 頂点番号>
+    using pdi = pair<double, int>;
+    std::priority_queue<pdi, vector<pdi>, std::greater<pdi>> pq;
+    
+    // 各始点からダイクストラ法を実行
+    size_t pops = 0;
+    for (int start = 0; start < nsize; start++) {
+        vector<bool> visited(nsize, false);
+        dist[start][start] = 0.0;
+        next_hop[start][start] = start;
+        pq.push({0.0, start});
+        
+        while (!pq.empty()) {
+            auto [d, current] = pq.top();
+            pq.pop();
+            pops++;
+            
+            if (visited[current]) continue;
+            visited[current] = true;
+            
+            // 隣接リストを使用した隣接頂点の探索
+            for (const auto& [next, weight] : adj_list[current]) {
+                double new_dist = dist[start][current] + weight;
+                if (new_dist < dist[start][next]) {
+                    dist[start][next] = new_dist;
+                    // 次のホップを更新
+                    next_hop[start][next] = (current == start) ? 
+                                          next : next_hop[start][current];
+                    pq.push({new_dist, next});
+                }
+            }
+        }
+    }
+    count_dijkstra_pops += pops;
+    
+    return {dist, next_hop};
+}
+
+/**
+ * @brief Update route choice using dynamic user optimum.
+ */
+void World::route_choice_duo(){
+    // In day-to-day mode, the preferences at this route update start from the ones of the previous day and are recorded for the next day
+    size_t update = timestep_for_route_update > 0 ? timestep / timestep_for_route_update : 0;
+    vector<vector<double>> *day_pref = nullptr;
+    vector<char> is_dest;
+    if (day_to_day_weight > 0.0){
+        if (route_preference_profile.size() <= update){
+            route_preference_profile.resize(update + 1);
+        }
+        day_pref = &route_preference_profile[update];
+        is_dest.assign(nodes.size(), 0);
+        for (auto veh : vehicles){
+            is_dest[veh->dest->id] = 1;
+        }
+    }
+
+    for (auto dest : nodes){
+        int k = dest->id;
+
+        auto duo_update_weight_tmp = duo_update_weight;
+        if (sum_map_values(route_preference[k]) == 0){
+             duo_update_weight_tmp = 1; //initialize with deterministic shortest path
+        }
+
+        double weight = duo_update_weight;
+        if (day_pref && (size_t)k < day_pref->size() && !(*day_pref)[k].empty()){
+            for (auto ln : links){
+                route_preference[k][ln] = (*day_pref)[k][ln->id];
+            }
+            weight = day_to_day_weight;
+        }
+
+        // For each link in the world, update preference
+        for (auto ln : links){
+            int i = ln->start_node->id;
+            int j = ln->end_node->id;
+            if (route_next[i][k] == j){
+                route_preference[k][ln] = (1.0 - weight) * route_preference[k][ln] + weight;
+            }else{
+                route_preference[k][ln] = (1.0 - weight) * route_preference[k][ln];
+            }
+        }
+
+        if (day_pref && is_dest[k]){
+            day_pref->resize(nodes.size());
+            (*day_pref)[k].resize(links.size());
+            for (auto ln : links){
+                (*day_pref)[k][ln->id] = route_preference[k][ln];
+            }
+        }
+    }
+}
+
+/**
+ * @brief Update route choice at the end of a step.
+ * 
+ * The route search is done at every `timestep_for_route_update` steps. In asynchronous mode, the search runs on a worker thread from a snapshot of link costs, and its result is applied `route_search_lag` steps later regardless of the progress of the thread, so that results are deterministic.
+ */
+void World::route_update(){
+    bool search = timestep_for_route_update > 0 && timestep % timestep_for_route_update == 0;
+    if (route_search_lag == 0 || route_next.empty()){
+        // the initial tables are always searched synchronously
+        if (search){
+            update_adj_time_matrix();
+            auto res = route_search_all(adj_mat_time, 0.0);
+            route_dist = res.first;
+            route_next = res.second;
+            timing_lap(tpROUTE_SEARCH);
+            route_choice_duo();
+            timing_lap(tpROUTE_CHOICE);
+        }
+        return;
+    }
+
+    if (route_search_pending && timestep >= route_search_due){
+        route_search_apply();
+    }
+    if (search){
+        route_search_start();
+        timing_lap(tpROUTE_SEARCH);
+    }
+}
+
+/**
+ * @brief Set the lag of asynchronous route search.
+ * 
+ * @param lag The number of steps from the start of a route search to the application of its result. 0 means synchronous search. It must be smaller than the interval of route updates.
+ */
+void World::set_route_search_lag(size_t lag){
+    if (lag > 0 && timestep_for_route_update > 0 && lag >= timestep_for_route_update){
+        throw std::runtime_error("The lag of route search must be smaller than the interval of route updates");
+    }
+    if (lag == 0 && route_search_pending){
+        // apply the pending result synchronously from now
+        route_search_apply();
+    }
+    route_search_lag = lag;
+}
+
+/**
+ * @brief Start a route search on a worker thread from the current link costs.
+ */
+void World::route_search_start(){
+    route_search_wait();
+    update_adj_time_matrix();
+    // the search only reads the snapshot and the frozen network, which the simulation does not modify
+    route_search_future = std::async(std::launch::async, [this, adj = adj_mat_time](){
+        return route_search_all(adj, 0.0);
+    });
+    route_search_pending = true;
+    route_search_due = timestep + route_search_lag;
+}
+
+/**
+ * @brief Apply the result of the pending route search and update route choice.
+ */
+void World::route_search_apply(){
+    route_search_wait();
+    route_dist = std::move(route_search_result.first);
+    route_next = std::move(route_search_result.second);
+    route_search_result = {};
+    route_search_pending = false;
+    timing_lap(tpROUTE_SEARCH);
+    route_choice_duo();
+    timing_lap(tpROUTE_CHOICE);
+}
+
+/**
+ * @brief Wait for the running route search and keep its result in `route_search_result`.
+ */
+void World::route_search_wait() const{
+    if (route_search_future.valid()){
+        route_search_result = route_search_future.get();
+    }
+}
+
+/**
+ * @brief Discard the pending route search.
+ */
+void World::route_search_cancel(){
+    route_search_wait();
+    route_search_result = {};
+    route_search_pending = false;
+    route_search_due = 0;
+}
+
+void World::print_scenario_stats(){
+    if (print_mode == 1){
+        (*writer) << "Scenario statistics:\n";
+        (*writer) << "    duration: " << t_max << " s\n";
+        (*writer) << "    timesteps: " << total_timesteps << "\n";
+        (*writer) << "    nodes: " << nodes.size() << "\n";
+        (*writer) << "    links: " << links.size() << "\n";
+        (*writer) << "    vehicles: " << (int)vehicles.size() * (int)delta_n << " veh\n";
+        (*writer) << "    platoon size: " << delta_n << " veh\n";
+        (*writer) << "    platoons: " << vehicles.size() << "\n";
+        (*writer) << "    vehicles: " << (double)vehicles.size() * delta_n << " veh\n";
+    }
+}
+
+void World::print_simple_results(){
+    (*writer) << "Stats:\n";
+    (*writer) << "    Average speed: " << ave_v << "\n";
+    (*writer) << "    Average speed ratio: " << ave_vratio << "\n";
+    (*writer) << "    Trips completion: "
+              << trips_completed << " / " << trips_total << "\n";
+}
+
+// -----------------------------------------------------------------------
+//MARK: mainloop
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Main simulation loop.
+ * 
+ * @param duration_t Duration to run simulation.
+ * @param until_t Time to run simulation until.
+ */
+void World::main_loop(double duration_t=-1, double until_t=-1){
+    int start_ts, end_ts;
+    start_ts = timestep;
+
+    if (duration_t < 0 && until_t < 0){
+        end_ts = total_timesteps;
+    } else if (duration_t >= 0 && until_t < 0){
+        end_ts = static_cast<size_t>(floor((duration_t+time)/delta_t)) + 1;
+    } else if (duration_t < 0 && until_t >= 0){
+        end_ts = static_cast<size_t>(floor(until_t/delta_t)) + 1;
+    } else {
+        throw std::runtime_error("Cannot specify both `duration_t` and `until_t` parameters for `World.main_loop`");
+    }
+
+    if (end_ts > total_timesteps){
+        end_ts = total_timesteps;
+    }
+    if (end_ts <= start_ts){
+        return;
+    }
+
+    if (timing_mode){
+        timing_last = std::chrono::steady_clock::now();
+    }
+    trips_total = (double)vehicles.size() * delta_n;
+    for (timestep = start_ts; timestep < end_ts; timestep++){
+        rolling_spill_check();
+        timing_lap(tpOTHER);
+
+        if (idle_skip_mode && check_idle()){
+            size_t ts_next = std::min(next_departure_timestep(), (size_t)end_ts);
+            fast_forward(ts_next);
+            timing_lap(tpIDLE);
+            if (timestep >= end_ts){
+                break;
+            }
+            rolling_spill_check();
+            timing_lap(tpOTHER);
+        }
+
+        time = timestep*delta_t;
+
+        // Link updates
+        for (auto ln : links){
+            ln->update();
+        }
+        timing_lap(tpLINK);
+
+        // Node generate & update
+        for (auto nd : nodes){
+            nd->generate();
+            nd->signal_update();
+        }
+        timing_lap(tpGENERATE);
+
+        // Node transfer
+        for (auto nd : nodes){
+            nd->transfer();
+        }
+        timing_lap(tpTRANSFER);
+
+        // car-following
+        int veh_count = 0;
+        double ave_speed = 0;
+        for (const auto& veh : vehicles_running){
+            veh.second->car_follow_newell();
+            
+            veh_count++;
+            ave_speed = ave_speed*(veh_count-1)/veh_count + veh.second->v/(veh_count);
+        }
+        timing_lap(tpCAR_FOLLOW);
+
+        // vehicle update: 安全な走査のため、一度キーをコピーする
+        for (auto it = vehicles_living.begin(); it != vehicles_living.end(); ) {
+            Vehicle* veh = it->second;
+            ++it;  // update 前に次のイテレータへ進める
+            veh->update();
+
+        }        
+        timing_lap(tpVEHICLE);
+
+        // route choice update
+        route_update();
+
+        print_progress(veh_count, ave_speed);
+        timing_lap(tpOTHER);
+        timing_step_end();
+        stats_step_end();
+    }
+
+    if (timestep >= total_timesteps){
+        if (rolling_window > 0 && rolling_spilled_until < timestep){
+            rolling_spill_range(rolling_spilled_until, timestep);
+        }
+        vehicle_archive.shrink_to_fit();
+        if (series_mode != smDENSE){
+            for (auto ln : links){
+                ln->arrival_curve.shrink_to_fit();
+                ln->departure_curve.shrink_to_fit();
+                ln->traveltime_real.shrink_to_fit();
+                ln->traveltime_instant.shrink_to_fit();
+            }
+        }
+    }
+}
+
+/**
+ * @brief Return the world to t=0 while keeping the network, the demand and the allocations.
+ * 
+ * Vehicle states, logs, link curves and queues are cleared in place. Parameters of nodes, links and vehicles changed after construction are kept.
+ * 
+ * @param keep_route_preference If true, the route preferences learned by DUO are kept. Otherwise, they are cleared as in a new world.
+ * @param reseed If true, the random number generator is reseeded, so that the same run as a new world is obtained. Otherwise, it continues from the current state.
+ * @param random_seed The new random seed. If negative, the current `random_seed` is used.
+ */
+void World::reset(bool keep_route_preference, bool reseed, long long random_seed){
+    // retired vehicles get their names back from the archive first
+    for (auto veh : vehicles){
+        veh->reset();
+    }
+    vehicle_archive.clear();
+    for (auto nd : nodes){
+        nd->reset();
+    }
+    for (auto ln : links){
+        ln->reset();
+    }
+
+    // rebuilt in the order of construction, so that the iteration order is the same as a new world
+    unordered_map<int, Vehicle *>().swap(vehicles_living);
+    unordered_map<int, Vehicle *>().swap(vehicles_running);
+    vehicles_map.clear();
+    for (auto veh : vehicles){
+        vehicles_living[veh->id] = veh;
+        vehicles_map[veh->name] = veh;
+    }
+
+    timestep = 0;
+    time = 0.0;
+    ave_v = 0.0;
+    ave_vratio = 0.0;
+    trips_total = 0.0;
+    trips_completed = 0.0;
+    run_samples = 0.0;
+    sum_v = 0.0;
+    sum_vratio = 0.0;
+    total_travel_time = 0.0;
+    total_delay = 0.0;
+    vehicle_distance = 0.0;
+    stats_snapshot.clear();
+    stats_series.clear();
+    reset_detectors();
+    rolling_spilled_until = 0;
+
+    if (flag_initialized){
+        for (auto ln : links){
+            adj_mat_time[ln->start_node->id][ln->end_node->id] = ln->length / ln->vmax;
+        }
+        if (!keep_route_preference){
+            for (auto &pref : route_preference){
+                for (auto &[_, value] : pref){
+                    value = 0.0;
+                }
+            }
+        }
+    }
+    if (!keep_route_preference){
+        route_preference_profile.clear();
+    }
+    route_search_cancel();
+    route_next.clear();
+    route_dist.clear();
+    reset_timing();
+
+    if (reseed){
+        if (random_seed >= 0){
+            this->random_seed = random_seed;
+        }
+        rng.seed((std::mt19937::result_type)this->random_seed);
+    }
+}
+
+/**
+ * @brief Print the simulation progress at every 10% of the total timesteps.
+ * 
+ * @param veh_count The number of running platoons.
+ * @param ave_speed The average speed of running platoons.
+ */
+void World::print_progress(int veh_count, double ave_speed){
+    if (print_mode == 1 && total_timesteps > 0 && timestep % (total_timesteps / 10 == 0 ? 1 : total_timesteps / 10) == 0){
+        if (timestep == 0){
+            (*writer) <<  "Simulating..." << endl;
+            (*writer) <<  std::setw(10) << "time" 
+                << "|"<< std::setw(14) <<  "# of vehicles"
+                << "|"<< std::setw(11) << " ave speed" << endl;
+        }
+        (*writer) << std::setw(8) << std::fixed << std::setprecision(0) << time << " s"
+              << "|" << std::setw(10) << veh_count*delta_n << " veh"
+              << "|" << std::setw(7) << std::fixed << std::setprecision(2) << ave_speed << " m/s"
+              << endl;
+    }
+}
+
+/**
+ * @brief Check whether the network is globally idle, i.e., no vehicle is running or waiting to be generated.
+ * 
+ * @return bool
+ */
+bool World::check_idle(){
+    if (!vehicles_running.empty()){
+        return false;
+    }
+    for (auto nd : nodes){
+        if (!nd->generation_queue.empty()){
+            return false;
+        }
+    }
+    return true;
+}
+
+/**
+ * @brief Get the earliest timestep at which a vehicle at home departs.
+ * 
+ * @return size_t The timestep, or `total_timesteps` if no vehicle departs anymore.
+ */
+size_t World::next_departure_timestep(){
+    size_t ts_next = total_timesteps;
+    for (const auto &item : vehicles_living){
+        Vehicle *veh = item.second;
+        if (veh->state != vsHOME){
+            continue;
+        }
+        // the same condition as in Vehicle::update
+        double ts_guess = ceil(veh->departure_time / delta_t);
+        size_t ts = ts_guess > 0.0 ? (size_t)ts_guess : 0;
+        while (ts > 0 && (double)(ts-1) * delta_t >= veh->departure_time){
+            ts--;
+        }
+        while ((double)ts * delta_t < veh->departure_time){
+            ts++;
+        }
+        if (ts < ts_next){
+            ts_next = ts;
+        }
+    }
+    return ts_next;
+}
+
+/**
+ * @brief Advance the simulation clock from the current timestep to `ts_target` while the network is idle.
+ * 
+ * Link states are filled in bulk. Signals, route choice updates, and progress output are processed as if each timestep had been simulated.
+ * 
+ * @param ts_target The timestep at which the ordinary simulation resumes.
+ */
+void World::fast_forward(size_t ts_target){
+    size_t ts_from = timestep;
+    if (ts_target <= ts_from){
+        return;
+    }
+
+    bool route_searched = false;
+    for (timestep = ts_from; timestep < ts_target; timestep++){
+        time = timestep*delta_t;
+
+        // link states are filled in bulk up to the next spill point in rolling mode
+        if (timestep == ts_from || (rolling_window > 0 && timestep % rolling_window == 0)){
+            rolling_spill_check();
+            size_t ts_chunk_end = ts_target;
+            if (rolling_window > 0){
+                ts_chunk_end = std::min(ts_target, (timestep / rolling_window + 1) * rolling_window);
+            }
+            for (auto ln : links){
+                ln->fill_idle(timestep, ts_chunk_end);
+            }
+        }
+
+        for (auto nd : nodes){
+            nd->signal_update();
+        }
+
+        // link costs do not change while idle, so the search result is reused unless they are given by a profile
+        if (route_search_lag > 0){
+            route_update();
+        }else if (timestep_for_route_update > 0 && timestep % timestep_for_route_update == 0){
+            if (!route_searched || !route_traveltime_profile.empty()){
+                update_adj_time_matrix();
+                auto res = route_search_all(adj_mat_time, 0.0);
+                route_dist = res.first;
+                route_next = res.second;
+                route_searched = true;
+            }
+            route_choice_duo();
+        }
+
+        print_progress(0, 0.0);
+        timing_step_end();
+        stats_step_end();
+    }
+}
+
+
+bool World::check_simulation_ongoing(){
+    if (timestep < total_timesteps){
+        return true;
+    } else {
+        return false;
+    }
+}
+
+// -----------------------------------------------------------------------
+// MARK: Network statistics
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Accumulate the statistics of a running vehicle in a step, before its position is updated.
+ * 
+ * @param veh The vehicle.
+ */
+void World::record_run_step(const Vehicle *veh){
+    // the speed is sampled in the same way as the vehicle log
+    double v_sample = (std::fabs(veh->x - (veh->link->length - 1.0)) > 1e-9) ? veh->v : 0.0;
+    double dx = veh->x_next - veh->x;
+    run_samples += 1.0;
+    sum_v += v_sample;
+    sum_vratio += v_sample / veh->link->vmax;
+    total_travel_time += delta_t * delta_n;
+    total_delay += (delta_t - dx / veh->link->vmax) * delta_n;
+    vehicle_distance += dx * delta_n;
+}
+
+/**
+ * @brief Update the averages at the end of a step and record a row of the stats series at the end of each interval.
+ */
+void World::stats_step_end(){
+    if (run_samples > 0.0){
+        ave_v = sum_v / run_samples;
+        ave_vratio = sum_vratio / run_samples;
+    }
+    if (stats_interval > 0 && (timestep + 1) % stats_interval == 0){
+        vector<double> values = stats_values();
+        vector<double> row = {(double)(timestep + 1) * delta_t};
+        for (size_t i = 0; i < values.size(); i++){
+            row.push_back(values[i] - (i < stats_snapshot.size() ? stats_snapshot[i] : 0.0));
+        }
+        stats_series.push_back(row);
+        stats_snapshot = values;
+    }
+}
+
+/**
+ * @brief Get the accumulated values: running samples, sum of speeds, sum of speed ratios, total travel time, total delay, vehicle distance, and trips completed.
+ */
+vector<double> World::stats_values() const{
+    return {run_samples, sum_v, sum_vratio, total_travel_time, total_delay, vehicle_distance, trips_completed};
+}
+
+/**
+ * @brief Set the interval of the stats series. The recorded series is cleared.
+ * 
+ * @param interval_t The interval in seconds. If 0, the series is not recorded.
+ */
+void World::set_stats_interval(double interval_t){
+    if (interval_t < 0){
+        throw std::runtime_error("The interval of the stats series must be non-negative");
+    }
+    stats_interval = (interval_t > 0) ? std::max((size_t)1, (size_t)std::round(interval_t / delta_t)) : 0;
+    stats_snapshot = stats_values();
+    stats_series.clear();
+}
+
+/**
+ * @brief Get the network statistics accumulated so far.
+ * 
+ * @return map<string, double> "average_speed" and "average_speed_ratio" over the steps of running vehicles, "total_travel_time" and "total_delay" in veh*s, "vehicle_km", "trips_completed" and "trips_total" in veh.
+ */
+map<string, double> World::get_stats() const{
+    return {
+        {"average_speed", ave_v},
+        {"average_speed_ratio", ave_vratio},
+        {"total_travel_time", total_travel_time},
+        {"total_delay", total_delay},
+        {"vehicle_km", vehicle_distance / 1000.0},
+        {"trips_completed", trips_completed},
+        {"trips_total", (double)vehicles.size() * delta_n}
+    };
+}
+
+/**
+ * @brief Get the network statistics of each interval recorded by `set_stats_interval`.
+ * 
+ * @return map<string, vector<double>> "t" (the end time of each interval), and "average_speed", "average_speed_ratio", "total_travel_time", "total_delay", "vehicle_km" and "trips_completed" in each interval.
+ */
+map<string, vector<double>> World::get_stats_series() const{
+    map<string, vector<double>> ret;
+    for (const string &key : {"t", "average_speed", "average_speed_ratio", "total_travel_time", "total_delay", "vehicle_km", "trips_completed"}){
+        ret[key] = {};
+    }
+    for (const auto &row : stats_series){
+        double samples = row[1];
+        ret["t"].push_back(row[0]);
+        ret["average_speed"].push_back(samples > 0.0 ? row[2] / samples : std::nan(""));
+        ret["average_speed_ratio"].push_back(samples > 0.0 ? row[3] / samples : std::nan(""));
+        ret["total_travel_time"].push_back(row[4]);
+        ret["total_delay"].push_back(row[5]);
+        ret["vehicle_km"].push_back(row[6] / 1000.0);
+        ret["trips_completed"].push_back(row[7]);
+    }
+    return ret;
+}
+
+/**
+ * @brief Set how link travel times are recorded. The recorded interval stats are cleared if the interval changes.
+ * 
+ * @param interval_t The interval of the stats in seconds. It is rounded to a multiple of the timestep.
+ * @param keep_samples Whether keep the raw samples of all traversals in addition to the stats.
+ */
+void World::set_traveltime_stats(double interval_t, bool keep_samples){
+    if (interval_t <= 0){
+        throw std::runtime_error("The interval of the link travel time stats must be positive");
+    }
+    size_t interval = std::max((size_t)1, (size_t)std::round(interval_t / delta_t));
+    if (interval != traveltime_stats_interval){
+        traveltime_stats_interval = interval;
+        for (auto ln : links){
+            ln->traveltime_interval_count.clear();
+            ln->traveltime_interval_sum.clear();
+        }
+    }
+    traveltime_keep_samples = keep_samples;
+}
+
+/**
+ * @brief Check whether the vehicle logs contain the complete trajectories, i.e., the time, link and position of every vehicle at every timestep.
+ * 
+ * @return bool
+ */
+bool World::trajectories_available() const {
+    int required = vlfT | vlfLINK | vlfX;
+    return vehicle_log_mode != vlmNONE
+        && vehicle_log_interval == 1
+        && vehicle_log_sample_ratio >= 1.0
+        && (vehicle_log_fields & required) == required
+        && vehicle_archive.spilled_count == 0;
+}
+
+/**
+ * @brief Compute link-by-time matrices of flow, density, speed and delay by Edie's generalized definitions.
+ * 
+ * In each time-space region of a link and a time bin, flow is the total distance traveled and density is the total time spent divided by the area of the region.
+ * They are computed from the vehicle trajectories if `trajectories_available()`, otherwise from the cumulative curves and the instantaneous travel times.
+ * Timesteps not kept in the link series in rolling mode are NaN in the latter case.
+ * 
+ * @param interval_t The length of a time bin in seconds. It is rounded to a multiple of the timestep.
+ * @return LinkStateMatrices
+ */
+LinkStateMatrices World::compute_link_state_matrices(double interval_t){
+    size_t bin_steps = (size_t)std::max(1.0, std::round(interval_t / delta_t));
+    size_t n_bins = (total_timesteps + bin_steps - 1) / bin_steps;
+    size_t n_links = links.size();
+
+    LinkStateMatrices ret;
+    ret.interval = (double)bin_steps * delta_t;
+    ret.n_links = n_links;
+    ret.n_bins = n_bins;
+    ret.from_trajectories = trajectories_available();
+
+    // total distance traveled (veh*m) and total time spent (veh*s) in each region
+    vector<double> ttd(n_links * n_bins, 0.0);
+    vector<double> tts(n_links * n_bins, 0.0);
+
+    if (ret.from_trajectories){
+        for (Vehicle *veh : vehicles){
+            vector<double> log_t = veh->get_log_t();
+            vector<int> log_link = veh->get_log_link();
+            vector<double> log_x = veh->get_log_x();
+            for (size_t i = 0; i < log_t.size(); i++){
+                if (log_link[i] < 0){
+                    continue;
+                }
+                const Link *ln = links[log_link[i]];
+                size_t ts = (size_t)std::llround(log_t[i] / delta_t);
+                if (ts >= total_timesteps){
+                    continue;
+                }
+                // the position at the next timestep, or the end of the link if the vehicle has left it
+                double x_next = ln->length;
+                if (i + 1 < log_t.size()){
+                    if (log_link[i+1] == log_link[i]){
+                        x_next = log_x[i+1];
+                    }
+                } else if (veh->state == vsRUN){
+                    x_next = veh->x;
+                }
+                size_t k = (size_t)ln->id * n_bins + ts / bin_steps;
+                ttd[k] += (x_next - log_x[i]) * delta_n;
+                tts[k] += delta_t * delta_n;
+            }
+        }
+    } else {
+        size_t ts_end = std::min(timestep + 1, total_timesteps);
+        for (const Link *ln : links){
+            for (size_t ts = 0; ts < ts_end; ts++){
+                size_t k = (size_t)ln->id * n_bins + ts / bin_steps;
+                if (!ln->arrival_curve.contains(ts)){
+                    ttd[k] = tts[k] = std::nan("");
+                    continue;
+                }
+                double n = ln->arrival_curve.at(ts) - ln->departure_curve.at(ts);
+                tts[k] += n * delta_t;
+                ttd[k] += n * delta_t * ln->length / ln->traveltime_instant.at(ts);
+            }
+        }
+    }
+
+    ret.flow.resize(n_links * n_bins);
+    ret.density.resize(n_links * n_bins);
+    ret.speed.resize(n_links * n_bins);
+    ret.delay.resize(n_links * n_bins);
+    for (const Link *ln : links){
+        double area = ln->length * ret.interval;
+        for (size_t b = 0; b < n_bins; b++){
+            size_t k = (size_t)ln->id * n_bins + b;
+            ret.flow[k] = ttd[k] / area;
+            ret.density[k] = tts[k] / area;
+            ret.speed[k] = tts[k] > 0.0 ? ttd[k] / tts[k] : (std::isnan(tts[k]) ? tts[k] : ln->vmax);
+            ret.delay[k] = tts[k] - ttd[k] / ln->vmax;
+        }
+    }
+    return ret;
+}
+
+/**
+ * @brief Answer a batch of queries of links and time windows in one pass.
+ * 
+ * Each query is a link and a window [t1, t2). Queries whose window is empty or out of the kept link series give NaN.
+ * 
+ * @param link_ids The link id of each query.
+ * @param t1 The start time of each window.
+ * @param t2 The end time of each window.
+ * @return LinkQueryResult The inflow and outflow as in `Link::inflow` and `Link::outflow`, and the means of the travel time and of the number of vehicles over the timesteps in the window.
+ */
+LinkQueryResult World::query_links(const vector<int> &link_ids, const vector<double> &t1, const vector<double> &t2) const {
+    size_t n = link_ids.size();
+    if (t1.size() != n || t2.size() != n){
+        throw std::invalid_argument("The numbers of links and time windows must be the same");
+    }
+    LinkQueryResult ret;
+    ret.inflow.assign(n, std::nan(""));
+    ret.outflow.assign(n, std::nan(""));
+    ret.traveltime.assign(n, std::nan(""));
+    ret.vehicles.assign(n, std::nan(""));
+    for (size_t q = 0; q < n; q++){
+        if (link_ids[q] < 0 || (size_t)link_ids[q] >= links.size()){
+            throw std::out_of_range("link id " + std::to_string(link_ids[q]) + " is out of range");
+        }
+        const Link *ln = links[link_ids[q]];
+        if (!(t1[q] >= 0.0 && t2[q] > t1[q])){
+            continue;
+        }
+        size_t ts1 = (size_t)(t1[q] / delta_t);
+        size_t ts2 = (size_t)(t2[q] / delta_t);
+        if (!ln->arrival_curve.contains(ts1) || !ln->arrival_curve.contains(ts2)){
+            continue;
+        }
+        ret.inflow[q] = (ln->arrival_curve.at(ts2) - ln->arrival_curve.at(ts1)) / (t2[q] - t1[q]);
+        ret.outflow[q] = (ln->departure_curve.at(ts2) - ln->departure_curve.at(ts1)) / (t2[q] - t1[q]);
+        if (ts2 > ts1){
+            double steps = (double)(ts2 - ts1);
+            ret.traveltime[q] = ln->traveltime_real.sum(ts1, ts2) / steps;
+            ret.vehicles[q] = (ln->arrival_curve.sum(ts1, ts2) - ln->departure_curve.sum(ts1, ts2)) / steps;
+        }
+    }
+    return ret;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Route queries
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Compute the free flow travel times from a node to all nodes, or from all nodes to a node.
+ * 
+ * @param source The node id.
+ * @param reverse If true, the travel times to `source` are computed.
+ * @return vector<double> By node id. Infinity if unreachable.
+ */
+vector<double> World::freeflow_distances(int source, bool reverse) const {
+    if (source < 0 || (size_t)source >= nodes.size()){
+        throw std::out_of_range("node id " + std::to_string(source) + " is out of range");
+    }
+    const double inf = std::numeric_limits<double>::infinity();
+    vector<double> dist(nodes.size(), inf);
+    using pdi = pair<double, int>;
+    std::priority_queue<pdi, vector<pdi>, std::greater<pdi>> pq;
+    dist[source] = 0.0;
+    pq.push({0.0, source});
+    while (!pq.empty()){
+        auto [d, i] = pq.top();
+        pq.pop();
+        if (d > dist[i]){
+            continue;
+        }
+        for (auto ln : reverse ? nodes[i]->in_links : nodes[i]->out_links){
+            int j = reverse ? ln->start_node->id : ln->end_node->id;
+            double nd = d + ln->length / ln->vmax;
+            if (nd < dist[j]){
+                dist[j] = nd;
+                pq.push({nd, j});
+            }
+        }
+    }
+    return dist;
+}
+
+/**
+ * @brief Compute time-dependent shortest paths of many (origin, destination, departure time) queries in parallel.
+ * 
+ * Link costs are the experienced travel times by entry time from `Link::entry_traveltime`. Since they are FIFO, a label-setting search gives exact earliest arrivals. The search is goal-directed by ALT (A*, landmarks and the triangle inequality) lower bounds from free flow travel times, which never exceed the experienced ones. The landmarks are chosen by the farthest selection.
+ * 
+ * @param orig_ids The origin node ids.
+ * @param dest_ids The destination node ids.
+ * @param departure_times The departure times in s.
+ * @param return_paths Whether return the link paths.
+ * @param n_landmarks The number of landmarks. 0 means plain Dijkstra.
+ * @param n_threads The number of threads. 0 means the number of hardware threads.
+ * @return RouteQueryResult
+ */
+RouteQueryResult World::query_routes(const vector<int> &orig_ids, const vector<int> &dest_ids, const vector<double> &departure_times,
+        bool return_paths, int n_landmarks, int n_threads) const {
+    size_t n = orig_ids.size();
+    if (dest_ids.size() != n || departure_times.size() != n){
+        throw std::invalid_argument("The numbers of origins, destinations and departure times must be the same");
+    }
+    int n_nodes = (int)nodes.size();
+    for (size_t q = 0; q < n; q++){
+        if (orig_ids[q] < 0 || orig_ids[q] >= n_nodes){
+            throw std::out_of_range("node id " + std::to_string(orig_ids[q]) + " is out of range");
+        }
+        if (dest_ids[q] < 0 || dest_ids[q] >= n_nodes){
+            throw std::out_of_range("node id " + std::to_string(dest_ids[q]) + " is out of range");
+        }
+    }
+    const double inf = std::numeric_limits<double>::infinity();
+
+    // Landmarks: lm_from[k][v] = d(L_k, v), lm_to[k][v] = d(v, L_k)
+    vector<vector<double>> lm_from, lm_to;
+    if (n_landmarks > 0 && n_nodes > 0 && n > 0){
+        vector<double> min_dist(n_nodes, inf);
+        int next = 0;
+        for (int k = 0; k < std::min(n_landmarks, n_nodes); k++){
+            lm_from.push_back(freeflow_distances(next, false));
+            lm_to.push_back(freeflow_distances(next, true));
+            // the next landmark is the node farthest from the current ones
+            int far = -1;
+            double far_dist = 0.0;
+            for (int v = 0; v < n_nodes; v++){
+                min_dist[v] = std::min(min_dist[v], std::min(lm_from.back()[v], lm_to.back()[v]));
+                if (min_dist[v] < inf && min_dist[v] > far_dist){
+                    far_dist = min_dist[v];
+                    far = v;
+                }
+            }
+            if (far < 0){
+                break;
+            }
+            next = far;
+        }
+    }
+    size_t n_lm = lm_from.size();
+
+    RouteQueryResult ret;
+    ret.traveltime.assign(n, std::nan(""));
+    if (return_paths){
+        ret.paths.resize(n);
+    }
+
+    std::atomic<size_t> settled_total(0);
+    auto worker = [&](size_t q_begin, size_t q_end){
+        // scratch arrays are reset lazily by stamping them with the query number
+        vector<double> arrival(n_nodes, inf);
+        vector<double> potential(n_nodes, 0.0);
+        vector<Link *> pred(n_nodes, nullptr);
+        vector<size_t> stamp(n_nodes, 0);
+        vector<bool> done(n_nodes, false);
+        using pdi = pair<double, int>;
+        std::priority_queue<pdi, vector<pdi>, std::greater<pdi>> pq;
+        size_t settled = 0;
+
+        for (size_t q = q_begin; q < q_end; q++){
+            size_t qs = q + 1;
+            int s = orig_ids[q], t = dest_ids[q];
+            auto visit = [&](int v){
+                if (stamp[v] != qs){
+                    stamp[v] = qs;
+                    arrival[v] = inf;
+                    pred[v] = nullptr;
+                    done[v] = false;
+                    double h = 0.0;
+                    for (size_t k = 0; k < n_lm; k++){
+                        // d(v, t) >= d(L, t) - d(L, v) and >= d(v, L) - d(t, L)
+                        if (lm_from[k][v] < inf && lm_from[k][t] < inf){
+                            h = std::max(h, lm_from[k][t] - lm_from[k][v]);
+                        }
+                        if (lm_to[k][v] < inf && lm_to[k][t] < inf){
+                            h = std::max(h, lm_to[k][v] - lm_to[k][t]);
+                        }
+                    }
+                    potential[v] = h;
+                }
+            };
+            pq = {};
+            visit(s);
+            arrival[s] = departure_times[q];
+            pq.push({arrival[s] + potential[s], s});
+            while (!pq.empty()){
+                auto [key, i] = pq.top();
+                pq.pop();
+                if (done[i]){
+                    continue;
+                }
+                done[i] = true;
+                settled++;
+                if (i == t){
+                    break;
+                }
+                for (auto ln : nodes[i]->out_links){
+                    int j = ln->end_node->id;
+                    visit(j);
+                    if (done[j]){
+                        continue;
+                    }
+                    double a = arrival[i] + ln->entry_traveltime(arrival[i]);
+                    if (a < arrival[j]){
+                        arrival[j] = a;
+                        pred[j] = ln;
+                        pq.push({a + potential[j], j});
+                    }
+                }
+            }
+            if (stamp[t] == qs && done[t]){
+                ret.traveltime[q] = arrival[t] - departure_times[q];
+                if (return_paths){
+                    auto &path = ret.paths[q];
+                    for (int v = t; pred[v] != nullptr; v = pred[v]->start_node->id){
+                        path.push_back(pred[v]->id);
+                    }
+                    std::reverse(path.begin(), path.end());
+                }
+            }
+        }
+        settled_total += settled;
+    };
+
+    size_t n_workers = n_threads > 0 ? (size_t)n_threads : std::max(1u, std::thread::hardware_concurrency());
+    n_workers = std::min(n_workers, std::max((size_t)1, n / 64));
+    if (n_workers <= 1){
+        worker(0, n);
+    } else {
+        vector<std::thread> threads;
+        size_t chunk = (n + n_workers - 1) / n_workers;
+        for (size_t b = 0; b < n; b += chunk){
+            threads.emplace_back(worker, b, std::min(n, b + chunk));
+        }
+        for (auto &th : threads){
+            th.join();
+        }
+    }
+    ret.settled = settled_total;
+    return ret;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Detectors
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Add a virtual loop detector. It records the vehicles crossing the position during the simulation.
+ * 
+ * @param detector_name The name of the detector.
+ * @param link_name The name of the link.
+ * @param x The position from the start of the link. It must be in [0, length).
+ * @param interval_t The aggregation interval in seconds. It is rounded to a multiple of the timestep.
+ * @return int The index of the detector.
+ */
+int World::add_detector(const string &detector_name, const string &link_name, double x, double interval_t){
+    Link *ln = get_link(link_name);
+    if (x < 0.0 || x >= ln->length){
+        throw std::runtime_error("The position of detector `" + detector_name + "` must be in [0, length) of link `" + link_name + "`");
+    }
+    if (interval_t <= 0.0){
+        throw std::runtime_error("The interval of detector `" + detector_name + "` must be positive");
+    }
+    for (const auto &d : detectors){
+        if (d.name == detector_name){
+            throw std::runtime_error("Detector `" + detector_name + "` already exists");
+        }
+    }
+
+    Detector d;
+    d.name = detector_name;
+    d.link = ln->id;
+    d.x = x;
+    d.interval = std::max((size_t)1, (size_t)std::round(interval_t / delta_t));
+    size_t n_bins = (total_timesteps + d.interval - 1) / d.interval;
+    d.count.assign(n_bins, 0.0);
+    d.sum_v.assign(n_bins, 0.0);
+    d.occupied.assign(n_bins, 0.0);
+    detectors.push_back(std::move(d));
+
+    if (link_detectors.size() < links.size()){
+        link_detectors.resize(links.size());
+    }
+    link_detectors[ln->id].push_back((int)detectors.size() - 1);
+    return (int)detectors.size() - 1;
+}
+
+/**
+ * @brief Record a running vehicle at the detectors it crosses in a step, before its position is updated.
+ * 
+ * @param veh The vehicle.
+ */
+void World::record_detectors(const Vehicle *veh){
+    if ((size_t)veh->link->id >= link_detectors.size()){
+        return;
+    }
+    for (int i : link_detectors[veh->link->id]){
+        Detector &d = detectors[i];
+        if (veh->x <= d.x && d.x < veh->x_next){
+            double v = (veh->x_next - veh->x) / delta_t;
+            size_t b = timestep / d.interval;
+            d.count[b] += delta_n;
+            d.sum_v[b] += v * delta_n;
+            // each vehicle occupies the jam spacing
+            d.occupied[b] += delta_n * veh->link->delta / v;
+        }
+    }
+}
+
+/**
+ * @brief Clear the values recorded by the detectors.
+ */
+void World::reset_detectors(){
+    for (auto &d : detectors){
+        std::fill(d.count.begin(), d.count.end(), 0.0);
+        std::fill(d.sum_v.begin(), d.sum_v.end(), 0.0);
+        std::fill(d.occupied.begin(), d.occupied.end(), 0.0);
+    }
+}
+
+/**
+ * @brief Get the values recorded by a detector in each interval.
+ * 
+ * @param detector_name The name of the detector.
+ * @return map<string, vector<double>> "t" (the start time of each interval), "count" (veh), "flow" (veh/s), "speed" (time-mean speed, NaN if no vehicle crossed), and "occupancy" (the fraction of time the detector is occupied).
+ */
+map<string, vector<double>> World::get_detector_data(const string &detector_name) const{
+    for (const auto &d : detectors){
+        if (d.name != detector_name){
+            continue;
+        }
+        double interval_t = (double)d.interval * delta_t;
+        map<string, vector<double>> ret;
+        for (size_t b = 0; b < d.count.size(); b++){
+            ret["t"].push_back((double)b * interval_t);
+            ret["count"].push_back(d.count[b]);
+            ret["flow"].push_back(d.count[b] / interval_t);
+            ret["speed"].push_back(d.count[b] > 0.0 ? d.sum_v[b] / d.count[b] : std::nan(""));
+            ret["occupancy"].push_back(std::min(1.0, d.occupied[b] / interval_t));
+        }
+        return ret;
+    }
+    throw std::runtime_error("Detector `" + detector_name + "` not found");
+}
+
+// -----------------------------------------------------------------------
+// MARK: Memory accounting
+// -----------------------------------------------------------------------
+
+template <typename T>
+inline size_t vector_bytes(const vector<T> &v){
+    return v.capacity() * sizeof(T);
+}
+
+template <typename T>
+inline size_t matrix_bytes(const vector<vector<T>> &mat){
+    size_t bytes = vector_bytes(mat);
+    for (const auto &row : mat){
+        bytes += vector_bytes(row);
+    }
+    return bytes;
+}
+
+// heap buffer of a string beyond the small string optimization
+inline size_t string_bytes(const string &str){
+    return str.capacity() > 15 ? str.capacity() + 1 : 0;
+}
+
+// a red-black tree node has a color and three pointers besides the value
+template <typename K, typename V>
+inline size_t map_bytes(const map<K, V> &m){
+    return m.size() * (sizeof(std::pair<const K, V>) + 4 * sizeof(void *));
+}
+
+// a hash node has a next pointer and the cached hash besides the value
+template <typename V>
+inline size_t name_map_bytes(const unordered_map<string, V> &m){
+    size_t bytes = m.bucket_count() * sizeof(void *);
+    for (const auto &[key, _] : m){
+        bytes += sizeof(std::pair<const string, V>) + sizeof(void *) + sizeof(size_t) + string_bytes(key);
+    }
+    return bytes;
+}
+
+/**
+ * @brief Estimate the memory usage of the world by category.
+ * 
+ * The sizes are estimated from the sizes and capacities of the containers, so that they are approximate. The projected sizes at the end of the simulation are extrapolated linearly from the elapsed steps. Before the simulation, vehicle logs and travel time samples are estimated from the free flow shortest paths of the vehicles.
+ * 
+ * @return map<string, double> The bytes of each category, their "total", and the "projected_" ones of the categories growing with time and of the total.
+ */
+map<string, double> World::memory_usage(){
+    map<string, double> ret;
+
+    size_t vehicle_objects = vehicles.size() * sizeof(Vehicle);
+    size_t vehicle_logs = 0;
+    size_t vehicle_preferences = 0;
+    for (auto veh : vehicles){
+        vehicle_objects += string_bytes(veh->name) + vector_bytes(veh->links_preferred);
+        vehicle_logs += vector_bytes(veh->log_t) + vector_bytes(veh->log_state) + vector_bytes(veh->log_link)
+                      + vector_bytes(veh->log_x) + vector_bytes(veh->log_v) + vector_bytes(veh->log_segments);
+        vehicle_preferences += map_bytes(veh->route_preference);
+    }
+    const VehicleArchive &ar = vehicle_archive;
+    vehicle_logs += vector_bytes(ar.offsets) + vector_bytes(ar.log_t) + vector_bytes(ar.log_state) + vector_bytes(ar.log_link)
+                  + vector_bytes(ar.log_x) + vector_bytes(ar.log_v) + vector_bytes(ar.log_segments)
+                  + string_bytes(ar.names) + vector_bytes(ar.name_offsets) + vector_bytes(ar.vehicle_ids);
+
+    size_t network_objects = nodes.size() * sizeof(Node) + links.size() * sizeof(Link);
+    size_t link_series = 0;
+    size_t link_samples = 0;
+    for (auto nd : nodes){
+        network_objects += string_bytes(nd->name) + vector_bytes(nd->in_links) + vector_bytes(nd->out_links) + vector_bytes(nd->signal_intervals);
+    }
+    for (auto ln : links){
+        network_objects += string_bytes(ln->name) + vector_bytes(ln->signal_group);
+        link_series += ln->arrival_curve.bytes() + ln->departure_curve.bytes()
+                     + ln->traveltime_real.bytes() + ln->traveltime_instant.bytes();
+        link_samples += vector_bytes(ln->traveltime_t) + vector_bytes(ln->traveltime_tt)
+                      + vector_bytes(ln->traveltime_interval_count) + vector_bytes(ln->traveltime_interval_sum) + ln->traveltime_sketch.bytes();
+    }
+    for (const auto &d : detectors){
+        link_series += sizeof(Detector) + string_bytes(d.name) + vector_bytes(d.count) + vector_bytes(d.sum_v) + vector_bytes(d.occupied);
+    }
+    link_series += matrix_bytes(link_detectors);
+
+    size_t route_matrices = matrix_bytes(adj_mat_time) + matrix_bytes(route_next) + matrix_bytes(route_dist)
+                          + matrix_bytes(route_search_result.first) + matrix_bytes(route_search_result.second)
+                          + matrix_bytes(route_traveltime_profile);
+    for (const auto &pref : route_preference){
+        route_matrices += map_bytes(pref);
+    }
+    for (const auto &prefs : route_preference_profile){
+        route_matrices += matrix_bytes(prefs);
+    }
+
+    size_t name_maps = name_map_bytes(nodes_map) + name_map_bytes(links_map);
+    if (network){
+        name_maps += name_map_bytes(network->node_ids) + name_map_bytes(network->link_ids);
+        network_objects += matrix_bytes(network->successors);
+    }
+
+    ret["vehicle_objects"] = (double)vehicle_objects;
+    ret["vehicle_logs"] = (double)vehicle_logs;
+    ret["vehicle_preferences"] = (double)vehicle_preferences;
+    ret["network_objects"] = (double)network_objects;
+    ret["link_series"] = (double)link_series;
+    ret["link_samples"] = (double)link_samples;
+    ret["route_matrices"] = (double)route_matrices;
+    ret["name_maps"] = (double)name_maps;
+    double total = 0.0;
+    for (const auto &[_, bytes] : ret){
+        total += bytes;
+    }
+    ret["total"] = total;
+
+    // projection of the categories growing with time
+    double projected_logs = (double)vehicle_logs;
+    double projected_samples = (double)link_samples;
+    if (timestep > 0 && timestep < total_timesteps){
+        double ratio = (double)total_timesteps / (double)timestep;
+        projected_logs *= (rolling_window > 0) ? 1.0 : ratio;
+        projected_samples *= ratio;
+    }else if (timestep == 0 && !vehicles.empty()){
+        vector<vector<double>> adj(nodes.size(), vector<double>(nodes.size(), 0.0));
+        for (auto ln : links){
+            adj[ln->start_node->id][ln->end_node->id] = ln->length / ln->vmax;
+        }
+        size_t pops = count_dijkstra_pops;
+        auto [dist, next] = route_search_all(adj, 0.0);
+        count_dijkstra_pops = pops;
+        size_t record_bytes = 0;
+        if (vehicle_log_mode == vlmFULL){
+            record_bytes = ((vehicle_log_fields & vlfT) ? sizeof(double) : 0) + ((vehicle_log_fields & vlfSTATE) ? sizeof(int) : 0)
+                         + ((vehicle_log_fields & vlfLINK) ? sizeof(int) : 0) + ((vehicle_log_fields & vlfX) ? sizeof(double) : 0)
+                         + ((vehicle_log_fields & vlfV) ? sizeof(double) : 0);
+        }
+        for (auto veh : vehicles){
+            int i = veh->orig->id;
+            int k = veh->dest->id;
+            if (next[i][k] < 0){
+                continue;
+            }
+            if (veh->log_enabled){
+                projected_logs += (double)record_bytes * (dist[i][k] / delta_t / (double)vehicle_log_interval + 1.0);
+            }
+            // a pair of raw samples per traversed link
+            if (traveltime_keep_samples){
+                for (int n = i; n != k; n = next[n][k]){
+                    projected_samples += 2.0 * sizeof(double);
+                }
+            }
+        }
+    }
+    ret["projected_vehicle_logs"] = projected_logs;
+    ret["projected_link_samples"] = projected_samples;
+    ret["projected_total"] = total - (double)vehicle_logs - (double)link_samples + projected_logs + projected_samples;
+
+    return ret;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Timing
+// -----------------------------------------------------------------------
+
+const vector<string> TIMING_PHASE_NAMES = {
+    "link_update", "generate_signal", "transfer", "car_follow", "vehicle_update",
+    "route_search", "route_choice", "idle_skip", "other"
+};
+const vector<string> TIMING_COUNTER_NAMES = {"steps", "transfers", "route_choices", "dijkstra_pops"};
+
+/**
+ * @brief Enable or disable timing mode, in which the time spent in each phase of `main_loop` is measured.
+ * 
+ * @param enabled Whether measure the phase times.
+ * @param interval_t The interval of the timing series in seconds. If 0, the series is not recorded.
+ */
+void World::set_timing_mode(bool enabled, double interval_t){
+    if (interval_t < 0){
+        throw std::runtime_error("The interval of the timing series must be non-negative");
+    }
+    timing_mode = enabled;
+    timing_interval = (interval_t > 0) ? std::max((size_t)1, (size_t)std::round(interval_t / delta_t)) : 0;
+    timing_snapshot = timing_values();
+    timing_series.clear();
+}
+
+/**
+ * @brief Clear the measured times, the counters and the timing series.
+ */
+void World::reset_timing(){
+    timing_total.assign(tpCOUNT, 0.0);
+    count_steps = 0;
+    count_transfers = 0;
+    count_route_choices = 0;
+    count_dijkstra_pops = 0;
+    timing_snapshot = timing_values();
+    timing_series.clear();
+}
+
+/**
+ * @brief Add the time since the last lap to a phase in timing mode.
+ * 
+ * @param phase The phase.
+ */
+void World::timing_lap(int phase){
+    if (!timing_mode){
+        return;
+    }
+    auto now = std::chrono::steady_clock::now();
+    timing_total[phase] += std::chrono::duration<double>(now - timing_last).count();
+    timing_last = now;
+}
+
+/**
+ * @brief Count a finished step and record a row of the timing series at the end of each interval.
+ */
+void World::timing_step_end(){
+    count_steps++;
+    if (timing_interval > 0 && (timestep + 1) % timing_interval == 0){
+        vector<double> values = timing_values();
+        vector<double> row = {(double)(timestep + 1) * delta_t};
+        for (size_t i = 0; i < values.size(); i++){
+            row.push_back(values[i] - (i < timing_snapshot.size() ? timing_snapshot[i] : 0.0));
+        }
+        timing_series.push_back(row);
+        timing_snapshot = values;
+    }
+}
+
+/**
+ * @brief Get the phase times followed by the counters in the order of `TIMING_PHASE_NAMES` and `TIMING_COUNTER_NAMES`.
+ */
+vector<double> World::timing_values() const{
+    vector<double> values = timing_total;
+    values.push_back((double)count_steps);
+    values.push_back((double)count_transfers);
+    values.push_back((double)count_route_choices);
+    values.push_back((double)count_dijkstra_pops);
+    return values;
+}
+
+/**
+ * @brief Get the total time spent in each phase and the counters.
+ * 
+ * @return map<string, double> The time of each phase in seconds (0 unless timing mode is enabled), "total" time, and the counters "steps", "transfers", "route_choices", and "dijkstra_pops".
+ */
+map<string, double> World::get_timing() const{
+    map<string, double> ret;
+    vector<double> values = timing_values();
+    double total = 0.0;
+    for (size_t i = 0; i < tpCOUNT; i++){
+        ret[TIMING_PHASE_NAMES[i]] = values[i];
+        total += values[i];
+    }
+    ret["total"] = total;
+    for (size_t i = 0; i < TIMING_COUNTER_NAMES.size(); i++){
+        ret[TIMING_COUNTER_NAMES[i]] = values[tpCOUNT + i];
+    }
+    return ret;
+}
+
+/**
+ * @brief Get the timing series recorded in timing mode.
+ * 
+ * @return map<string, vector<double>> "t" (the end time of each interval) and the values of `get_timing` in each interval.
+ */
+map<string, vector<double>> World::get_timing_series() const{
+    map<string, vector<double>> ret;
+    vector<string> names = TIMING_PHASE_NAMES;
+    names.insert(names.end(), TIMING_COUNTER_NAMES.begin(), TIMING_COUNTER_NAMES.end());
+    ret["t"] = {};
+    ret["total"] = {};
+    for (const auto &n : names){
+        ret[n] = {};
+    }
+    for (const auto &row : timing_series){
+        ret["t"].push_back(row[0]);
+        double total = 0.0;
+        for (size_t i = 0; i < names.size(); i++){
+            ret[names[i]].push_back(row[i + 1]);
+            if (i < tpCOUNT){
+                total += row[i + 1];
+            }
+        }
+        ret["total"].push_back(total);
+    }
+    return ret;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Rolling mode
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Enable rolling mode, in which only a trailing window of link time series is kept and older data is spilled.
+ * 
+ * Every `window_t` seconds, the link series of the last window and the logs of vehicles retired in the meantime are passed to `spill` and then released.
+ * Finished vehicles are retired automatically in rolling mode.
+ * 
+ * Only the link series and the vehicle logs are bounded. The simulation still ends at `total_timesteps`, and the following grow with the number of vehicles or intervals:
+ * the Vehicle objects in `vehicles` (ids are their indices), the names, ids and offsets in `vehicle_archive`, and the stats and timing series. The detector series are allocated for the whole duration.
+ * 
+ * After the simulation has started, only the spill function of the current window can be replaced, e.g., for a world restored from a checkpoint.
+ * 
+ * @param window_t The length of the window in seconds.
+ * @param spill The function called with the first and past-the-end timesteps of spilled data. If empty, the data is dropped.
+ */
+void World::set_rolling_mode(double window_t, std::function<void(size_t, size_t)> spill){
+    if (window_t <= 0.0){
+        throw std::runtime_error("`window_t` of rolling mode must be positive");
+    }
+    size_t window = (size_t)ceil(window_t / delta_t);
+    if (timestep != 0){
+        // a world restored from a checkpoint only needs the spill function again
+        if (window == rolling_window){
+            rolling_spill = spill;
+            return;
+        }
+        throw std::runtime_error("Rolling mode must be set before the simulation starts");
+    }
+    if (series_mode != smDENSE){
+        throw std::runtime_error("Rolling mode cannot be used with compressed link series");
+    }
+    rolling_window = window;
+    rolling_spill = spill;
+    rolling_spilled_until = 0;
+    vehicle_retire_mode = true;
+    for (auto ln : links){
+        ln->init_series(rolling_window);
+    }
+}
+
+/**
+ * @brief Set the storage of link time series. It must be set before the simulation starts.
+ * 
+ * @param mode The mode in `SeriesMode`. In compressed modes, only the breakpoints where the values change are stored. They cannot be used with rolling mode.
+ */
+void World::set_series_mode(int mode){
+    if (mode < smDENSE || mode > smCOMPRESSED_F32){
+        throw std::runtime_error("Unknown link series mode " + std::to_string(mode));
+    }
+    if (timestep != 0){
+        throw std::runtime_error("The link series mode must be set before the simulation starts");
+    }
+    if (mode != smDENSE && rolling_window > 0){
+        throw std::runtime_error("Compressed link series cannot be used with rolling mode");
+    }
+    series_mode = mode;
+    for (auto ln : links){
+        ln->init_series(rolling_window);
+    }
+}
+
+/**
+ * @brief Spill the data of the last window if the current timestep is at the end of a window.
+ */
+void World::rolling_spill_check(){
+    if (rolling_window > 0 && timestep > 0 && timestep % rolling_window == 0 && rolling_spilled_until < timestep){
+        rolling_spill_range(rolling_spilled_until, timestep);
+    }
+}
+
+/**
+ * @brief Pass the data in the range of timesteps to the spill function and release the spilled vehicle logs.
+ * 
+ * @param ts_start The first timestep.
+ * @param ts_end The timestep after the last one.
+ */
+void World::rolling_spill_range(size_t ts_start, size_t ts_end){
+    if (rolling_spill){
+        rolling_spill(ts_start, ts_end);
+    }
+    vehicle_archive.spill();
+    // the raw travel time samples are not used by the simulation
+    for (auto ln : links){
+        ln->traveltime_t.clear();
+        ln->traveltime_tt.clear();
+    }
+    rolling_spilled_until = ts_end;
+}
+
+/**
+ * @brief Get a time series of all links.
+ * 
+ * @param kind The name of the series: "arrival_curve", "departure_curve", "traveltime_real", or "traveltime_instant".
+ * @param ts_start The first timestep.
+ * @param ts_end The timestep after the last one.
+ * @return vector<vector<double>> The series of each link.
+ */
+vector<vector<double>> World::get_link_series(const string &kind, size_t ts_start, size_t ts_end){
+    LinkSeries Link::*series;
+    if (kind == "arrival_curve"){
+        series = &Link::arrival_curve;
+    } else if (kind == "departure_curve"){
+        series = &Link::departure_curve;
+    } else if (kind == "traveltime_real"){
+        series = &Link::traveltime_real;
+    } else if (kind == "traveltime_instant"){
+        series = &Link::traveltime_instant;
+    } else {
+        throw std::runtime_error("Unknown link series `" + kind + "`");
+    }
+    vector<vector<double>> ret;
+    ret.reserve(links.size());
+    for (auto ln : links){
+        ret.push_back((ln->*series).range(ts_start, ts_end));
+    }
+    return ret;
+}
+
+/**
+ * @brief Get the ids of retired vehicles in the archive.
+ * 
+ * @param unspilled_only If true, only vehicles whose logs have not been spilled are returned.
+ * @return vector<int>
+ */
+vector<int> World::get_archived_vehicle_ids(bool unspilled_only){
+    if (unspilled_only){
+        return vector<int>(vehicle_archive.vehicle_ids.begin() + vehicle_archive.spilled_count, vehicle_archive.vehicle_ids.end());
+    }
+    return vehicle_archive.vehicle_ids;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Fork
+// -----------------------------------------------------------------------
+
+/**
+ * @brief Create a deep copy of the world including the complete simulation state.
+ * 
+ * Nodes, links and vehicles are copied with all pointers remapped to the objects of the new world, so that the copy can be simulated and modified independently.
+ * The spill function of rolling mode is not copied.
+ * 
+ * @return std::unique_ptr<World> The new world.
+ */
+std::unique_ptr<World> World::fork() const {
+    auto wf = std::make_unique<World>(name, t_max, delta_n, tau, duo_update_time, duo_update_weight,
+        route_choice_uncertainty, print_mode, random_seed, vehicle_log_mode);
+    World *f = wf.get();
+
+    f->delta_t = delta_t;
+    f->total_timesteps = total_timesteps;
+    f->timestep_for_route_update = timestep_for_route_update;
+    f->timestep = timestep;
+    f->time = time;
+    f->flag_initialized = flag_initialized;
+    f->ave_v = ave_v;
+    f->ave_vratio = ave_vratio;
+    f->trips_total = trips_total;
+    f->trips_completed = trips_completed;
+    f->run_samples = run_samples;
+    f->sum_v = sum_v;
+    f->sum_vratio = sum_vratio;
+    f->total_travel_time = total_travel_time;
+    f->total_delay = total_delay;
+    f->vehicle_distance = vehicle_distance;
+    f->stats_interval = stats_interval;
+    f->traveltime_stats_interval = traveltime_stats_interval;
+    f->traveltime_keep_samples = traveltime_keep_samples;
+    f->stats_snapshot = stats_snapshot;
+    f->stats_series = stats_series;
+    f->detectors = detectors;
+    f->link_detectors = link_detectors;
+    f->rng = rng;
+    f->writer = writer;
+    f->writer_holder = writer_holder;
+    f->vehicle_log_reserve_size = vehicle_log_reserve_size;
+    f->vehicle_log_interval = vehicle_log_interval;
+    f->vehicle_log_sample_ratio = vehicle_log_sample_ratio;
+    f->vehicle_log_fields = vehicle_log_fields;
+    f->vehicle_log_wait = vehicle_log_wait;
+    f->vehicle_retire_mode = vehicle_retire_mode;
+    f->vehicle_archive = vehicle_archive;
+    f->idle_skip_mode = idle_skip_mode;
+    f->rolling_window = rolling_window;
+    f->series_mode = series_mode;
+    f->rolling_spilled_until = rolling_spilled_until;
+
+    // Copy the objects first, then remap their pointers by id
+    for (auto nd : nodes){
+        f->nodes.push_back(f->node_pool.create(*nd));
+    }
+    for (auto ln : links){
+        f->links.push_back(f->link_pool.create(*ln));
+    }
+    for (auto veh : vehicles){
+        f->vehicles.push_back(f->vehicle_pool.create(*veh));
+    }
+    f->node_id = node_id;
+    f->link_id = link_id;
+    f->vehicle_id = vehicle_id;
+
+    auto node_of = [f](const Node *nd){ return nd ? f->nodes[nd->id] : nullptr; };
+    auto link_of = [f](const Link *ln){ return ln ? f->links[ln->id] : nullptr; };
+    auto vehicle_of = [f](const Vehicle *veh){ return veh ? f->vehicles[veh->id] : nullptr; };
+    auto remap_preference = [&](const map<Link *, double> &pref){
+        map<Link *, double> ret;
+        for (const auto &[ln, value] : pref){
+            ret.emplace_hint(ret.end(), link_of(ln), value);
+        }
+        return ret;
+    };
+
+    // The frozen topology is shared
+    f->network = network;
+    for (auto nd : f->nodes){
+        nd->w = f;
+        for (auto &ln : nd->in_links) ln = link_of(ln);
+        for (auto &ln : nd->out_links) ln = link_of(ln);
+        for (auto &veh : nd->incoming_vehicles) veh = vehicle_of(veh);
+        for (auto &ln : nd->incoming_vehicles_requests) ln = link_of(ln);
+        for (auto &veh : nd->generation_queue) veh = vehicle_of(veh);
+    }
+    for (auto ln : f->links){
+        ln->w = f;
+        ln->start_node = node_of(ln->start_node);
+        ln->end_node = node_of(ln->end_node);
+        for (auto &veh : ln->vehicles) veh = vehicle_of(veh);
+    }
+    for (const auto &[name, nd] : nodes_map){
+        f->nodes_map.emplace(name, node_of(nd));
+    }
+    for (const auto &[name, ln] : links_map){
+        f->links_map.emplace(name, link_of(ln));
+    }
+    for (auto veh : f->vehicles){
+        veh->w = f;
+        veh->orig = node_of(veh->orig);
+        veh->dest = node_of(veh->dest);
+        veh->link = link_of(veh->link);
+        veh->leader = vehicle_of(veh->leader);
+        veh->follower = vehicle_of(veh->follower);
+        veh->route_next_link = link_of(veh->route_next_link);
+        veh->route_preference = remap_preference(veh->route_preference);
+        for (auto &ln : veh->links_preferred) ln = link_of(ln);
+    }
+    for (const auto &[name, veh] : vehicles_map){
+        f->vehicles_map.emplace(name, vehicle_of(veh));
+    }
+
+    // Copying keeps the iteration order, which affects the simulation
+    f->vehicles_living = vehicles_living;
+    for (auto &[_, veh] : f->vehicles_living) veh = vehicle_of(veh);
+    f->vehicles_running = vehicles_running;
+    for (auto &[_, veh] : f->vehicles_running) veh = vehicle_of(veh);
+
+    for (const auto &pref : route_preference){
+        f->route_preference.push_back(remap_preference(pref));
+    }
+    f->adj_mat_time = adj_mat_time;
+    f->route_next = route_next;
+    f->route_dist = route_dist;
+    f->route_traveltime_profile = route_traveltime_profile;
+    route_search_wait();
+    f->route_search_lag = route_search_lag;
+    f->route_search_pending = route_search_pending;
+    f->route_search_due = route_search_due;
+    f->route_search_result = route_search_result;
+    f->timing_mode = timing_mode;
+    f->timing_interval = timing_interval;
+    f->timing_snapshot = f->timing_values();
+    f->day_to_day_weight = day_to_day_weight;
+    f->route_preference_profile = route_preference_profile;
+
+    return wf;
+}
+
+// -----------------------------------------------------------------------
+// MARK: Checkpoint
+// -----------------------------------------------------------------------
+
+const char CHECKPOINT_MAGIC[8] = {'U', 'X', 'S', 'P', 'C', 'K', 'P', 'T'};
+const uint32_t CHECKPOINT_VERSION = 8;
+
+template <typename T>
+inline int id_of(const T *obj){
+    return obj ? obj->id : -1;
+}
+
+template <typename T>
+inline vector<int> ids_of(const T &objs){
+    vector<int> ids;
+    ids.reserve(objs.size());
+    for (auto obj : objs){
+        ids.push_back(id_of(obj));
+    }
+    return ids;
+}
+
+/**
+ * @brief Check an object id read from a checkpoint before it is used as an index.
+ * 
+ * @param id The id. -1 means no object if `nullable` is true.
+ * @param size The number of the objects.
+ * @param nullable Whether -1 is allowed.
+ * @return int The id.
+ */
+inline int checked_id(int id, size_t size, bool nullable = false){
+    if ((nullable && id == -1) || (id >= 0 && (size_t)id < size)){
+        return id;
+    }
+    throw std::runtime_error("Checkpoint does not match the network: object id " + std::to_string(id) + " is out of range");
+}
+
+inline void write_preference(BinaryWriter &out, const map<Link *, double> &pref){
+    vector<int> ids;
+    vector<double> values;
+    for (const auto &[ln, value] : pref){
+        ids.push_back(ln->id);
+        values.push_back(value);
+    }
+    out.write_vector(ids);
+    out.write_vector(values);
+}
+
+inline map<Link *, double> read_preference(BinaryReader &in, const vector<Link *> &links){
+    vector<int> ids = in.read_vector<int>();
+    vector<double> values = in.read_vector<double>();
+    if (ids.size() != values.size()){
+        throw std::runtime_error("Checkpoint does not match the network: broken route preference");
+    }
+    map<Link *, double> pref;
+    for (size_t i = 0; i < ids.size(); i++){
+        pref[links[checked_id(ids[i], links.size())]] = values[i];
+    }
+    return pref;
+}
+
+template <typename T>
+inline void write_matrix(BinaryWriter &out, const vector<vector<T>> &mat){
+    out.write<uint64_t>(mat.size());
+    for (const auto &row : mat){
+        out.write_vector(row);
+    }
+}
+
+template <typename T>
+inline vector<vector<T>> read_matrix(BinaryReader &in){
+    vector<vector<T>> mat(in.read<uint64_t>());
+    for (auto &row : mat){
+        row = in.read_vector<T>();
+    }
+    return mat;
+}
+
+inline void write_series(BinaryWriter &out, const LinkSeries &series){
+    out.write<uint64_t>(series.length);
+    out.write<uint64_t>(series.window);
+    out.write<uint64_t>(series.ts_latest);
+    out.write_vector(series.data);
+    out.write(series.mode);
+    out.write_vector(series.bp_ts);
+    out.write_vector(series.bp_value);
+    out.write_vector(series.bp_value32);
+    out.write(series.value_latest);
+}
+
+inline void read_series(BinaryReader &in, LinkSeries &series){
+    series.length = in.read<uint64_t>();
+    series.window = in.read<uint64_t>();
+    series.ts_latest = in.read<uint64_t>();
+    series.data = in.read_vector<double>();
+    series.mode = in.read<int>();
+    series.bp_ts = in.read_vector<uint32_t>();
+    series.bp_value = in.read_vector<double>();
+    series.bp_value32 = in.read_vector<float>();
+    series.value_latest = in.read<double>();
+}
+
+/**
+ * @brief Save the complete simulation state to a binary file.
+ * 
+ * The simulation can be continued by `main_loop` after restoring the file with `load_checkpoint`. The spill function of rolling mode is not saved.
+ * 
+ * Values are written in the native byte order and struct layout, so a checkpoint can only be restored on a machine with the same architecture and build.
+ * 
+ * @param fname The file name.
+ */
+void World::save_checkpoint(const string &fname){
+    std::ofstream ofs(fname, std::ios::binary);
+    if (!ofs){
+        throw std::runtime_error("Cannot open checkpoint file `" + fname + "`");
+    }
+    BinaryWriter out(ofs);
+
+    out.write(CHECKPOINT_MAGIC);
+    out.write(CHECKPOINT_VERSION);
+
+    // Config
+    out.write_string(name);
+    out.write(t_max);
+    out.write(delta_n);
+    out.write(tau);
+    out.write(duo_update_time);
+    out.write(duo_update_weight);
+    out.write(print_mode);
+    out.write(delta_t);
+    out.write<uint64_t>(total_timesteps);
+    out.write<uint64_t>(timestep_for_route_update);
+    out.write(route_choice_uncertainty);
+    out.write(random_seed);
+    out.write(vehicle_log_mode);
+    out.write<uint64_t>(vehicle_log_interval);
+    out.write(vehicle_log_sample_ratio);
+    out.write(vehicle_log_fields);
+    out.write(vehicle_log_wait);
+    out.write<uint64_t>(vehicle_log_reserve_size);
+    out.write(vehicle_retire_mode);
+    out.write(idle_skip_mode);
+    out.write<uint64_t>(rolling_window);
+    out.write(series_mode);
+    out.write<uint64_t>(rolling_spilled_until);
+
+    // Clock, stats and randomness
+    out.write<uint64_t>(timestep);
+    out.write(time);
+    out.write(flag_initialized);
+    out.write(ave_v);
+    out.write(ave_vratio);
+    out.write(trips_total);
+    out.write(trips_completed);
+    out.write(run_samples);
+    out.write(sum_v);
+    out.write(sum_vratio);
+    out.write(total_travel_time);
+    out.write(total_delay);
+    out.write(vehicle_distance);
+    out.write<uint64_t>(stats_interval);
+    out.write<uint64_t>(traveltime_stats_interval);
+    out.write(traveltime_keep_samples);
+    out.write_vector(stats_snapshot);
+    write_matrix(out, stats_series);
+    out.write<uint64_t>(detectors.size());
+    for (const auto &d : detectors){
+        out.write_string(d.name);
+        out.write(d.link);
+        out.write(d.x);
+        out.write<uint64_t>(d.interval);
+        out.write_vector(d.count);
+        out.write_vector(d.sum_v);
+        out.write_vector(d.occupied);
     }
+    write_matrix(out, link_detectors);
+    std::ostringstream rng_state;
+    rng_state << rng;
+    out.write_string(rng_state.str());
 
-    vector<vector<double>> dist(nsize, vector<double>(nsize, infty));
-    vector<vector<int>> next_hop(nsize, vector<int>(nsize, -1));
-    
-    // 優先度付きキューを使用: pair<距離, 頂点番号>
-    using pdi = pair<double, int>;
-    std::priority_queue<pdi, vector<pdi>, std::greater<pdi>> pq;
-    
-    // 各始点からダイクストラ法を実行
-    for (int start = 0; start < nsize; start++) {
-        vector<bool> visited(nsize, false);
-        dist[start][start] = 0.0;
-        next_hop[start][start] = start;
-        pq.push({0.0, start});
-        
-        while (!pq.empty()) {
-            auto [d, current] = pq.top();
-            pq.pop();
-            
-            if (visited[current]) continue;
-            visited[current] = true;
-            
-            // 隣接リストを使用した隣接頂点の探索
-            for (const auto& [next, weight] : adj_list[current]) {
-                double new_dist = dist[start][current] + weight;
-                if (new_dist < dist[start][next]) {
-                    dist[start][next] = new_dist;
-                    // 次のホップを更新
-                    next_hop[start][next] = (current == start) ? 
-                                          next : next_hop[start][current];
-                    pq.push({new_dist, next});
-                }
-            }
-        }
+    // Definitions of objects
+    out.write<uint64_t>(nodes.size());
+    for (auto nd : nodes){
+        out.write_string(nd->name);
+        out.write(nd->x);
+        out.write(nd->y);
+        out.write_vector(nd->signal_intervals);
+        out.write(nd->signal_offset);
+    }
+    out.write<uint64_t>(links.size());
+    for (auto ln : links){
+        out.write_string(ln->name);
+        out.write(ln->start_node->id);
+        out.write(ln->end_node->id);
+        out.write(ln->vmax);
+        out.write(ln->kappa);
+        out.write(ln->length);
+        out.write(ln->merge_priority);
+        out.write(ln->capacity_out);
+        out.write_vector(ln->signal_group);
+    }
+    out.write<uint64_t>(vehicles.size());
+    for (auto veh : vehicles){
+        out.write_string(veh->name);
+        out.write(veh->departure_time);
+        out.write(veh->orig->id);
+        out.write(veh->dest->id);
+    }
+
+    // States of objects
+    for (auto nd : nodes){
+        out.write(nd->signal_t);
+        out.write(nd->signal_phase);
+        out.write_vector(ids_of(nd->incoming_vehicles));
+        out.write_vector(ids_of(nd->incoming_vehicles_requests));
+        out.write_vector(ids_of(nd->generation_queue));
+    }
+    for (auto ln : links){
+        out.write(ln->delta);
+        out.write(ln->tau);
+        out.write(ln->capacity);
+        out.write(ln->backward_wave_speed);
+        out.write(ln->capacity_out_remain);
+        out.write_vector(ids_of(ln->vehicles));
+        out.write_vector(ln->traveltime_tt);
+        out.write_vector(ln->traveltime_t);
+        out.write(ln->traveltime_last);
+        out.write_vector(ln->traveltime_interval_count);
+        out.write_vector(ln->traveltime_interval_sum);
+        ln->traveltime_sketch.write(out);
+        write_series(out, ln->arrival_curve);
+        write_series(out, ln->departure_curve);
+        write_series(out, ln->traveltime_real);
+        write_series(out, ln->traveltime_instant);
+    }
+    for (auto veh : vehicles){
+        out.write(id_of(veh->link));
+        out.write(veh->arrival_time);
+        out.write(veh->travel_time);
+        out.write(veh->x);
+        out.write(veh->x_next);
+        out.write(veh->v);
+        out.write(id_of(veh->leader));
+        out.write(id_of(veh->follower));
+        out.write(veh->state);
+        out.write(veh->arrival_time_link);
+        out.write(id_of(veh->route_next_link));
+        out.write(veh->route_choice_flag_on_link);
+        out.write(veh->route_adaptive);
+        out.write(veh->route_choice_uncertainty);
+        write_preference(out, veh->route_preference);
+        out.write(veh->route_choice_principle);
+        out.write_vector(ids_of(veh->links_preferred));
+        out.write(veh->log_enabled);
+        out.write_vector(veh->log_t);
+        out.write_vector(veh->log_state);
+        out.write_vector(veh->log_link);
+        out.write_vector(veh->log_x);
+        out.write_vector(veh->log_v);
+        out.write_vector(veh->log_segments);
+        out.write(veh->log_x_last);
+        out.write(veh->archive_index);
+    }
+
+    // Archive of retired vehicles
+    out.write_vector(vehicle_archive.offsets);
+    out.write_vector(vehicle_archive.log_t);
+    out.write_vector(vehicle_archive.log_state);
+    out.write_vector(vehicle_archive.log_link);
+    out.write_vector(vehicle_archive.log_x);
+    out.write_vector(vehicle_archive.log_v);
+    out.write_vector(vehicle_archive.log_segments);
+    out.write_string(vehicle_archive.names);
+    out.write_vector(vehicle_archive.name_offsets);
+    out.write_vector(vehicle_archive.vehicle_ids);
+    out.write<uint64_t>(vehicle_archive.spilled_count);
+    out.write<uint64_t>(vehicle_archive.column_base);
+
+    // Collections whose iteration order affects the simulation
+    out.write_vector(unordered_map_keys(vehicles_living));
+    out.write<uint64_t>(vehicles_living.bucket_count());
+    out.write_vector(unordered_map_keys(vehicles_running));
+    out.write<uint64_t>(vehicles_running.bucket_count());
+
+    // Route choice
+    out.write<uint64_t>(route_preference.size());
+    for (const auto &pref : route_preference){
+        write_preference(out, pref);
+    }
+    write_matrix(out, adj_mat_time);
+    write_matrix(out, route_next);
+    write_matrix(out, route_dist);
+    route_search_wait();
+    out.write<uint64_t>(route_search_lag);
+    out.write(route_search_pending);
+    out.write<uint64_t>(route_search_due);
+    write_matrix(out, route_search_result.first);
+    write_matrix(out, route_search_result.second);
+    write_matrix(out, route_traveltime_profile);
+    out.write(day_to_day_weight);
+    out.write<uint64_t>(route_preference_profile.size());
+    for (const auto &prefs : route_preference_profile){
+        write_matrix(out, prefs);
+    }
+
+    out.write(CHECKPOINT_MAGIC);
+    if (!ofs){
+        throw std::runtime_error("Failed to write checkpoint file `" + fname + "`");
     }
-    
-    return {dist, next_hop};
 }
 
 /**
- * @brief Update route choice using dynamic user optimum.
+ * @brief Restore the complete simulation state from a binary file written by `save_checkpoint`.
+ * 
+ * The world must be empty, i.e., it must not have any nodes, links or vehicles.
+ * The object ids in the file are checked before they are used, so a broken file raises an error instead of corrupting the memory.
+ * 
+ * @param fname The file name.
  */
-void World::route_choice_duo(){
-    for (auto dest : nodes){
-        int k = dest->id;
+void World::load_checkpoint(const string &fname){
+    if (!nodes.empty() || !links.empty() || !vehicles.empty()){
+        throw std::runtime_error("A checkpoint can only be loaded into an empty World");
+    }
+    std::ifstream ifs(fname, std::ios::binary);
+    if (!ifs){
+        throw std::runtime_error("Cannot open checkpoint file `" + fname + "`");
+    }
+    BinaryReader in(ifs);
 
-        auto duo_update_weight_tmp = duo_update_weight;
-        if (sum_map_values(route_preference[k]) == 0){
-             duo_update_weight_tmp = 1; //initialize with deterministic shortest path
+    auto check_magic = [&](){
+        char magic[8];
+        for (auto &c : magic){
+            c = in.read<char>();
         }
-
-        // For each link in the world, update preference
-        for (auto ln : links){
-            int i = ln->start_node->id;
-            int j = ln->end_node->id;
-            if (route_next[i][k] == j){
-                route_preference[k][ln] = (1.0 - duo_update_weight) * route_preference[k][ln] + duo_update_weight;
-            }else{
-                route_preference[k][ln] = (1.0 - duo_update_weight) * route_preference[k][ln];
-            }
+        if (!std::equal(magic, magic + 8, CHECKPOINT_MAGIC)){
+            throw std::runtime_error("`" + fname + "` is not a valid checkpoint file");
+        }
+    };
+    check_magic();
+    uint32_t version = in.read<uint32_t>();
+    if (version != CHECKPOINT_VERSION){
+        uint32_t swapped = ((version & 0xFFu) << 24) | ((version & 0xFF00u) << 8) | ((version >> 8) & 0xFF00u) | (version >> 24);
+        if (swapped == CHECKPOINT_VERSION){
+            throw std::runtime_error("`" + fname + "` was written on a machine with a different byte order");
         }
+        throw std::runtime_error("Unsupported checkpoint version in `" + fname + "`");
     }
-}
 
-void World::print_scenario_stats(){
-    if (print_mode == 1){
-        (*writer) << "Scenario statistics:\n";
-        (*writer) << "    duration: " << t_max << " s\n";
-        (*writer) << "    timesteps: " << total_timesteps << "\n";
-        (*writer) << "    nodes: " << nodes.size() << "\n";
-        (*writer) << "    links: " << links.size() << "\n";
-        (*writer) << "    vehicles: " << (int)vehicles.size() * (int)delta_n << " veh\n";
-        (*writer) << "    platoon size: " << delta_n << " veh\n";
-        (*writer) << "    platoons: " << vehicles.size() << "\n";
-        (*writer) << "    vehicles: " << (double)vehicles.size() * delta_n << " veh\n";
+    // Config
+    name = in.read_string();
+    t_max = in.read<double>();
+    delta_n = in.read<double>();
+    tau = in.read<double>();
+    duo_update_time = in.read<double>();
+    duo_update_weight = in.read<double>();
+    print_mode = in.read<int>();
+    delta_t = in.read<double>();
+    total_timesteps = in.read<uint64_t>();
+    timestep_for_route_update = in.read<uint64_t>();
+    route_choice_uncertainty = in.read<double>();
+    random_seed = in.read<long long>();
+    vehicle_log_mode = in.read<int>();
+    vehicle_log_interval = in.read<uint64_t>();
+    vehicle_log_sample_ratio = in.read<double>();
+    vehicle_log_fields = in.read<int>();
+    vehicle_log_wait = in.read<bool>();
+    vehicle_log_reserve_size = in.read<uint64_t>();
+    vehicle_retire_mode = in.read<bool>();
+    idle_skip_mode = in.read<bool>();
+    rolling_window = in.read<uint64_t>();
+    series_mode = in.read<int>();
+    rolling_spilled_until = in.read<uint64_t>();
+    rolling_spill = nullptr;
+
+    // Clock, stats and randomness
+    timestep = in.read<uint64_t>();
+    time = in.read<double>();
+    flag_initialized = in.read<bool>();
+    ave_v = in.read<double>();
+    ave_vratio = in.read<double>();
+    trips_total = in.read<double>();
+    trips_completed = in.read<double>();
+    run_samples = in.read<double>();
+    sum_v = in.read<double>();
+    sum_vratio = in.read<double>();
+    total_travel_time = in.read<double>();
+    total_delay = in.read<double>();
+    vehicle_distance = in.read<double>();
+    stats_interval = in.read<uint64_t>();
+    traveltime_stats_interval = in.read<uint64_t>();
+    traveltime_keep_samples = in.read<bool>();
+    stats_snapshot = in.read_vector<double>();
+    stats_series = read_matrix<double>(in);
+    detectors.resize(in.read<uint64_t>());
+    for (auto &d : detectors){
+        d.name = in.read_string();
+        d.link = in.read<int>();
+        d.x = in.read<double>();
+        d.interval = in.read<uint64_t>();
+        d.count = in.read_vector<double>();
+        d.sum_v = in.read_vector<double>();
+        d.occupied = in.read_vector<double>();
     }
-}
+    link_detectors = read_matrix<int>(in);
+    std::istringstream rng_state(in.read_string());
+    rng_state >> rng;
 
-void World::print_simple_results(){
-    double n = 0.0;
+    // Definitions of objects
+    size_t n_nodes = in.read<uint64_t>();
+    for (size_t i = 0; i < n_nodes; i++){
+        string node_name = in.read_string();
+        double x = in.read<double>();
+        double y = in.read<double>();
+        vector<double> signal_intervals = in.read_vector<double>();
+        double signal_offset = in.read<double>();
+        add_node(node_name, x, y, signal_intervals, signal_offset);
+    }
+    size_t n_links = in.read<uint64_t>();
+    for (size_t i = 0; i < n_links; i++){
+        string link_name = in.read_string();
+        int start_node = in.read<int>();
+        int end_node = in.read<int>();
+        double vmax = in.read<double>();
+        double kappa = in.read<double>();
+        double length = in.read<double>();
+        double merge_priority = in.read<double>();
+        double capacity_out = in.read<double>();
+        vector<int> signal_group = in.read_vector<int>();
+        start_node = checked_id(start_node, nodes.size());
+        end_node = checked_id(end_node, nodes.size());
+        add_link(link_name, nodes[start_node]->name, nodes[end_node]->name, vmax, kappa, length, merge_priority, capacity_out, signal_group);
+    }
+    size_t n_vehicles = in.read<uint64_t>();
+    for (size_t i = 0; i < n_vehicles; i++){
+        string vehicle_name = in.read_string();
+        double departure_time = in.read<double>();
+        int orig = checked_id(in.read<int>(), nodes.size());
+        int dest = checked_id(in.read<int>(), nodes.size());
+        add_vehicle(vehicle_name, departure_time, nodes[orig]->name, nodes[dest]->name);
+    }
+
+    auto link_of = [&](int id){ return id >= 0 ? links[checked_id(id, links.size())] : nullptr; };
+    auto vehicle_of = [&](int id){ return id >= 0 ? vehicles[checked_id(id, vehicles.size())] : nullptr; };
+    for (const auto &d : detectors){
+        checked_id(d.link, links.size());
+    }
+    if (link_detectors.size() > links.size()){
+        throw std::runtime_error("Checkpoint does not match the network: too many links with detectors");
+    }
+    for (const auto &ids : link_detectors){
+        for (int id : ids){
+            checked_id(id, detectors.size());
+        }
+    }
+
+    // States of objects
+    for (auto nd : nodes){
+        nd->signal_t = in.read<double>();
+        nd->signal_phase = in.read<int>();
+        nd->incoming_vehicles.clear();
+        for (int id : in.read_vector<int>()){
+            nd->incoming_vehicles.push_back(vehicle_of(id));
+        }
+        nd->incoming_vehicles_requests.clear();
+        for (int id : in.read_vector<int>()){
+            nd->incoming_vehicles_requests.push_back(link_of(id));
+        }
+        nd->generation_queue.clear();
+        for (int id : in.read_vector<int>()){
+            nd->generation_queue.push_back(vehicle_of(id));
+        }
+    }
+    for (auto ln : links){
+        ln->delta = in.read<double>();
+        ln->tau = in.read<double>();
+        ln->capacity = in.read<double>();
+        ln->backward_wave_speed = in.read<double>();
+        ln->capacity_out_remain = in.read<double>();
+        ln->vehicles.clear();
+        for (int id : in.read_vector<int>()){
+            ln->vehicles.push_back(vehicle_of(id));
+        }
+        ln->traveltime_tt = in.read_vector<double>();
+        ln->traveltime_t = in.read_vector<double>();
+        ln->traveltime_last = in.read<double>();
+        ln->traveltime_interval_count = in.read_vector<double>();
+        ln->traveltime_interval_sum = in.read_vector<double>();
+        ln->traveltime_sketch.read(in);
+        read_series(in, ln->arrival_curve);
+        read_series(in, ln->departure_curve);
+        read_series(in, ln->traveltime_real);
+        read_series(in, ln->traveltime_instant);
+    }
+    for (auto veh : vehicles){
+        veh->link = link_of(in.read<int>());
+        veh->arrival_time = in.read<double>();
+        veh->travel_time = in.read<double>();
+        veh->x = in.read<double>();
+        veh->x_next = in.read<double>();
+        veh->v = in.read<double>();
+        veh->leader = vehicle_of(in.read<int>());
+        veh->follower = vehicle_of(in.read<int>());
+        veh->state = in.read<int>();
+        veh->arrival_time_link = in.read<double>();
+        veh->route_next_link = link_of(in.read<int>());
+        veh->route_choice_flag_on_link = in.read<int>();
+        veh->route_adaptive = in.read<double>();
+        veh->route_choice_uncertainty = in.read<double>();
+        veh->route_preference = read_preference(in, links);
+        veh->route_choice_principle = in.read<int>();
+        veh->links_preferred.clear();
+        for (int id : in.read_vector<int>()){
+            veh->links_preferred.push_back(link_of(id));
+        }
+        veh->log_enabled = in.read<bool>();
+        veh->log_t = in.read_vector<double>();
+        veh->log_state = in.read_vector<int>();
+        veh->log_link = in.read_vector<int>();
+        veh->log_x = in.read_vector<double>();
+        veh->log_v = in.read_vector<double>();
+        veh->log_segments = in.read_vector<LogSegment>();
+        veh->log_x_last = in.read<double>();
+        veh->archive_index = in.read<int>();
+    }
 
+    // Archive of retired vehicles
+    vehicle_archive.offsets = in.read_vector<size_t>();
+    vehicle_archive.log_t = in.read_vector<double>();
+    vehicle_archive.log_state = in.read_vector<int>();
+    vehicle_archive.log_link = in.read_vector<int>();
+    vehicle_archive.log_x = in.read_vector<double>();
+    vehicle_archive.log_v = in.read_vector<double>();
+    vehicle_archive.log_segments = in.read_vector<LogSegment>();
+    vehicle_archive.names = in.read_string();
+    vehicle_archive.name_offsets = in.read_vector<size_t>();
+    vehicle_archive.vehicle_ids = in.read_vector<int>();
+    vehicle_archive.spilled_count = in.read<uint64_t>();
+    vehicle_archive.column_base = in.read<uint64_t>();
+    for (int id : vehicle_archive.vehicle_ids){
+        checked_id(id, vehicles.size());
+    }
     for (auto veh : vehicles){
-        trips_total += delta_n;
-        for (int j = 0; j < veh->log_state.size(); j++){
-            if (veh->log_state[j] == vsRUN){
-                double v_cur = veh->log_v[j];
-                ave_v += (v_cur - ave_v) / (n + 1.0);
-
-                Link *ln_ptr = nullptr;
-                if (veh->log_link[j] != -1){
-                    ln_ptr = get_link_by_id(veh->log_link[j]);
-                }
-                double denom_vmax = (ln_ptr) ? ln_ptr->vmax : 1.0;
-                double vratio = v_cur / denom_vmax;
+        checked_id(veh->archive_index, vehicle_archive.vehicle_ids.size(), true);
+    }
 
-                ave_vratio += (vratio - ave_vratio) / (n + 1.0);
-                n += 1.0;
-            }else if (veh->log_state[j] == vsEND){
-                trips_completed += delta_n;
-                break;
-            }
+    vehicles_map.clear();
+    for (auto veh : vehicles){
+        if (veh->archive_index < 0){
+            vehicles_map[veh->name] = veh;
         }
     }
 
-    (*writer) << "Stats:\n";
-    (*writer) << "    Average speed: " << ave_v << "\n";
-    (*writer) << "    Average speed ratio: " << ave_vratio << "\n";
-    (*writer) << "    Trips completion: "
-              << trips_completed << " / " << trips_total << "\n";
+    // Collections whose iteration order affects the simulation
+    vector<int> living = in.read_vector<int>();
+    restore_unordered_map(vehicles_living, living, in.read<uint64_t>(), vehicle_of);
+    vector<int> running = in.read_vector<int>();
+    restore_unordered_map(vehicles_running, running, in.read<uint64_t>(), vehicle_of);
+
+    // Route choice
+    route_preference.resize(in.read<uint64_t>());
+    if (!route_preference.empty() && route_preference.size() != nodes.size()){
+        throw std::runtime_error("Checkpoint does not match the network: broken route preference");
+    }
+    for (auto &pref : route_preference){
+        pref = read_preference(in, links);
+    }
+    adj_mat_time = read_matrix<double>(in);
+    route_next = read_matrix<int>(in);
+    route_dist = read_matrix<double>(in);
+    route_search_lag = in.read<uint64_t>();
+    route_search_pending = in.read<bool>();
+    route_search_due = in.read<uint64_t>();
+    route_search_result.first = read_matrix<double>(in);
+    route_search_result.second = read_matrix<int>(in);
+    route_traveltime_profile = read_matrix<double>(in);
+    day_to_day_weight = in.read<double>();
+    route_preference_profile.resize(in.read<uint64_t>());
+    for (auto &prefs : route_preference_profile){
+        prefs = read_matrix<double>(in);
+    }
+    if (flag_initialized){
+        freeze_network();
+    }
+
+    check_magic();
 }
 
 // -----------------------------------------------------------------------
-//MARK: mainloop
+// MARK: Day-to-day equilibrium
 // -----------------------------------------------------------------------
 
 /**
- * @brief Main simulation loop.
+ * @brief Set the link travel times used by the route search at each route update instead of the current ones.
  * 
- * @param duration_t Duration to run simulation.
- * @param until_t Time to run simulation until.
+ * @param profile profile[k][link id] is the travel time at the k-th route update. Non-positive values and updates beyond the profile fall back to the current travel times. An empty profile disables it.
  */
-void World::main_loop(double duration_t=-1, double until_t=-1){
-    int start_ts, end_ts;
-    start_ts = timestep;
-
-    if (duration_t < 0 && until_t < 0){
-        end_ts = total_timesteps;
-    } else if (duration_t >= 0 && until_t < 0){
-        end_ts = static_cast<size_t>(floor((duration_t+time)/delta_t)) + 1;
-    } else if (duration_t < 0 && until_t >= 0){
-        end_ts = static_cast<size_t>(floor(until_t/delta_t)) + 1;
-    } else {
-        throw std::runtime_error("Cannot specify both `duration_t` and `until_t` parameters for `World.main_loop`");
+void World::set_route_traveltime_profile(const vector<vector<double>> &profile){
+    for (const auto &row : profile){
+        if (row.size() != links.size()){
+            throw std::runtime_error("Each row of the travel time profile must have the travel times of all links");
+        }
     }
+    route_traveltime_profile = profile;
+}
 
-    if (end_ts > total_timesteps){
-        end_ts = total_timesteps;
+/**
+ * @brief Get the link travel times experienced by vehicles entering each link at each route update.
+ * 
+ * The travel time of a vehicle entering at timestep ts is obtained from the cumulative curves as the time until the departure curve reaches the arrival curve at ts.
+ * 
+ * @return vector<vector<double>> profile[k][link id] is the travel time at the k-th route update. The free flow travel time is used if no vehicle has entered the link, and the elapsed time is used as a lower bound if the vehicles have not left the link yet.
+ */
+vector<vector<double>> World::get_traveltime_profile(){
+    vector<vector<double>> profile;
+    if (timestep_for_route_update == 0){
+        return profile;
     }
-    if (end_ts <= start_ts){
-        return;
+    size_t ts_end = std::min(timestep, total_timesteps);
+    for (size_t ts = 0; ts < ts_end; ts += timestep_for_route_update){
+        profile.emplace_back(links.size(), 0.0);
     }
-
-    for (timestep = start_ts; timestep < end_ts; timestep++){
-        time = timestep*delta_t;
-
-        // Link updates
-        for (auto ln : links){
-            ln->update();
+    for (auto ln : links){
+        double tt_free = ln->length / ln->vmax;
+        size_t ts_out = ln->departure_curve.first_timestep();
+        for (size_t k = 0; k < profile.size(); k++){
+            size_t ts = k * timestep_for_route_update;
+            if (!ln->arrival_curve.contains(ts) || ln->arrival_curve.at(ts) == 0.0){
+                profile[k][ln->id] = tt_free;
+                continue;
+            }
+            // the departure curve is monotone, so the search resumes from the previous result
+            double arrivals = ln->arrival_curve.at(ts);
+            ts_out = std::max(ts_out, ts);
+            while (ts_out < ts_end && ln->departure_curve.at(ts_out) < arrivals){
+                ts_out++;
+            }
+            profile[k][ln->id] = std::max(tt_free, (double)(ts_out - ts) * delta_t);
         }
+    }
+    return profile;
+}
 
-        // Node generate & update
-        for (auto nd : nodes){
-            nd->generate();
-            nd->signal_update();
+/**
+ * @brief Compute the relative gap of completed trips against the shortest paths under a travel time profile.
+ * 
+ * For each completed trip, the shortest path travel time is computed from the travel times of the profile at the route update just before its departure.
+ * 
+ * @param profile profile[k][link id] is the travel time at the k-th route update, e.g., from `get_traveltime_profile`.
+ * @return double (sum of experienced travel times - sum of shortest path travel times) / sum of experienced travel times
+ */
+double World::equilibrium_gap(const vector<vector<double>> &profile){
+    if (profile.empty() || timestep_for_route_update == 0){
+        return 0.0;
+    }
+    vector<vector<Vehicle *>> departures(profile.size());
+    for (auto veh : vehicles){
+        if (veh->state == vsEND){
+            size_t k = std::min((size_t)(veh->departure_time / delta_t) / timestep_for_route_update, profile.size() - 1);
+            departures[k].push_back(veh);
         }
+    }
 
-        // Node transfer
-        for (auto nd : nodes){
-            nd->transfer();
+    double tt_total = 0.0;
+    double tt_shortest = 0.0;
+    vector<vector<double>> adj(nodes.size(), vector<double>(nodes.size(), 0.0));
+    for (size_t k = 0; k < profile.size(); k++){
+        if (departures[k].empty()){
+            continue;
         }
-
-        // car-following
-        int veh_count = 0;
-        double ave_speed = 0;
-        for (const auto& veh : vehicles_running){
-            veh.second->car_follow_newell();
-            
-            veh_count++;
-            ave_speed = ave_speed*(veh_count-1)/veh_count + veh.second->v/(veh_count);
+        for (auto ln : links){
+            adj[ln->start_node->id][ln->end_node->id] = profile[k][ln->id];
+        }
+        auto dist = route_search_all(adj, 0.0).first;
+        for (auto veh : departures[k]){
+            tt_total += veh->travel_time;
+            tt_shortest += std::min(dist[veh->orig->id][veh->dest->id], veh->travel_time);
         }
+    }
+    return tt_total > 0.0 ? (tt_total - tt_shortest) / tt_total : 0.0;
+}
 
-        // vehicle update: 安全な走査のため、一度キーをコピーする
-        for (auto it = vehicles_living.begin(); it != vehicles_living.end(); ) {
-            Vehicle* veh = it->second;
-            ++it;  // update 前に次のイテレータへ進める
-            veh->update();
+const char ROUTE_TABLE_MAGIC[8] = {'U', 'X', 'S', 'P', 'R', 'O', 'U', 'T'};
+const uint32_t ROUTE_TABLE_VERSION = 1;
 
-        }        
+/**
+ * @brief Save the route preferences, the day-to-day mode settings, and the travel time profile for route search to a binary file.
+ * 
+ * Nodes and links are identified by name, so the file can be loaded into another World of the same network.
+ * 
+ * @param fname The file name.
+ */
+void World::save_route_table(const string &fname){
+    std::ofstream ofs(fname, std::ios::binary);
+    if (!ofs){
+        throw std::runtime_error("Cannot open route table file `" + fname + "`");
+    }
+    BinaryWriter out(ofs);
+    out.write(ROUTE_TABLE_MAGIC);
+    out.write(ROUTE_TABLE_VERSION);
 
-        // route choice update
-        if (timestep_for_route_update > 0 && timestep % timestep_for_route_update == 0){
-            update_adj_time_matrix();            
-            auto res = route_search_all(adj_mat_time, 0.0);
-            route_dist = res.first;
-            route_next = res.second;
-            route_choice_duo();
-        }
+    out.write<uint64_t>(nodes.size());
+    for (auto nd : nodes){
+        out.write_string(nd->name);
+    }
+    out.write<uint64_t>(links.size());
+    for (auto ln : links){
+        out.write_string(ln->name);
+    }
 
-        // Print progress in steps
-        if (print_mode == 1 && total_timesteps > 0 && timestep % (total_timesteps / 10 == 0 ? 1 : total_timesteps / 10) == 0){
-            if (timestep == 0){
-                (*writer) <<  "Simulating..." << endl;
-                (*writer) <<  std::setw(10) << "time" 
-                    << "|"<< std::setw(14) <<  "# of vehicles"
-                    << "|"<< std::setw(11) << " ave speed" << endl;
-            }
-            (*writer) << std::setw(8) << std::fixed << std::setprecision(0) << time << " s"
-                  << "|" << std::setw(10) << veh_count*delta_n << " veh"
-                  << "|" << std::setw(7) << std::fixed << std::setprecision(2) << ave_speed << " m/s"
-                  << endl;
-        }        
+    // route_preference[dest][link id]
+    vector<vector<double>> pref_rows;
+    for (const auto &pref : route_preference){
+        vector<double> row(links.size(), 0.0);
+        for (const auto &[ln, value] : pref){
+            row[ln->id] = value;
+        }
+        pref_rows.push_back(row);
+    }
+    write_matrix(out, pref_rows);
+    out.write(day_to_day_weight);
+    out.write<uint64_t>(route_preference_profile.size());
+    for (const auto &prefs : route_preference_profile){
+        write_matrix(out, prefs);
+    }
+    write_matrix(out, route_traveltime_profile);
+    if (!ofs){
+        throw std::runtime_error("Failed to write route table file `" + fname + "`");
     }
 }
 
+/**
+ * @brief Load the route preferences, the day-to-day mode settings, and the travel time profile for route search saved by `save_route_table`.
+ * 
+ * The world is initialized if it is not yet. The nodes and links in the file must exist in the world.
+ * 
+ * @param fname The file name.
+ */
+void World::load_route_table(const string &fname){
+    std::ifstream ifs(fname, std::ios::binary);
+    if (!ifs){
+        throw std::runtime_error("Cannot open route table file `" + fname + "`");
+    }
+    BinaryReader in(ifs);
+    char magic[8];
+    for (auto &c : magic){
+        c = in.read<char>();
+    }
+    if (!std::equal(magic, magic + 8, ROUTE_TABLE_MAGIC) || in.read<uint32_t>() != ROUTE_TABLE_VERSION){
+        throw std::runtime_error("`" + fname + "` is not a valid route table file");
+    }
 
-bool World::check_simulation_ongoing(){
-    if (timestep < total_timesteps){
-        return true;
-    } else {
-        return false;
+    auto read_objects = [&](auto find){
+        vector<decltype(find(string()))> objs(in.read<uint64_t>());
+        for (auto &obj : objs){
+            string obj_name = in.read_string();
+            obj = find(obj_name);
+            if (obj == nullptr){
+                throw std::runtime_error("`" + obj_name + "` in the route table is not found in the World");
+            }
+        }
+        return objs;
+    };
+    vector<Node *> file_nodes = read_objects([this](const string &n){ return find_node(n); });
+    vector<Link *> file_links = read_objects([this](const string &n){ return find_link(n); });
+
+    // rows of the file are indexed by the node ids and the link ids at saving
+    auto remap_row = [&](const vector<double> &row){
+        vector<double> ret(row.empty() ? 0 : links.size(), 0.0);
+        for (size_t i = 0; i < row.size(); i++){
+            ret[file_links[i]->id] = row[i];
+        }
+        return ret;
+    };
+    auto remap_rows = [&](const vector<vector<double>> &rows){
+        vector<vector<double>> ret(rows.empty() ? 0 : nodes.size());
+        for (size_t k = 0; k < rows.size(); k++){
+            ret[file_nodes[k]->id] = remap_row(rows[k]);
+        }
+        return ret;
+    };
+
+    initialize_adj_matrix();
+    vector<vector<double>> pref_rows = remap_rows(read_matrix<double>(in));
+    for (size_t k = 0; k < pref_rows.size(); k++){
+        for (auto ln : links){
+            route_preference[k][ln] = pref_rows[k][ln->id];
+        }
     }
+    double file_day_to_day_weight = in.read<double>();
+    vector<vector<vector<double>>> pref_profile(in.read<uint64_t>());
+    for (auto &prefs : pref_profile){
+        prefs = remap_rows(read_matrix<double>(in));
+    }
+    vector<vector<double>> tt_profile;
+    for (const auto &row : read_matrix<double>(in)){
+        tt_profile.push_back(remap_row(row));
+    }
+    day_to_day_weight = file_day_to_day_weight;
+    route_preference_profile = pref_profile;
+    route_traveltime_profile = tt_profile;
 }
 
 // -----------------------------------------------------------------------
@@ -857,10 +4148,8 @@ bool World::check_simulation_ongoing(){
 // -----------------------------------------------------------------------
 
 Node *World::get_node(const string &node_name){
-    for (auto nd : nodes){
-        if (nd->name == node_name){
-            return nd;
-        }
+    if (Node *nd = find_node(node_name)){
+        return nd;
     }
     (*writer) << "Error at function get_node(): `"
               << node_name << "` not found\n";
@@ -868,10 +4157,8 @@ Node *World::get_node(const string &node_name){
 }
 
 Link *World::get_link(const string &link_name){
-    for (auto ln : links){
-        if (ln->name == link_name){
-            return ln;
-        }
+    if (Link *ln = find_link(link_name)){
+        return ln;
     }
     (*writer) << "Error at function get_link(): `"
               << link_name << "` not found\n";
@@ -881,7 +4168,7 @@ Link *World::get_link(const string &link_name){
 
 Vehicle *World::get_vehicle(const string &vehicle_name){
     for (auto vh : vehicles){
-        if (vh->name == vehicle_name){
+        if (vh->name_view() == vehicle_name){
             return vh;
         }
     }
@@ -891,6 +4178,10 @@ Vehicle *World::get_vehicle(const string &vehicle_name){
 }
 
 Link *World::get_link_by_id(const int link_id){
+    // ids are the indices in `links`
+    if (link_id >= 0 && (size_t)link_id < links.size() && links[link_id]->id == link_id){
+        return links[link_id];
+    }
     for (auto ln : links){
         if (ln->id == link_id){
             return ln;
@@ -915,15 +4206,14 @@ inline void add_demand(
         demand += flow * w->delta_t;
         if (demand > (double)w->delta_n){
             // create new vehicle
-            Vehicle *v = new Vehicle(
-                w,
+            Vehicle *v = w->add_vehicle(
                 orig_name + "-" + dest_name + "-" + std::to_string(t),
                 t,
                 orig_name,
                 dest_name);
             
             for (auto ln_str : links_preferred_str){
-                v->links_preferred.push_back(w->links_map[ln_str]);
+                v->links_preferred.push_back(w->find_link(ln_str));
             }
             //(void)v; // or store if needed //what is this???
 
@@ -7,7 +7,9 @@
 #include <vector>
 #include <deque>
 #include <string>
+#include <string_view>
 #include <cmath>
+#include <limits>
 #include <random>
 #include <map>
 #include <unordered_map>
@@ -16,6 +18,11 @@
 #include <queue>
 #include <execution>
 #include <thread>
+#include <functional>
+#include <stdexcept>
+#include <memory>
+#include <future>
+#include <atomic>
 
 #include "utils.h"
 
@@ -40,6 +47,143 @@ enum RouteChoicePrinciple : int {
     rcpFIXED = 1
 };
 
+enum VehicleLogMode : int {
+    vlmNONE       = 0,
+    vlmFULL       = 1,
+    vlmCOMPRESSED = 2
+};
+
+// Bit flags to select the recorded fields of vehicle logs
+enum VehicleLogField : int {
+    vlfT     = 1,
+    vlfSTATE = 2,
+    vlfLINK  = 4,
+    vlfX     = 8,
+    vlfV     = 16,
+    vlfALL   = 31
+};
+
+// Phases of a simulation step measured in timing mode
+enum TimingPhase : int {
+    tpLINK          = 0,
+    tpGENERATE      = 1,    // vehicle generation and signal update
+    tpTRANSFER      = 2,
+    tpCAR_FOLLOW    = 3,
+    tpVEHICLE       = 4,
+    tpROUTE_SEARCH  = 5,    // including waiting for the asynchronous search
+    tpROUTE_CHOICE  = 6,
+    tpIDLE          = 7,    // fast-forward over idle periods
+    tpOTHER         = 8,    // rolling spill and progress printing
+    tpCOUNT         = 9
+};
+extern const vector<string> TIMING_PHASE_NAMES;
+
+// A run of vehicle log samples in which state, link and speed are constant and the position increases by `dx` per timestep
+struct LogSegment {
+    double x;   // position at the first sample
+    double v;
+    double dx;
+    int ts;     // timestep of the first sample
+    int count;  // number of samples
+    int link;
+    int state;
+};
+
+// Columnar store of logs and names of retired vehicles. The records of each vehicle are in [offsets[i], offsets[i+1]).
+struct VehicleArchive {
+    vector<size_t> offsets;
+    vector<double> log_t;
+    vector<int> log_state;
+    vector<int> log_link;
+    vector<double> log_x;
+    vector<double> log_v;
+    vector<LogSegment> log_segments;
+
+    string names;
+    vector<size_t> name_offsets;
+    vector<int> vehicle_ids;
+
+    // Records before `spilled_count` have no logs. The columns start from the record `spilled_count`.
+    size_t spilled_count = 0;
+    size_t column_base = 0;
+
+    int append(const Vehicle *veh);
+    void spill();
+    void clear();
+    std::string_view get_name(int index) const;
+    void shrink_to_fit();
+    size_t size() const;
+
+    template <typename T>
+    vector<T> slice(const vector<T> &column, int index) const {
+        if (column.empty() || (size_t)index < spilled_count){
+            return {};
+        }
+        return vector<T>(column.begin() + (offsets[index] - column_base), column.begin() + (offsets[index+1] - column_base));
+    }
+};
+
+// A virtual loop detector at a position of a link. The values are aggregated in each interval.
+struct Detector {
+    string name;
+    int link;                   // link id
+    double x;                   // position from the start of the link
+    size_t interval;            // steps per interval
+    vector<double> count;       // veh crossed the detector
+    vector<double> sum_v;       // sum of the speeds of crossed vehicles weighted by veh
+    vector<double> occupied;    // time the detector is occupied in seconds
+};
+
+// Link-by-time matrices of traffic states by Edie's generalized definitions.
+// Each matrix is row-major with a row per link and `n_bins` columns.
+struct LinkStateMatrices {
+    double interval;            // length of a time bin in seconds
+    size_t n_links;
+    size_t n_bins;
+    bool from_trajectories;     // false if computed from the cumulative curves
+    vector<double> flow;        // veh/s
+    vector<double> density;     // veh/m
+    vector<double> speed;       // m/s, the free flow speed if no vehicle is present
+    vector<double> delay;       // veh*s, compared with the free flow speed
+};
+
+// -----------------------------------------------------------------------
+// MARK: class Network
+// -----------------------------------------------------------------------
+
+struct NodeSpec {
+    string name;
+    double x;
+    double y;
+    vector<double> signal_intervals;
+    double signal_offset;
+};
+
+struct LinkSpec {
+    string name;
+    int start_node;
+    int end_node;
+    double vmax;
+    double kappa;
+    double length;
+    double merge_priority;
+    double capacity_out;
+    vector<int> signal_group;
+};
+
+// Frozen network topology shared by Worlds.
+// Worlds on the same Network share its definitions, name maps and adjacency lists, and instantiate only per-run nodes and links holding queues and curves.
+struct Network {
+    vector<NodeSpec> nodes;
+    vector<LinkSpec> links;
+    unordered_map<string, int> node_ids;
+    unordered_map<string, int> link_ids;
+    vector<vector<int>> successors;  // successors[i]: the end nodes of the links from node i in ascending order
+
+    int find_node(const string &node_name) const;
+    int find_link(const string &link_name) const;
+};
+
 // -----------------------------------------------------------------------
 // MARK: class Node
 // -----------------------------------------------------------------------
@@ -84,6 +228,108 @@ struct Node {
     void transfer();
 
     void signal_update();
+
+    void reset();
+};
+
+// -----------------------------------------------------------------------
+// MARK: class LinkSeries
+// -----------------------------------------------------------------------
+
+// Storage of link time series
+enum SeriesMode : int {
+    smDENSE          = 0,   // a double per timestep
+    smCOMPRESSED     = 1,   // breakpoints where the value changes
+    smCOMPRESSED_F32 = 2    // breakpoints with float32 values
+};
+
+// Time series of a link state indexed by timestep.
+// In dense mode, all timesteps are stored. In rolling mode, only the latest `window` timesteps are kept in a ring buffer.
+// In compressed modes, only the breakpoints where the value changes are stored, and a value is found by binary search. The series must be written in the order of time.
+// As in dense mode, timesteps not written yet have the value 0.
+struct LinkSeries {
+    vector<double> data;
+    size_t length;      // number of timesteps of the whole simulation
+    size_t window;      // 0 in dense mode
+    size_t ts_latest;   // latest timestep written
+
+    int mode;
+    vector<uint32_t> bp_ts;     // timestep of each breakpoint
+    vector<double> bp_value;
+    vector<float> bp_value32;
+    double value_latest;        // exact value at `ts_latest` in compressed modes
+
+    LinkSeries() : length(0), window(0), ts_latest(0), mode(smDENSE), value_latest(0.0) {}
+
+    void init(size_t length, size_t window, int mode = smDENSE);
+
+    size_t index(size_t ts) const {
+        return window ? ts % window : ts;
+    }
+    double get(size_t ts) const {
+        if (mode != smDENSE){
+            return get_compressed(ts);
+        }
+        return data[index(ts)];
+    }
+    void set(size_t ts, double value){
+        if (mode != smDENSE){
+            set_compressed(ts, value);
+            return;
+        }
+        data[index(ts)] = value;
+        if (ts > ts_latest){
+            ts_latest = ts;
+        }
+    }
+    void add(size_t ts, double value){
+        if (mode != smDENSE){
+            set_compressed(ts, get_compressed(ts) + value);
+            return;
+        }
+        data[index(ts)] += value;
+        if (ts > ts_latest){
+            ts_latest = ts;
+        }
+    }
+
+    // value at the last timestep of the simulation
+    double back() const {
+        return at(length - 1);
+    }
+
+    size_t first_timestep() const;
+    bool contains(size_t ts) const;
+    double at(size_t ts) const;
+    vector<double> range(size_t ts_start, size_t ts_end) const;
+    vector<double> to_vector() const;
+    double sum(size_t ts_start, size_t ts_end) const;
+    size_t bytes() const;
+    void shrink_to_fit();
+
+    size_t breakpoint_count() const {
+        return bp_ts.size();
+    }
+    double breakpoint_value(size_t i) const {
+        return mode == smCOMPRESSED_F32 ? (double)bp_value32[i] : bp_value[i];
+    }
+    double get_compressed(size_t ts) const;
+    void set_compressed(size_t ts, double value);
+};
+
+// Results of batch link queries, an element per query
+struct LinkQueryResult {
+    vector<double> inflow;      // veh/s
+    vector<double> outflow;     // veh/s
+    vector<double> traveltime;  // mean of `traveltime_real` in s
+    vector<double> vehicles;    // mean number of vehicles on the link
+};
+
+// Results of batch time-dependent shortest path queries, an element per query
+struct RouteQueryResult {
+    vector<double> traveltime;  // s, NaN if the destination is unreachable
+    vector<vector<int>> paths;  // link ids, empty unless requested
+    size_t settled = 0;         // total number of nodes settled by the searches
 };
 
 // -----------------------------------------------------------------------
@@ -107,13 +353,18 @@ struct Link {
     double backward_wave_speed;
     deque<Vehicle *> vehicles;
 
+    // Travel times of traversals. The raw samples are kept only if World::traveltime_keep_samples is true
     vector<double> traveltime_tt; // increments of time
     vector<double> traveltime_t;
+    double traveltime_last;                     // latest travel time, negative if none
+    vector<double> traveltime_interval_count;   // veh exited in each interval
+    vector<double> traveltime_interval_sum;     // sum of travel times weighted by veh
+    QuantileSketch traveltime_sketch;
 
-    vector<double> arrival_curve;
-    vector<double> departure_curve;
-    vector<double> traveltime_real;
-    vector<double> traveltime_instant;
+    LinkSeries arrival_curve;
+    LinkSeries departure_curve;
+    LinkSeries traveltime_real;
+    LinkSeries traveltime_instant;
 
     double merge_priority;
 
@@ -137,6 +388,16 @@ struct Link {
 
     void update();
     void set_travel_time();
+    void fill_idle(size_t ts_from, size_t ts_to);
+    void init_series(size_t window);
+    void reset();
+
+    double inflow(double t1, double t2);
+    double outflow(double t1, double t2);
+
+    void add_traveltime_sample(double t, double tt);
+    double traveltime_quantile(double q) const;
+    double entry_traveltime(double t) const;
 
 };
 
@@ -178,12 +439,20 @@ struct Vehicle {
     vector<Link *> links_preferred;
 
     // Logging
+    bool log_enabled;
     vector<double> log_t;
     vector<int> log_state;
     vector<int> log_link;
     vector<double> log_x;
     vector<double> log_v;
 
+    // Logging in compressed mode
+    vector<LogSegment> log_segments;
+    double log_x_last;
+
+    // Index in the world-level archive after retirement, -1 if not retired
+    int archive_index;
+
     Vehicle(
         World *w,
         const string &vehicle_name,
@@ -197,6 +466,19 @@ struct Vehicle {
     void route_next_link_choice(vector<Link*> linkset);
     void record_travel_time(Link *link, double t);
     void log_data();
+    void log_data_compressed(double v_log);
+
+    void retire();
+    void reset();
+    std::string_view name_view() const;
+    void set_name(const string &new_name);
+    pair<const LogSegment *, const LogSegment *> get_log_segments() const;
+
+    vector<double> get_log_t();
+    vector<int> get_log_state();
+    vector<int> get_log_link();
+    vector<double> get_log_x();
+    vector<double> get_log_v();
 
 };
 
@@ -224,6 +506,11 @@ struct World {
     int link_id;
     int vehicle_id;
 
+    // Storage owning the objects
+    ObjectPool<Node> node_pool;
+    ObjectPool<Link> link_pool;
+    ObjectPool<Vehicle> vehicle_pool;
+
     // Collections of objects
     vector<Vehicle *> vehicles;         //all state
     vector<Link *> links;
@@ -241,25 +528,56 @@ struct World {
     double route_choice_uncertainty;
     vector<map<Link *, double>> route_preference;   //route_preference[dest][ln]: 目的ノードdestへのリンクlnの選好
 
+    // Network topology. It is frozen at initialization and can be shared by Worlds.
+    std::shared_ptr<const Network> network;
+
     // Graph adjacency
-    vector<vector<int>> adj_mat;
     vector<vector<double>> adj_mat_time;
     vector<vector<int>> route_next;
     vector<vector<double>> route_dist;
 
+    // Asynchronous route search. If route_search_lag > 0, the search runs on a worker thread and its result is applied route_search_lag steps later
+    size_t route_search_lag = 0;
+    bool route_search_pending = false;
+    size_t route_search_due = 0;
+    mutable std::future<pair<vector<vector<double>>, vector<vector<int>>>> route_search_future;
+    mutable pair<vector<vector<double>>, vector<vector<int>>> route_search_result;
+
     bool flag_initialized;
 
-    // stats
+    // Timing instrumentation. The counters are always updated, and the phase times only in timing mode
+    bool timing_mode = false;
+    size_t timing_interval = 0;     // steps per row of the timing series, 0 if not recorded
+    std::chrono::steady_clock::time_point timing_last;
+    vector<double> timing_total = vector<double>(tpCOUNT, 0.0);     // seconds
+    size_t count_steps = 0;
+    size_t count_transfers = 0;
+    size_t count_route_choices = 0;
+    std::atomic<size_t> count_dijkstra_pops{0};     // also updated by asynchronous route searches
+    vector<double> timing_snapshot;
+    vector<vector<double>> timing_series;
+
+    // stats accumulated during simulation
     double ave_v;
     double ave_vratio;
     double trips_total;
     double trips_completed;
+    double run_samples = 0.0;       // number of steps of running vehicles (platoons)
+    double sum_v = 0.0;
+    double sum_vratio = 0.0;
+    double total_travel_time = 0.0; // veh*s
+    double total_delay = 0.0;       // veh*s, compared with the free flow speed
+    double vehicle_distance = 0.0;  // veh*m
+    size_t stats_interval = 0;      // steps per row of the stats series, 0 if not recorded
+    vector<double> stats_snapshot;
+    vector<vector<double>> stats_series;
 
     // Randomness
     long long random_seed;
     std::mt19937 rng;
 
     std::ostream *writer;
+    std::shared_ptr<std::ostream> writer_holder;    // owns `writer` if it is created for this world
 
     World(
         const string &world_name,
@@ -271,29 +589,160 @@ struct World {
         double route_choice_uncertainty,
         int print_mode,
         long long random_seed,
-        bool vehicle_log_mode);
+        int vehicle_log_mode);
+    ~World();
+
+    Node *add_node(
+        const string &node_name,
+        double x,
+        double y,
+        vector<double> signal_intervals = {0},
+        double signal_offset = 0);
+    Link *add_link(
+        const string &link_name,
+        const string &start_node_name,
+        const string &end_node_name,
+        double vmax,
+        double kappa,
+        double length,
+        double merge_priority,
+        double capacity_out = -1.0,
+        vector<int> signal_group = {0});
+    Vehicle *add_vehicle(
+        const string &vehicle_name,
+        double departure_time,
+        const string &orig_name,
+        const string &dest_name);
+
+    std::shared_ptr<const Network> freeze_network();
+    void attach_network(std::shared_ptr<const Network> net);
+    Node *find_node(const string &node_name);
+    Link *find_link(const string &link_name);
 
     void initialize_adj_matrix();
     void update_adj_time_matrix();
 
+    // Day-to-day equilibrium
+    // route_traveltime_profile[k][link id]: link travel times used by the route search at the k-th route update instead of the current ones, if not empty
+    vector<vector<double>> route_traveltime_profile;
+    // If positive, the preferences at the k-th route update are updated from route_preference_profile[k][dest][link id] of the previous day with this weight
+    double day_to_day_weight = 0.0;
+    vector<vector<vector<double>>> route_preference_profile;
+    void set_route_traveltime_profile(const vector<vector<double>> &profile);
+    vector<vector<double>> get_traveltime_profile();
+    double equilibrium_gap(const vector<vector<double>> &profile);
+    void save_route_table(const string &fname);
+    void load_route_table(const string &fname);
+
     void route_choice_duo();
 
+    map<string, double> memory_usage();
+
+    void record_run_step(const Vehicle *veh);
+    void stats_step_end();
+    vector<double> stats_values() const;
+    void set_stats_interval(double interval_t);
+    map<string, double> get_stats() const;
+    map<string, vector<double>> get_stats_series() const;
+    bool trajectories_available() const;
+
+    // Link travel time stats
+    size_t traveltime_stats_interval;       // steps per interval
+    bool traveltime_keep_samples = false;   // keep the raw samples in Link::traveltime_t and Link::traveltime_tt
+    void set_traveltime_stats(double interval_t, bool keep_samples);
+
+    // Virtual loop detectors
+    vector<Detector> detectors;
+    vector<vector<int>> link_detectors;     // detector indices by link id
+    int add_detector(const string &detector_name, const string &link_name, double x, double interval_t);
+    void record_detectors(const Vehicle *veh);
+    void reset_detectors();
+    map<string, vector<double>> get_detector_data(const string &detector_name) const;
+    LinkStateMatrices compute_link_state_matrices(double interval_t);
+    LinkQueryResult query_links(const vector<int> &link_ids, const vector<double> &t1, const vector<double> &t2) const;
+
+    // Time-dependent shortest path queries
+    vector<double> freeflow_distances(int source, bool reverse) const;
+    RouteQueryResult query_routes(const vector<int> &orig_ids, const vector<int> &dest_ids, const vector<double> &departure_times,
+        bool return_paths, int n_landmarks, int n_threads) const;
+
+    void set_timing_mode(bool enabled, double interval_t);
+    void reset_timing();
+    void timing_lap(int phase);
+    void timing_step_end();
+    vector<double> timing_values() const;
+    map<string, double> get_timing() const;
+    map<string, vector<double>> get_timing_series() const;
+    void route_update();
+    void set_route_search_lag(size_t lag);
+    void route_search_start();
+    void route_search_apply();
+    void route_search_wait() const;
+    void route_search_cancel();
+
     // Route search (Floyd-Warshall style)
     pair<vector<vector<double>>, vector<vector<int>>> 
         route_search_all(const vector<vector<double>> &adj, double infty);
 
     void print_scenario_stats();
     void print_simple_results();
+    void print_progress(int veh_count, double ave_speed);
     void main_loop(double duration_t, double end_t);
+    void reset(bool keep_route_preference, bool reseed, long long random_seed);
+
+    // Fast-forward over globally idle periods
+    bool check_idle();
+    size_t next_departure_timestep();
+    void fast_forward(size_t ts_target);
 
     bool check_simulation_ongoing();
 
+    std::unique_ptr<World> fork() const;
+
+    // Checkpoint of the complete simulation state
+    void save_checkpoint(const string &fname);
+    void load_checkpoint(const string &fname);
+
     Node *get_node(const string &node_name);
     Link *get_link(const string &link_name);
     Link *get_link_by_id(const int link_id);
     Vehicle *get_vehicle(const string &vehicle_name);
 
     size_t vehicle_log_reserve_size;
-    bool vehicle_log_mode;
+    int vehicle_log_mode;
+
+    // Vehicle logging policy
+    size_t vehicle_log_interval;
+    double vehicle_log_sample_ratio;
+    int vehicle_log_fields;
+    bool vehicle_log_wait;
+
+    // Storage of link time series in `SeriesMode`
+    int series_mode = smDENSE;
+    void set_series_mode(int mode);
+
+    // Rolling mode: link time series are kept in ring buffers of `rolling_window` timesteps and older data is spilled
+    size_t rolling_window;
+    size_t rolling_spilled_until;
+    std::function<void(size_t, size_t)> rolling_spill;
+
+    void set_rolling_mode(double window_t, std::function<void(size_t, size_t)> spill);
+    void rolling_spill_check();
+    void rolling_spill_range(size_t ts_start, size_t ts_end);
+    vector<vector<double>> get_link_series(const string &kind, size_t ts_start, size_t ts_end);
+    vector<int> get_archived_vehicle_ids(bool unspilled_only);
+
+    // Retirement of finished vehicles
+    bool vehicle_retire_mode;
+    VehicleArchive vehicle_archive;
+
+    void set_vehicle_log_policy(
+        size_t interval,
+        double sample_ratio,
+        int fields,
+        bool log_wait,
+        size_t reserve_size);
+
+    bool idle_skip_mode;
 
 };
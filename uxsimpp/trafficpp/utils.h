@@ -6,6 +6,16 @@
 #include <vector>
 #include <random>
 #include <algorithm>
+#include <new>
+#include <utility>
+#include <string>
+#include <istream>
+#include <ostream>
+#include <stdexcept>
+#include <type_traits>
+#include <cstdint>
+#include <cmath>
+#include <unordered_map>
 
 using std::vector, std::cout, std::endl;
 
@@ -33,6 +43,282 @@ using std::vector, std::cout, std::endl;
 //     return arr;
 // }
 
+/**
+ * @brief Block-allocated storage owning objects of type T.
+ * 
+ * Objects are constructed in place in fixed-size blocks and never moved, so that raw pointers to them stay valid until the pool is cleared.
+ * Objects created one after another are placed contiguously in memory.
+ * 
+ * @tparam T The type of the objects.
+ */
+template <typename T>
+class ObjectPool {
+public:
+    explicit ObjectPool(size_t block_size = 256) : block_size(block_size), count(0) {}
+    ~ObjectPool(){
+        clear();
+    }
+    ObjectPool(const ObjectPool &) = delete;
+    ObjectPool &operator=(const ObjectPool &) = delete;
+
+    /**
+     * @brief Construct a new object in the pool.
+     * 
+     * @param args The arguments passed to the constructor of T.
+     * @return T* A pointer to the created object.
+     */
+    template <typename... Args>
+    T *create(Args&&... args){
+        if (count == blocks.size() * block_size){
+            blocks.push_back(static_cast<T *>(::operator new(sizeof(T) * block_size)));
+        }
+        T *slot = blocks[count / block_size] + count % block_size;
+        new (slot) T(std::forward<Args>(args)...);
+        count++;
+        return slot;
+    }
+
+    /**
+     * @brief Destroy all objects in reverse order of creation and release the memory.
+     */
+    void clear(){
+        for (size_t i = count; i > 0; i--){
+            (blocks[(i-1) / block_size] + (i-1) % block_size)->~T();
+        }
+        for (auto block : blocks){
+            ::operator delete(block);
+        }
+        blocks.clear();
+        count = 0;
+    }
+
+    size_t size() const {
+        return count;
+    }
+
+    /**
+     * @brief The memory reserved by the pool in bytes.
+     */
+    size_t capacity_bytes() const {
+        return blocks.size() * block_size * sizeof(T);
+    }
+
+private:
+    size_t block_size;
+    size_t count;
+    vector<T *> blocks;
+};
+
+/**
+ * @brief Writer of binary streams used for checkpoints.
+ * 
+ * Trivially copyable values and vectors of them are written as raw bytes in the native byte order and layout, so the streams are not portable across architectures. Vectors and strings are prefixed with their sizes.
+ */
+class BinaryWriter {
+public:
+    explicit BinaryWriter(std::ostream &os) : os(os) {}
+
+    template <typename T>
+    void write(const T &value){
+        static_assert(std::is_trivially_copyable_v<T>, "BinaryWriter::write requires a trivially copyable type");
+        os.write(reinterpret_cast<const char *>(&value), sizeof(T));
+    }
+
+    template <typename T>
+    void write_vector(const vector<T> &vec){
+        static_assert(std::is_trivially_copyable_v<T>, "BinaryWriter::write_vector requires a trivially copyable type");
+        write<uint64_t>(vec.size());
+        if (!vec.empty()){
+            os.write(reinterpret_cast<const char *>(vec.data()), sizeof(T) * vec.size());
+        }
+    }
+
+    void write_string(const std::string &str){
+        write<uint64_t>(str.size());
+        os.write(str.data(), str.size());
+    }
+
+private:
+    std::ostream &os;
+};
+
+/**
+ * @brief Reader of binary streams written by `BinaryWriter`.
+ */
+class BinaryReader {
+public:
+    explicit BinaryReader(std::istream &is) : is(is) {}
+
+    template <typename T>
+    T read(){
+        static_assert(std::is_trivially_copyable_v<T>, "BinaryReader::read requires a trivially copyable type");
+        T value;
+        is.read(reinterpret_cast<char *>(&value), sizeof(T));
+        check();
+        return value;
+    }
+
+    template <typename T>
+    vector<T> read_vector(){
+        static_assert(std::is_trivially_copyable_v<T>, "BinaryReader::read_vector requires a trivially copyable type");
+        vector<T> vec(read<uint64_t>());
+        if (!vec.empty()){
+            is.read(reinterpret_cast<char *>(vec.data()), sizeof(T) * vec.size());
+            check();
+        }
+        return vec;
+    }
+
+    std::string read_string(){
+        std::string str(read<uint64_t>(), '\0');
+        if (!str.empty()){
+            is.read(str.data(), str.size());
+            check();
+        }
+        return str;
+    }
+
+private:
+    std::istream &is;
+
+    void check(){
+        if (!is){
+            throw std::runtime_error("Unexpected end of binary stream");
+        }
+    }
+};
+
+/**
+ * @brief Streaming quantile sketch of non-negative values with a bounded relative error (DDSketch).
+ * 
+ * Values are counted in logarithmic buckets (gamma^(i-1), gamma^i], so that the memory depends only on the range of the values, not on their number.
+ * A quantile is estimated within the relative error `alpha` of the exact one.
+ */
+class QuantileSketch {
+public:
+    explicit QuantileSketch(double alpha = 0.01) : alpha(alpha), gamma((1.0 + alpha) / (1.0 - alpha)), log_gamma(std::log(gamma)), offset(0), zero_count(0.0), total(0.0) {}
+
+    void add(double x, double weight = 1.0){
+        total += weight;
+        if (x <= MIN_VALUE){
+            zero_count += weight;
+            return;
+        }
+        int i = (int)std::ceil(std::log(x) / log_gamma);
+        if (bins.empty()){
+            offset = i;
+            bins.push_back(0.0);
+        } else if (i < offset){
+            bins.insert(bins.begin(), (size_t)(offset - i), 0.0);
+            offset = i;
+        } else if (i >= offset + (int)bins.size()){
+            bins.resize((size_t)(i - offset + 1), 0.0);
+        }
+        bins[i - offset] += weight;
+    }
+
+    /**
+     * @brief Estimate the q-quantile. NaN if the sketch is empty.
+     */
+    double quantile(double q) const {
+        if (total <= 0.0){
+            return std::nan("");
+        }
+        double rank = std::clamp(q, 0.0, 1.0) * total;
+        double cum = zero_count;
+        if (cum > 0.0 && cum >= rank){
+            return 0.0;
+        }
+        for (size_t k = 0; k < bins.size(); k++){
+            cum += bins[k];
+            if (cum > 0.0 && cum >= rank){
+                // the value with the same relative error to both ends of the bucket
+                return 2.0 * std::pow(gamma, offset + (int)k) / (gamma + 1.0);
+            }
+        }
+        return 2.0 * std::pow(gamma, offset + (int)bins.size() - 1) / (gamma + 1.0);
+    }
+
+    double count() const {
+        return total;
+    }
+
+    double relative_accuracy() const {
+        return alpha;
+    }
+
+    void clear(){
+        bins.clear();
+        offset = 0;
+        zero_count = 0.0;
+        total = 0.0;
+    }
+
+    size_t bytes() const {
+        return bins.capacity() * sizeof(double);
+    }
+
+    void write(BinaryWriter &out) const {
+        out.write(alpha);
+        out.write(offset);
+        out.write(zero_count);
+        out.write(total);
+        out.write_vector(bins);
+    }
+
+    void read(BinaryReader &in){
+        *this = QuantileSketch(in.read<double>());
+        offset = in.read<int>();
+        zero_count = in.read<double>();
+        total = in.read<double>();
+        bins = in.read_vector<double>();
+    }
+
+private:
+    static constexpr double MIN_VALUE = 1e-9;
+
+    double alpha;
+    double gamma;
+    double log_gamma;
+    int offset;             // bucket index of bins[0]
+    vector<double> bins;
+    double zero_count;      // values not larger than MIN_VALUE
+    double total;
+};
+
+/**
+ * @brief Get the keys of an unordered map in its iteration order.
+ */
+template <typename K, typename V>
+inline vector<K> unordered_map_keys(const std::unordered_map<K, V> &m){
+    vector<K> keys;
+    keys.reserve(m.size());
+    for (const auto &[key, _] : m){
+        keys.push_back(key);
+    }
+    return keys;
+}
+
+/**
+ * @brief Refill an unordered map so that it iterates in the order of `keys`.
+ * 
+ * With the same bucket count, inserting the keys in reverse order reproduces the original iteration order of libstdc++, where a new bucket and a new element in an existing bucket are both linked in front.
+ * With other implementations, the contents are the same but the order may differ.
+ * 
+ * @param m The map to be refilled.
+ * @param keys The keys in the iteration order.
+ * @param bucket_count The bucket count of the original map.
+ * @param value_of The function to get the value of a key.
+ */
+template <typename K, typename V, typename F>
+inline void restore_unordered_map(std::unordered_map<K, V> &m, const vector<K> &keys, size_t bucket_count, F value_of){
+    m.clear();
+    m.rehash(bucket_count);
+    for (auto it = keys.rbegin(); it != keys.rend(); ++it){
+        m.emplace(*it, value_of(*it));
+    }
+}
+
 /**
  * remove_from_vector: remove a particular pointer from a vector.
  */
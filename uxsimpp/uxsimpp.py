@@ -1,4 +1,6 @@
 import random
+import weakref
+import asyncio
 from collections.abc import Iterable
 import numpy as np
 import matplotlib.pyplot as plt
@@ -12,17 +14,30 @@ World = trafficppy.World
 Link = trafficppy.Link
 Node = trafficppy.Node
 Vehicle = trafficppy.Vehicle
+Network = trafficppy.Network
 create_world = trafficppy.create_world
 add_node = trafficppy.add_node
 add_link = trafficppy.add_link
 add_demand = trafficppy.add_demand
+load_checkpoint = trafficppy.load_checkpoint
 
 ################################
 
 from .analyzer import *
 from .utils import *
+from .ensemble import *
+from .results import *
 
 
+#####################################################
+## MARK: 各種定数
+
+LINK_SERIES_MODES = {
+    "dense": 0,
+    "compressed": 1,
+    "compressed_f32": 2,
+}
+
 #####################################################
 ## MARK: シナリオ定義関数
 
@@ -31,7 +46,18 @@ def newWorld(name="",
              duo_update_time=600, duo_update_weight=0.5, 
              print_mode=True,
              random_seed=None,
-             vehicle_detailed_log=1):
+             vehicle_detailed_log=1,
+             vehicle_log_interval=1,
+             vehicle_log_sample_ratio=1.0,
+             vehicle_log_fields=None,
+             vehicle_log_wait=True,
+             vehicle_log_reserve_size=0,
+             vehicle_retire_mode=False,
+             rolling_window_t=None,
+             rolling_spill=None,
+             network=None,
+             route_search_lag=0,
+             link_series="dense"):
     """
     Create a World (simulation environment).
 
@@ -54,7 +80,29 @@ def newWorld(name="",
     random_seed : int or None, optional
         The random seed, default is None.
     vehicle_detailed_log : int, optional
-        Whether save vehicle data or not, default is 1.
+        Whether save vehicle data or not, default is 1. If 0, vehicle data is not saved. If 1, every sample is saved. If 2, only breakpoints of trajectories (link transitions, state changes, and speed changes) are saved and the samples are reconstructed exactly on access.
+    vehicle_log_interval : int, optional
+        Vehicle data is saved every `vehicle_log_interval` timesteps, default is 1. The end of trip is always saved.
+    vehicle_log_sample_ratio : float, optional
+        The ratio of vehicles whose data is saved, default is 1.0. Vehicles are sampled deterministically by their id.
+    vehicle_log_fields : list of str or None, optional
+        The fields of vehicle data to be saved, chosen from "t", "state", "link", "x", and "v". Default is None (all fields).
+    vehicle_log_wait : bool, optional
+        Whether save data of vehicles waiting at the origin or not, default is True.
+    vehicle_log_reserve_size : int, optional
+        The initial capacity of vehicle data for each vehicle, default is 0. Setting the expected number of records avoids reallocation.
+    vehicle_retire_mode : bool, optional
+        Whether move the data of finished vehicles to a compact world-level store and release their per-vehicle state, default is False. The trip records and trajectories of finished vehicles remain accessible.
+    rolling_window_t : float or None, optional
+        If specified, rolling mode is enabled with this window length in seconds, default is None. See `World.set_rolling_mode`.
+    rolling_spill : callable or None, optional
+        The function receiving the data spilled in rolling mode, default is None (the data is dropped).
+    network : Network or None, optional
+        A frozen network obtained by `World.freeze_network` of another World, default is None. If specified, the nodes and links are instantiated from it and its name maps and adjacency lists are shared, so that nodes and links must not be added.
+    route_search_lag : int, optional
+        The number of steps by which the result of each route search is applied late, default is 0. If positive, the route search runs on a worker thread in parallel with the simulation steps. See `World.route_search_lag`.
+    link_series : str, optional
+        The storage of link time series (cumulative curves and travel times), default is "dense". "dense" stores a value per timestep. "compressed" stores only the breakpoints where the values change, which saves memory for long horizons and large networks. "compressed_f32" also stores the values in float32. Compressed series cannot be used with rolling mode.
 
     Returns
     -------
@@ -78,6 +126,22 @@ def newWorld(name="",
         vehicle_detailed_log,  # vehicle_log_mode 
     )
 
+    if vehicle_log_fields is None:
+        vehicle_log_fields = VEHICLE_LOG_FIELDS.keys()
+    fields = 0
+    for field in vehicle_log_fields:
+        fields |= VEHICLE_LOG_FIELDS[field]
+    W.set_vehicle_log_policy(vehicle_log_interval, vehicle_log_sample_ratio, fields, vehicle_log_wait, vehicle_log_reserve_size)
+    W.vehicle_retire_mode = vehicle_retire_mode
+    if link_series not in LINK_SERIES_MODES:
+        raise ValueError(f"Unknown link_series `{link_series}`. Available modes are {list(LINK_SERIES_MODES.keys())}")
+    W.set_series_mode(LINK_SERIES_MODES[link_series])
+    if network is not None:
+        W.attach_network(network)
+    if rolling_window_t is not None:
+        W.set_rolling_mode(rolling_window_t, rolling_spill)
+    W.route_search_lag = route_search_lag
+
     return W
 
 def addNode(W, name, x, y, signal_intervals=[0], signal_offset=0):
@@ -185,6 +249,31 @@ def adddemand(W, origin, destination, start_time, end_time, flow, links_preferre
     add_demand(W, origin, destination, start_time, end_time, flow, links_preferred_list)
 World.adddemand = adddemand
 
+def addDetector(W, name, link, x, interval=300):
+    """
+    Add a virtual loop detector to the world. It records the count, time-mean speed and occupancy of the vehicles crossing the position in each interval.
+
+    Parameters
+    ----------
+    W : World
+        The world to which the detector belongs.
+    name : str
+        The name of the detector.
+    link : str or Link
+        The link on which the detector is placed.
+    x : float
+        The position from the start of the link. It must be in [0, length).
+    interval : float, optional
+        The aggregation interval in seconds, default is 300.
+
+    Returns
+    -------
+    int
+        The index of the detector.
+    """
+    return W.add_detector(name, W.Link_resolve(link, ret_type="name"), x, interval)
+World.addDetector = addDetector
+
 def link__repr__(s):
     return f"<Link `{s.name}`>"
 Link.__repr__ = link__repr__
@@ -221,6 +310,27 @@ def Link_resolve(W, link_like, ret_type="instance"):
         raise ValueError(f"Unknown ret_type {ret_type}")
 World.Link_resolve = Link_resolve
 
+def Node_resolve(W, node_like, ret_type="instance"):
+    instance = None
+    if isinstance(node_like, Node):
+        instance = node_like
+    elif isinstance(node_like, str):
+        instance = W.get_node(node_like)
+    elif isinstance(node_like, int):
+        instance = W.NODES[node_like]
+    else:
+        raise ValueError(f"Unknown Node {node_like}")
+    
+    if ret_type == "instance":
+        return instance
+    elif ret_type == "name":
+        return instance.name
+    elif ret_type == "id":
+        return instance.id
+    else:
+        raise ValueError(f"Unknown ret_type {ret_type}")
+World.Node_resolve = Node_resolve
+
 def eq_Link(W, link_like1, link_like2):
     return W.Link_resolve(link_like1, ret_type="name") == W.Link_resolve(link_like2, ret_type="name")
 World.eq_Link = eq_Link #TODO: Link.__eq__とLink.__hash__をオーバーライドすべきか？
@@ -245,17 +355,150 @@ def exec_simulation(W, duration_t=-1, until_t=-1):
     W.main_loop(duration_t, until_t)
 World.exec_simulation = exec_simulation
 
+async def exec_simulation_async(W, duration_t=-1, until_t=-1, progress_interval_t=None, progress_callback=None):
+    """
+    Execute the simulation in a worker thread without blocking the event loop.
 
-#####################################################
-## MARK: 簡易状態分析関数
+    The simulation is run in chunks of `progress_interval_t` seconds by `asyncio.to_thread`. The GIL is released during each chunk, and the control returns to the event loop between chunks. The results are the same as `exec_simulation`. The world must not be modified by other tasks until this coroutine finishes.
 
-def inflow(l, t1, t2):
-    return (l.arrival_curve[int(t2/l.W.delta_t)]-l.arrival_curve[int(t1/l.W.delta_t)])/(t2-t1)
-Link.inflow = inflow 
+    Parameters
+    ----------
+    W : World
+        The world simulation object.
+    duration_t : float, optional
+        Duration to run simulation, default is -1 (until completion).
+    until_t : float, optional
+        Time to run simulation until, default is -1 (until completion).
+    progress_interval_t : float or None, optional
+        The length of each chunk in seconds, default is None (one tenth of the simulation duration).
+    progress_callback : callable or None, optional
+        The function called as `progress_callback(W)` in the event loop after each chunk, default is None.
+    """
+    if duration_t >= 0 and until_t >= 0:
+        raise ValueError("Cannot specify both `duration_t` and `until_t`")
+    if duration_t >= 0:
+        until_t = W.time + duration_t
+    elif until_t < 0:
+        until_t = W.TMAX
+    if progress_interval_t is None:
+        progress_interval_t = W.TMAX/10
+    if progress_interval_t <= 0:
+        raise ValueError("`progress_interval_t` must be positive")
+
+    await asyncio.to_thread(W.initialize_adj_matrix)
+    t = W.time
+    while True:
+        t = min(t + progress_interval_t, until_t)
+        await asyncio.to_thread(W.main_loop, -1, t)
+        if progress_callback is not None:
+            progress_callback(W)
+        if t >= until_t or not W.check_simulation_ongoing():
+            break
+World.exec_simulation_async = exec_simulation_async
+
+def solve_dynamic_user_equilibrium(W, max_iterations=20, gap_tolerance=0.01, step_size=None, profile_weight=1.0, print_mode=True):
+    """
+    Search dynamic user equilibrium by day-to-day iterations of the same scenario.
 
-def outflow(l, t1, t2):
-    return (l.departure_curve[int(t2/l.W.delta_t)]-l.departure_curve[int(t1/l.W.delta_t)])/(t2-t1)
-Link.outflow = outflow 
+    Each iteration (day) resets the world in place and simulates it. At each route update, the route search uses the link travel times experienced in the previous days at the same time, and the route preferences are updated from the ones at the same time of the previous day toward the shortest paths with `step_size` (method of successive averages by default). The iterations stop when the gap of a day is below `gap_tolerance`. The world holds the result of the last day, and its route table can be saved by `save_route_table` to warm start another run.
+
+    Parameters
+    ----------
+    W : World
+        The world simulation object, either before or after simulation.
+    max_iterations : int, optional
+        The maximum number of iterations, default is 20.
+    gap_tolerance : float, optional
+        The convergence threshold of the relative gap, default is 0.01.
+    step_size : float or None, optional
+        The weight of the shortest paths in updating the route preferences from the previous day, default is None (1/(iteration+1)).
+    profile_weight : float, optional
+        The weight of the latest experienced travel times in updating the travel time profile for the route search, default is 1.0 (only the latest day is used).
+    print_mode : bool, optional
+        Whether print the gap of each iteration, default is True.
+
+    Returns
+    -------
+    list of float
+        The relative gap of each iteration. See `World.equilibrium_gap`.
+    """
+    gaps = []
+    for i in range(max_iterations):
+        W.day_to_day_weight = (1/(i+1) if step_size is None else step_size) if i > 0 else 1.0
+        if i > 0 or W.timestep > 0:
+            W.reset(keep_route_preference=True)
+        W.exec_simulation()
+
+        observed = np.array(W.get_traveltime_profile())
+        gap = W.equilibrium_gap(observed.tolist())
+        gaps.append(gap)
+        if print_mode:
+            print(f"DUE iteration {i}: gap = {gap:.4f}")
+        if gap < gap_tolerance:
+            break
+
+        profile = np.array(W.route_traveltime_profile)
+        if profile.shape != observed.shape:
+            profile = observed
+        else:
+            profile = (1-profile_weight)*profile + profile_weight*observed
+        W.route_traveltime_profile = profile.tolist()
+    return gaps
+World.solve_dynamic_user_equilibrium = solve_dynamic_user_equilibrium
+
+
+_set_rolling_mode = World.set_rolling_mode
+
+def set_rolling_mode(W, window_t, spill=None):
+    """
+    Enable rolling mode. Only the latest `window_t` seconds of link time series are kept in memory, so that they do not grow with the simulation duration. Finished vehicles are retired, and their trajectories are released after being spilled.
+
+    Rolling mode bounds the dominant per-timestep data, but it does not make the memory usage constant:
+    the simulation still ends at `tmax`, a Vehicle object and its archived name and id are kept for every vehicle (`W.VEHICLES` is indexed by vehicle id),
+    the statistics and timing series grow with the number of their intervals, and the detector series are allocated for the whole duration.
+
+    Parameters
+    ----------
+    W : World
+        The world simulation object.
+    window_t : float
+        The length of the window in seconds.
+    spill : callable or None, optional
+        The function called at the end of each window and of the simulation with a dict of the data to be released, default is None (the data is dropped). The dict has the following keys:
+        "ts_start" and "ts_end" (the range of timesteps), "t" (the times of the timesteps), "links" (the link names),
+        "arrival_curve", "departure_curve", "traveltime_real", and "traveltime_instant" (arrays of shape (number of links, number of timesteps)),
+        and "vehicles" (a dict from the names of vehicles finished since the last spill to dicts of their logs "t", "state", "link", "x", and "v").
+    """
+    if spill is None:
+        _set_rolling_mode(W, window_t, None)
+        return
+
+    # a weak reference avoids a reference cycle between the World and the callback
+    W_ref = weakref.ref(W)
+    def callback(ts_start, ts_end):
+        W = W_ref()
+        if W is None:
+            return
+        data = {
+            "ts_start": ts_start,
+            "ts_end": ts_end,
+            "t": np.arange(ts_start, ts_end)*W.delta_t,
+            "links": [l.name for l in W.LINKS],
+        }
+        for kind in ["arrival_curve", "departure_curve", "traveltime_real", "traveltime_instant"]:
+            data[kind] = np.array(W.get_link_series(kind, ts_start, ts_end)).reshape(len(W.LINKS), ts_end-ts_start)
+        vehicles = W.VEHICLES
+        data["vehicles"] = {}
+        for vid in W.get_archived_vehicle_ids(unspilled_only=True):
+            veh = vehicles[vid]
+            data["vehicles"][veh.name] = {"t": veh.log_t, "state": veh.log_state, "link": veh.log_link, "x": veh.log_x, "v": veh.log_v}
+        spill(data)
+    _set_rolling_mode(W, window_t, callback)
+World.set_rolling_mode = set_rolling_mode
+
+
+#####################################################
+## MARK: 簡易状態分析関数
 
 def link_inflow(W, l, t1, t2):
     if type(l) is str:
@@ -269,13 +512,102 @@ def link_outflow(W, l, t1, t2):
     return l.outflow(t1, t2)
 World.link_outflow = link_outflow
 
+_query_links = World.query_links
+
+def query_links(W, links, t1, t2):
+    """
+    Answer a batch of queries of links and time windows in one pass in C++.
+
+    Parameters
+    ----------
+    W : World
+        The world simulation object.
+    links : array-like of int, str or Link
+        The link of each query by id, name or instance.
+    t1 : float or array-like of float
+        The start time of each window. It is broadcast with `links` and `t2`.
+    t2 : float or array-like of float
+        The end time of each window.
+
+    Returns
+    -------
+    dict
+        NumPy arrays of "inflow" and "outflow" (veh/s), "traveltime" (the mean of `Link.traveltime_real`), and "vehicles" (the mean number of vehicles on the link) in the broadcast shape.
+        Queries whose window is empty or out of the kept link series give NaN.
+
+    Examples
+    --------
+    >>> res = W.query_links(["link1", "link2"], [0, 300], [300, 600])
+    >>> res["inflow"]
+    """
+    links = np.asarray(links)
+    if links.dtype.kind not in "iu":
+        links = np.vectorize(lambda l: W.Link_resolve(l, ret_type="id"), otypes=[np.int32])(links)
+    link_ids, t1, t2 = np.broadcast_arrays(links, np.asarray(t1, dtype=float), np.asarray(t2, dtype=float))
+    res = _query_links(W, link_ids.ravel(), t1.ravel(), t2.ravel())
+    return {key: value.reshape(link_ids.shape) for key, value in res.items()}
+World.query_links = query_links
+
+_query_routes = World.query_routes
+
+def query_routes(W, origs, dests, departure_times, return_paths=False, landmarks=8, n_threads=0):
+    """
+    Answer a batch of time-dependent shortest path queries in parallel in C++.
+
+    The link travel times are the ones experienced in the simulation by entry time, so this should be called after the simulation.
+
+    Parameters
+    ----------
+    W : World
+        The world simulation object.
+    origs : array-like of int, str or Node
+        The origin of each query by id, name or instance.
+    dests : array-like of int, str or Node
+        The destination of each query. It is broadcast with `origs` and `departure_times`.
+    departure_times : float or array-like of float
+        The departure time of each query.
+    return_paths : bool, optional
+        Whether return the paths, default is False.
+    landmarks : int, optional
+        The number of ALT landmarks for goal-directed search, default is 8. 0 means plain Dijkstra. It does not change the results.
+    n_threads : int, optional
+        The number of threads, default is 0 (the number of hardware threads).
+
+    Returns
+    -------
+    dict
+        "traveltime": NumPy array of the shortest travel times in the broadcast shape, NaN if unreachable.
+        "paths": list of lists of link names in the flattened order, only if `return_paths` is True.
+
+    Examples
+    --------
+    >>> res = W.query_routes("orig", ["dest1", "dest2"], [0, 600], return_paths=True)
+    >>> res["traveltime"], res["paths"]
+    """
+    def node_ids(nodes):
+        nodes = np.asarray(nodes)
+        if nodes.dtype.kind not in "iu":
+            nodes = np.vectorize(lambda n: W.Node_resolve(n, ret_type="id"), otypes=[np.int32])(nodes)
+        return nodes
+    orig_ids, dest_ids, deps = np.broadcast_arrays(node_ids(origs), node_ids(dests), np.asarray(departure_times, dtype=float))
+    res = _query_routes(W, orig_ids.ravel(), dest_ids.ravel(), deps.ravel(), return_paths, landmarks, n_threads)
+    ret = {"traveltime": res["traveltime"].reshape(orig_ids.shape)}
+    if return_paths:
+        ret["paths"] = [[W.LINKS[i].name for i in path] for path in res["paths"]]
+    return ret
+World.query_routes = query_routes
+
+World.save_results = save_results
+
 
 #####################################################
 ## MARK: 簡易可視化
 
 def plot_cumcurves(l, col):
-    plt.plot([t*l.W.delta_t for t in range(len(l.arrival_curve))], l.arrival_curve, color=col)
-    plt.plot([t*l.W.delta_t for t in range(len(l.arrival_curve))], l.departure_curve, color=col)
+    arrival_curve = l.arrival_curve
+    ts_first = l.series_first_timestep
+    plt.plot([(ts_first+t)*l.W.delta_t for t in range(len(arrival_curve))], arrival_curve, color=col)
+    plt.plot([(ts_first+t)*l.W.delta_t for t in range(len(arrival_curve))], l.departure_curve, color=col)
 
 
 #####################################################